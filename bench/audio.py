@@ -0,0 +1,202 @@
+"""
+Benchmark de transcripción de audio largo (transcribe_audio con troceo) contra
+el OpenAI falso de bench/fakes.py, sin red ni códecs.
+
+Genera Ogg/Opus y MP3 sintéticos pero bien formados (páginas con CRC, frames
+MPEG-1 Layer III a 128 kbps) cuyo contenido lleva marcadores numerados; el STT
+falso "transcribe" devolviendo los marcadores que ve en cada subida. Así se
+comprueba que el texto unido sale completo y en orden, y que cada trozo Ogg es
+un flujo válido (BOS/EOS, secuencia contigua, CRC), además de medir el tiempo
+de pared frente a la duración del audio. También trocea MP3 dañados (bytes sueltos,
+basura, sin ID3v1, cola que no es MP3) y exige el mismo texto que con una llamada.
+
+Uso:
+    python bench/audio.py                                  # 1, 5, 15 y 30 min, ogg y mp3
+    python bench/audio.py --minutes 60 --chunk-sec 60 --concurrency 8
+    python bench/audio.py --sec-per-mb 4 --json out.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import re
+import struct
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from fakes import FakeOpenAI  # noqa: E402
+
+MARK_RE = re.compile(rb"<m(\d{6})>")
+
+
+def _crc_ogg_slow(data: bytes) -> int:
+    """CRC de Ogg bit a bit (independiente de la versión rápida de main.py)."""
+    crc = 0
+    for b in data:
+        crc ^= b << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else (crc << 1)
+            crc &= 0xFFFFFFFF
+    return crc
+
+
+def _ogg_page(flags: int, granule: int, seq: int, packets: List[bytes]) -> bytes:
+    lacing = bytearray()
+    for p in packets:
+        n = len(p)
+        lacing.extend([255] * (n // 255))
+        lacing.append(n % 255)
+    page = bytearray(struct.pack("<4sBBqIIIB", b"OggS", 0, flags, granule, 0x5EED, seq, 0, len(lacing)))
+    page += lacing + b"".join(packets)
+    struct.pack_into("<I", page, 22, _crc_ogg_slow(bytes(page)))
+    return bytes(page)
+
+
+def make_ogg_opus(seconds: int) -> bytes:
+    """1 página por segundo: 50 paquetes de 20 ms (960 muestras a 48 kHz), ~16 kbps."""
+    head = b"OpusHead" + struct.pack("<BBHIhB", 1, 1, 312, 48000, 0, 0)
+    tags = b"OpusTags" + struct.pack("<I", 5) + b"bench" + struct.pack("<I", 0)
+    pages = [_ogg_page(0x02, 0, 0, [head]), _ogg_page(0x00, 0, 1, [tags])]
+    for s in range(seconds):
+        packets = [(b"<m%06d>" % s if i == 0 else b"") + b"\x00" * (40 if i else 32) for i in range(50)]
+        flags = 0x04 if s == seconds - 1 else 0x00
+        pages.append(_ogg_page(flags, 312 + (s + 1) * 48000, s + 2, packets))
+    return b"".join(pages)
+
+
+def make_mp3(seconds: int) -> bytes:
+    """MPEG-1 Layer III, 128 kbps, 44.1 kHz: frames de 417/418 bytes, 1152 muestras."""
+    out = bytearray(b"ID3\x04\x00\x00\x00\x00\x00\x0a" + b"\x00" * 10)
+    frames = int(seconds * 44100 / 1152)
+    acc = 0
+    for i in range(frames):
+        acc += 144 * 128000 % 44100
+        pad = 1 if acc >= 44100 else 0
+        acc -= 44100 if pad else 0
+        length = 144 * 128000 // 44100 + pad
+        hdr = bytes([0xFF, 0xFB, 0x90 | (pad << 1), 0x64])
+        sec = int(i * 1152 / 44100)
+        mark = b"<m%06d>" % sec if int((i - 1) * 1152 / 44100) != sec or i == 0 else b""
+        out += hdr + mark + b"\x00" * (length - 4 - len(mark))
+    return bytes(out + b"TAG" + b"\x00" * 125)
+
+
+def fake_transcriber(body: bytes) -> str:
+    return " ".join(f"w{int(n)}" for n in MARK_RE.findall(body))
+
+
+def check_ogg_chunk(data: bytes) -> None:
+    pos, seq = 0, 0
+    while pos < len(data):
+        _cap, _v, flags, _gp, _ser, pseq, crc, nseg = struct.unpack_from("<4sBBqIIIB", data, pos)
+        size = 27 + nseg + sum(data[pos + 27:pos + 27 + nseg])
+        page = bytearray(data[pos:pos + size])
+        struct.pack_into("<I", page, 22, 0)
+        assert _crc_ogg_slow(bytes(page)) == crc, f"CRC inválido en página {seq}"
+        assert pseq == seq, f"secuencia {pseq} != {seq}"
+        assert bool(flags & 0x02) == (seq == 0), "BOS fuera de la primera página"
+        pos += size
+        seq += 1
+        assert bool(flags & 0x04) == (pos == len(data)), "EOS fuera de la última página"
+
+
+def damaged_mp3_cases(seconds: int = 600) -> List[Tuple[str, bytes]]:
+    """MP3 con defectos reales: el troceo debe cubrir todo o no trocear."""
+    data = make_mp3(seconds)
+    k, half = int(len(data) * 0.2), len(data) // 2
+    return [
+        ("byte suelto al 20%", data[:k] + b"\x00" + data[k:]),
+        ("4 KiB de ceros al 50%", data[:half] + b"\x00" * 4096 + data[half:]),
+        ("sin ID3v1, último frame cortado", data[:-128 - 200]),
+        ("cola no MP3 de 200 KB", data + b"\x00" * 200_000),
+    ]
+
+
+async def run_damaged_mp3(m: Any, stt: FakeOpenAI, chunk_sec: float) -> List[Dict[str, Any]]:
+    """Troceado vs una llamada: mismo texto (si no se puede resincronizar, una llamada)."""
+    rows = []
+    for name, data in damaged_mp3_cases():
+        expected = fake_transcriber(data)
+        m.STT_CHUNK_SEC = chunk_sec
+        calls0 = stt.calls["transcriptions"]
+        text = await m.transcribe_audio(io.BytesIO(data), "audio.mp3", "audio/mpeg", language_hint="es")
+        row = {"case": name, "calls": stt.calls["transcriptions"] - calls0, "ok": text == expected}
+        rows.append(row)
+        print(f"mp3 dañado: {name:<32} {row['calls']:>3} llamadas | texto completo: {row['ok']}")
+    return rows
+
+
+async def run(args) -> Dict[str, Any]:
+    stt = FakeOpenAI(transcriber=fake_transcriber, sec_per_mb=args.sec_per_mb)
+    url = await stt.start()
+    os.environ.update(
+        DATA_DIR=tempfile.mkdtemp(prefix="bench_audio_"), OPENAI_API_KEY="bench", OPENAI_BASE_URL=url + "/v1",
+        STT_CHUNK_SEC=str(args.chunk_sec), STT_CHUNK_CONCURRENCY=str(args.concurrency),
+    )
+    import main as m
+
+    report: Dict[str, Any] = {"chunk_sec": args.chunk_sec, "concurrency": args.concurrency, "runs": []}
+    try:
+        for fmt, make, mime in (("ogg", make_ogg_opus, "audio/ogg"), ("mp3", make_mp3, "audio/mpeg")):
+            for minutes in args.minutes:
+                seconds = int(minutes * 60)
+                data = make(seconds)
+                expected = " ".join(f"w{s}" for s in range(seconds))
+
+                if fmt == "ogg":
+                    chunks = m.split_audio(io.BytesIO(data), chunk_sec=args.chunk_sec, max_bytes=m.OPENAI_STT_MAX_BYTES)
+                    for c in chunks or []:
+                        check_ogg_chunk(c.read())
+
+                row: Dict[str, Any] = {"format": fmt, "minutes": minutes, "bytes": len(data)}
+                for mode, chunk_sec in (("single", 0.0), ("chunked", args.chunk_sec)):
+                    m.STT_CHUNK_SEC = chunk_sec
+                    calls0 = stt.calls["transcriptions"]
+                    t0 = time.perf_counter()
+                    try:
+                        text = await m.transcribe_audio(io.BytesIO(data), "audio." + fmt, mime, language_hint="es")
+                    except RuntimeError:
+                        # Sin trocear, más de OPENAI_STT_MAX_BYTES no se manda a Whisper
+                        if mode == "chunked" or len(data) <= m.OPENAI_STT_MAX_BYTES:
+                            raise
+                        text = None
+                    row[mode + "_s"] = round(time.perf_counter() - t0, 3) if text is not None else None
+                    row[mode + "_calls"] = stt.calls["transcriptions"] - calls0
+                    row[mode + "_ok"] = text is None or text == expected
+                report["runs"].append(row)
+                single = f"{row['single_s']:>7.3f}s" if row["single_s"] is not None else "  > límite"
+                print(f"{fmt:<4} {minutes:>5.1f} min {len(data) / 1e6:>7.2f} MB | "
+                      f"una llamada {single} | "
+                      f"troceado {row['chunked_s']:>7.3f}s ({row['chunked_calls']} trozos) | "
+                      f"texto completo y en orden: {row['single_ok'] and row['chunked_ok']}")
+        report["mp3_damaged"] = await run_damaged_mp3(m, stt, args.chunk_sec)
+    finally:
+        await m.HTTP.close()
+        await stt.stop()
+    return report
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark de transcripción troceada con STT falso")
+    ap.add_argument("--minutes", type=float, nargs="+", default=[1, 5, 15, 30])
+    ap.add_argument("--chunk-sec", type=float, default=120.0)
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--sec-per-mb", type=float, default=2.0, help="latencia del STT falso por MB subido")
+    ap.add_argument("--json", help="guardar el reporte en este fichero")
+    args = ap.parse_args()
+    report = asyncio.run(run(args))
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2))
+    if not all(r["single_ok"] and r["chunked_ok"] for r in report["runs"]):
+        sys.exit(1)
+    if not all(r["ok"] for r in report["mp3_damaged"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
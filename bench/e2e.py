@@ -0,0 +1,425 @@
+"""
+Benchmark extremo a extremo, sin red: levanta Telegram/DeepL/OpenAI falsos
+(bench/fakes.py), arranca la app real de main.py contra ellos y le inyecta un
+flujo sintético de updates (texto, captions, álbumes, voz, ediciones, replies,
+fanout y canal) por los handlers normales.
+
+Uso:
+    python bench/e2e.py --updates 500 --tg-latency 0.03 --deepl-latency 0.08
+    python bench/e2e.py --mix text=1 --rate 50 --tg-429 0.02 --json out.json
+    python bench/e2e.py --ingest webhook --updates 200
+
+Con --ingest webhook los updates entran por HTTP al servidor de create_webhook_app
+(con el header de secreto) en vez de llamar al update_processor; antes se comprueba
+que sin secreto o con uno erróneo responde 403, que /metrics no está expuesto
+y que, con WEBHOOK_QUEUE_MAX updates retenidos, el siguiente recibe 503
+(si algo de eso falla, sale con código 1). Con --tg-local, getFile da rutas de otro
+disco que se traducen con TG_LOCAL_PATH_MAP; si algún audio baja por HTTP, código 1.
+
+Reporta updates/s, entregas/s, percentiles de latencia por update (desde que
+entra hasta que su handler termina, incluida la cola) y llamadas por API.
+Cualquier variable de entorno de main.py (UPDATE_WORKERS, DELIVERY_CONCURRENCY,
+OUTBOX, ...) se respeta; las URLs, claves y DATA_DIR las fija el benchmark.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from fakes import Faults, FakeDeepL, FakeOpenAI, FakeTelegram  # noqa: E402
+
+DEFAULT_MIX = "text=40,caption=10,album=8,voice=5,edit=10,reply=10,fanout=12,channel=5"
+BENCH_TOKEN = "4242:bench"
+WEBHOOK_SECRET = "bench-webhook-secret"
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+SENDER = {"id": 1001, "is_bot": False, "first_name": "Trader", "last_name": "Bench"}
+CHANNEL_SRC = {"id": -1007770001, "type": "channel", "title": "src", "username": "johaaletrader_es"}
+
+
+def parse_mix(spec: str) -> List[Tuple[str, float]]:
+    out = []
+    for part in spec.split(","):
+        if part.strip():
+            k, _, w = part.partition("=")
+            out.append((k.strip(), float(w or "1")))
+    return out
+
+
+def _signal_text(n: int) -> Tuple[str, List[Dict[str, Any]]]:
+    head = f"Señal #{n}"
+    url = f"https://example.com/s/{n}"
+    text = (
+        f"{head}: compra BTC en 65{n % 1000:03d}, objetivo 67000 y stop 63800. "
+        f"Gestiona el riesgo y no arriesgues más del 1% por operación. Detalles en {url} 🚀📈"
+    )
+    ents = [
+        {"type": "bold", "offset": 0, "length": len(head)},
+        {"type": "url", "offset": text.index(url), "length": len(url)},
+    ]
+    return text, ents
+
+
+class StreamBuilder:
+    """Genera dicts de Update (formato Bot API) sobre las rutas reales de main.py."""
+
+    def __init__(self, m, seed: int):
+        self.m = m
+        self.rnd = random.Random(seed)
+        self.update_ids = itertools.count(1)
+        self.msg_ids: Dict[int, itertools.count] = defaultdict(lambda: itertools.count(1))
+        fan = set(m.FANOUT_ROUTES)
+        self.fanout_routes = sorted(fan)
+        self.topic_routes = sorted(k for k in m.TOPIC_ROUTES if k not in fan and k[0] != k[1])
+        self.history: Dict[Tuple[int, int], List[Dict[str, Any]]] = defaultdict(list)
+        self.files = itertools.count(1)
+
+    def _base(self, chat_id: int, thread: int) -> Dict[str, Any]:
+        return {
+            "message_id": next(self.msg_ids[chat_id]),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "src", "is_forum": True},
+            "from": dict(SENDER),
+            "message_thread_id": thread,
+            "is_topic_message": True,
+        }
+
+    def _photo(self) -> List[Dict[str, Any]]:
+        n = next(self.files)
+        return [{"file_id": f"photo-{n}", "file_unique_id": f"up{n}", "width": 1280, "height": 720}]
+
+    def _update(self, key: str, msg: Dict[str, Any]) -> Dict[str, Any]:
+        return {"update_id": next(self.update_ids), key: msg}
+
+    def build(self, kind: str) -> List[Tuple[str, Dict[str, Any]]]:
+        route = self.rnd.choice(self.fanout_routes if kind == "fanout" else self.topic_routes)
+        chat_id, thread = route
+        hist = self.history[route]
+
+        if kind == "channel":
+            msg = self._base(CHANNEL_SRC["id"], 0)
+            for k in ("from", "message_thread_id", "is_topic_message"):
+                msg.pop(k)
+            msg["chat"] = dict(CHANNEL_SRC)
+            msg["text"], msg["entities"] = _signal_text(msg["message_id"])
+            return [(kind, self._update("channel_post", msg))]
+
+        if kind == "edit" and hist:
+            msg = json.loads(json.dumps(self.rnd.choice(hist)))
+            msg["text"] = msg["text"] + " (actualizado)"
+            msg["edit_date"] = int(time.time())
+            return [(kind, self._update("edited_message", msg))]
+
+        if kind == "album":
+            mgid = f"mg{next(self.files)}"
+            out = []
+            for i in range(self.rnd.randint(2, 4)):
+                msg = self._base(chat_id, thread)
+                msg["media_group_id"] = mgid
+                msg["photo"] = self._photo()
+                if i == 0:
+                    msg["caption"] = "Gráfico del día: soporte en 64000 y resistencia en 67000"
+                out.append((kind, self._update("message", msg)))
+            return out
+
+        msg = self._base(chat_id, thread)
+        if kind == "caption":
+            msg["photo"] = self._photo()
+            msg["caption"] = "Análisis técnico del par ETH/USDT, atentos a la ruptura 📊"
+        elif kind == "voice":
+            n = next(self.files)
+            msg["voice"] = {"file_id": f"voice-{n}", "file_unique_id": f"uv{n}", "duration": 12,
+                            "mime_type": "audio/ogg", "file_size": 48_000}
+        else:
+            msg["text"], msg["entities"] = _signal_text(msg["message_id"])
+            if kind == "reply" and hist:
+                msg["reply_to_message"] = self.rnd.choice(hist)
+            hist.append(msg)
+            del hist[:-50]
+        return [(kind, self._update("message", msg))]
+
+    def stream(self, n: int, mix: List[Tuple[str, float]]) -> List[Tuple[str, Dict[str, Any]]]:
+        kinds = [k for k, _ in mix]
+        weights = [w for _, w in mix]
+        out: List[Tuple[str, Dict[str, Any]]] = []
+        while len(out) < n:
+            out.extend(self.build(self.rnd.choices(kinds, weights)[0]))
+        return out[:n]
+
+
+async def _drain(m, timeout: float):
+    """Espera a que no quede trabajo: álbumes en buffer, scheduler, captions de audio y escritor de SQLite."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if (not m.MEDIA_GROUP_TASKS and not m.MEDIA_GROUP_BUFFER and m.DELIVERY.pending() == 0
+                and m.AUDIO_POOL.pending() == 0):
+            break
+        await asyncio.sleep(0.02)
+    if m.MSG_MAP:
+        await m.MSG_MAP.flush()
+
+
+async def _start_webhook(m, app):
+    """Servidor de create_webhook_app en un puerto libre + aviso de fin por update_id."""
+    from telegram.ext import TypeHandler
+
+    handled: Dict[int, "asyncio.Future[None]"] = {}
+
+    async def _done(update, _context):
+        fut = handled.get(update.update_id)
+        if fut is not None and not fut.done():
+            fut.set_result(None)
+
+    # Grupo alto: corre después de los handlers reales del mismo update
+    app.add_handler(TypeHandler(m.Update, _done), group=99)
+    await app.start()
+    runner = web.AppRunner(m.create_webhook_app(app, secret=WEBHOOK_SECRET), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    return runner, aiohttp.ClientSession(), url, handled
+
+
+async def _webhook_checks(session, url: str, path: str, sample: Dict[str, Any]) -> Dict[str, Any]:
+    """Sin secreto / secreto erróneo → 403 (sin encolar nada); /metrics no expuesto."""
+    probe = dict(sample, update_id=10 ** 9)
+    out: Dict[str, Any] = {}
+    for name, headers in (("sin_secreto", {}), ("secreto_erroneo", {SECRET_HEADER: "nope"})):
+        async with session.post(url + path, json=probe, headers=headers) as r:
+            out[name] = r.status
+    async with session.get(url + "/metrics") as r:
+        out["metrics"] = r.status
+    async with session.get(url + "/healthz") as r:
+        out["healthz"] = r.status
+    out["ok"] = (out["sin_secreto"], out["secreto_erroneo"], out["metrics"], out["healthz"]) == (403, 403, 404, 200)
+    return out
+
+
+async def _webhook_backpressure(m, app, session, url: str, sample: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Updates retenidos en un mismo tema hasta llenar WEBHOOK_QUEUE_MAX: el siguiente
+    debe recibir 503 (con Retry-After) y, al soltarlos y drenar, volver a aceptarse.
+    Los retenidos no pasan a los handlers reales (no cuentan como entregas).
+    """
+    from telegram.ext import ApplicationHandlerStop, TypeHandler
+
+    base = 2 * 10 ** 9
+    gate = asyncio.Event()
+
+    async def _hold(update, _context):
+        if update.update_id >= base:
+            await gate.wait()
+            raise ApplicationHandlerStop
+
+    async def _post(i: int) -> Tuple[int, str]:
+        async with session.post(url + m.WEBHOOK_PATH, json=dict(sample, update_id=base + i),
+                                headers={SECRET_HEADER: WEBHOOK_SECRET}) as r:
+            return r.status, r.headers.get("Retry-After", "")
+
+    async def _settle(timeout: float = 10.0) -> None:
+        deadline = time.monotonic() + timeout
+        while m.ingest_backlog(app) and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+
+    handler = TypeHandler(m.Update, _hold)
+    app.add_handler(handler, group=-1)
+    out: Dict[str, Any] = {"max": m.WEBHOOK_QUEUE_MAX, "accepted": 0, "busy": None}
+    try:
+        for i in range(m.WEBHOOK_QUEUE_MAX + 20):
+            status, retry = await _post(i)
+            if status != 200:
+                out["busy"], out["retry_after"] = status, retry
+                break
+            out["accepted"] += 1
+        out["backlog_at_busy"] = m.ingest_backlog(app)
+        gate.set()
+        await _settle()
+        out["after_drain"] = (await _post(m.WEBHOOK_QUEUE_MAX + 20))[0]
+        await _settle()
+    finally:
+        gate.set()
+        app.remove_handler(handler, group=-1)
+    out["ok"] = (out["busy"] == 503 and out.get("retry_after") == "1" and out["after_drain"] == 200
+                 and out["accepted"] <= m.WEBHOOK_QUEUE_MAX)
+    return out
+
+
+def _stage_summary(m) -> Dict[str, Dict[str, float]]:
+    agg: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0.0])
+    for (stage, _route, _kind), row in m.STAGE_SECONDS._values.items():
+        agg[stage][0] += row[-2]
+        agg[stage][1] += row[-1]
+    return {s: {"count": c, "mean_ms": (t / c * 1000.0) if c else 0.0} for s, (c, t) in sorted(agg.items())}
+
+
+async def run(args) -> Dict[str, Any]:
+    jitter = args.jitter
+    data_dir = tempfile.mkdtemp(prefix="replicator-bench-")
+    tg = FakeTelegram(Faults(args.tg_latency, jitter, args.tg_errors, args.tg_429), seed=args.seed,
+                      local_dir=os.path.join(data_dir, "bot-api") if args.tg_local else None)
+    deepl = FakeDeepL(Faults(args.deepl_latency, jitter, args.deepl_errors, args.deepl_429), seed=args.seed + 1)
+    stt = FakeOpenAI(Faults(args.stt_latency, jitter, args.stt_errors, args.stt_429), seed=args.seed + 2)
+    tg_url, deepl_url, stt_url = await tg.start(), await deepl.start(), await stt.start()
+
+    os.environ.update(
+        BOT_TOKEN=BENCH_TOKEN, DATA_DIR=data_dir, ADMIN_ID="0",
+        DEEPL_API_KEY="bench", DEEPL_API_URL=deepl_url,
+        OPENAI_API_KEY="bench", OPENAI_BASE_URL=stt_url + "/v1",
+    )
+    os.environ.setdefault("CATCHUP", "false")
+    os.environ.setdefault("TG_RATE_LIMIT", "true" if args.rate_limit else "false")
+    os.environ["TG_LOCAL_MODE"] = "true" if args.tg_local else "false"
+    if args.tg_local:
+        os.environ["TG_LOCAL_PATH_MAP"] = f"{tg.server_dir}:{tg.local_dir}"
+    import main as m  # noqa: E402  (lee la configuración del entorno al importar)
+
+    if not args.verbose:
+        for name in ("replicator", "httpx", "telegram", "aiohttp.access"):
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+    m.db_init()
+    app = m.build_application(base_url=tg_url + "/bot", base_file_url=tg_url + "/file/bot", local_mode=args.tg_local)
+    await app.initialize()
+    await m._post_init(app)
+
+    stream = StreamBuilder(m, args.seed).stream(args.updates, parse_mix(args.mix))
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    tg_calls_before = sum(tg.calls.values())
+
+    webhook: Dict[str, Any] = {}
+    wh_runner = wh_session = None
+    if args.ingest == "webhook":
+        wh_runner, wh_session, wh_url, handled = await _start_webhook(m, app)
+        webhook = await _webhook_checks(wh_session, wh_url, m.WEBHOOK_PATH, stream[0][1])
+        webhook["backpressure"] = await _webhook_backpressure(m, app, wh_session, wh_url, stream[0][1])
+        webhook["ok"] = webhook["ok"] and webhook["backpressure"]["ok"]
+
+    async def one(kind: str, data: Dict[str, Any], t0: float):
+        if wh_session is None:
+            u = m.Update.de_json(data, app.bot)
+            await app.update_processor.process_update(u, app.process_update(u))
+        else:
+            # Latencia = hasta que el handler terminó (no hasta el 200 del webhook)
+            fut = handled.setdefault(data["update_id"], asyncio.get_running_loop().create_future())
+            async with wh_session.post(wh_url + m.WEBHOOK_PATH, json=data, headers={SECRET_HEADER: WEBHOOK_SECRET}) as r:
+                if r.status != 200:
+                    raise RuntimeError(f"webhook HTTP {r.status}")
+            await fut
+        latencies[kind].append(time.perf_counter() - t0)
+
+    t_start = time.perf_counter()
+    tasks = []
+    for i, (kind, data) in enumerate(stream):
+        if args.rate > 0:
+            delay = t_start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one(kind, data, time.perf_counter())))
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    await _drain(m, args.drain_timeout)
+    wall = time.perf_counter() - t_start
+
+    deliveries = sum(1 for _, meth, _ in tg.sent if meth.startswith(("send", "copy", "edit")))
+    all_lat = sorted(x for v in latencies.values() for x in v)
+    pct = lambda vals: {p: round(m._percentile(vals, q) * 1000.0, 2) for p, q in (("p50", 50), ("p95", 95), ("p99", 99))}
+    report = {
+        "updates": len(stream),
+        "failed_updates": sum(1 for r in results if isinstance(r, Exception)),
+        "kinds": dict(Counter(k for k, _ in stream)),
+        "wall_sec": round(wall, 3),
+        "updates_per_sec": round(len(stream) / wall, 2) if wall else 0.0,
+        "deliveries": deliveries,
+        "deliveries_per_sec": round(deliveries / wall, 2) if wall else 0.0,
+        "latency_ms": {**pct(all_lat), "max": round(all_lat[-1] * 1000.0, 2) if all_lat else 0.0},
+        "latency_ms_by_kind": {k: pct(sorted(v)) for k, v in sorted(latencies.items())},
+        "calls": {
+            "telegram": dict(tg.calls),
+            "deepl": dict(deepl.calls),
+            "openai": dict(stt.calls),
+        },
+        "telegram_calls_during_run": sum(tg.calls.values()) - tg_calls_before,
+        "deepl_texts": deepl.texts,
+        "injected_errors": {s.name: dict(s.errors) for s in (tg, deepl, stt) if s.errors},
+        "stages": _stage_summary(m),
+        "webhook": webhook,
+        "config": {k: v for k, v in vars(args).items() if k != "json"},
+    }
+
+    if wh_runner is not None:
+        await wh_session.close()
+        await wh_runner.cleanup()
+        await app.stop()
+    await m._post_stop(app)
+    await app.shutdown()
+    await m._post_shutdown(app)
+    for s in (tg, deepl, stt):
+        await s.stop()
+    return report
+
+
+def print_report(r: Dict[str, Any]):
+    lat = r["latency_ms"]
+    print(f"updates: {r['updates']} ({r['failed_updates']} con error)  kinds: {r['kinds']}")
+    print(f"wall: {r['wall_sec']:.2f}s  throughput: {r['updates_per_sec']:.1f} updates/s, "
+          f"{r['deliveries_per_sec']:.1f} entregas/s ({r['deliveries']} entregas)")
+    print(f"latencia por update (ms): p50={lat['p50']} p95={lat['p95']} p99={lat['p99']} max={lat['max']}")
+    for k, p in r["latency_ms_by_kind"].items():
+        print(f"  {k:<8} p50={p['p50']:>9} p95={p['p95']:>9} p99={p['p99']:>9}")
+    for svc, calls in r["calls"].items():
+        print(f"{svc}: {sum(calls.values())} llamadas {calls}")
+    print(f"deepl textos: {r['deepl_texts']}")
+    if r["injected_errors"]:
+        print(f"errores inyectados: {r['injected_errors']}")
+    if r["webhook"]:
+        print(f"webhook: {r['webhook']}")
+    print("etapas (media ms / n):")
+    for stage, st in r["stages"].items():
+        print(f"  {stage:<40} {st['mean_ms']:>9.2f} / {st['count']:g}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark offline del replicador")
+    ap.add_argument("--updates", type=int, default=300)
+    ap.add_argument("--rate", type=float, default=0.0, help="updates/s inyectados (0 = ráfaga)")
+    ap.add_argument("--mix", default=DEFAULT_MIX)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--jitter", type=float, default=0.2)
+    for svc, lat in (("tg", 0.03), ("deepl", 0.08), ("stt", 0.4)):
+        ap.add_argument(f"--{svc}-latency", type=float, default=lat)
+        ap.add_argument(f"--{svc}-errors", type=float, default=0.0)
+        ap.add_argument(f"--{svc}-429", type=float, default=0.0)
+    ap.add_argument("--rate-limit", action="store_true", help="activar el rate limiter proactivo de Telegram")
+    ap.add_argument("--tg-local", action="store_true", help="simular telegram-bot-api --local (audio leído de disco)")
+    ap.add_argument("--ingest", choices=("direct", "webhook"), default="direct",
+                    help="direct = update_processor; webhook = POST al servidor de create_webhook_app")
+    ap.add_argument("--drain-timeout", type=float, default=60.0)
+    ap.add_argument("--json", help="guardar el reporte en este fichero")
+    ap.add_argument("--verbose", action="store_true")
+    args = ap.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    if report["webhook"] and not report["webhook"]["ok"]:
+        sys.exit(1)
+    if args.tg_local and report["calls"]["telegram"].get("file"):
+        print("--tg-local: el audio se descargó por HTTP en vez de leerse de disco")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
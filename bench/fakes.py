@@ -0,0 +1,238 @@
+"""
+Servidores falsos (aiohttp) para medir el bot sin servicios reales:
+  - Telegram Bot API  (/bot<token>/<método> y /file/bot<token>/<ruta>)
+  - DeepL             (/v2/translate, /v2/glossaries)
+  - OpenAI            (/v1/audio/transcriptions)
+
+Cada uno admite latencia (media + jitter), errores 5xx y 429 inyectados con una
+probabilidad, y lleva la cuenta de llamadas por método.
+"""
+import asyncio
+import itertools
+import json
+import os
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+
+@dataclass
+class Faults:
+    latency: float = 0.0       # segundos por llamada
+    jitter: float = 0.0        # ± fracción de latency
+    error_rate: float = 0.0    # probabilidad de 5xx
+    rate_429: float = 0.0      # probabilidad de 429
+    retry_after: int = 1       # segundos que se piden en los 429
+
+
+class FakeService:
+    name = "fake"
+
+    def __init__(self, faults: Optional[Faults] = None, seed: int = 0):
+        self.faults = faults or Faults()
+        self.calls: Counter = Counter()
+        self.errors: Counter = Counter()
+        self._rnd = random.Random(seed)
+        self._runner: Optional[web.AppRunner] = None
+        self.port = 0
+
+    def routes(self, app: web.Application):
+        raise NotImplementedError
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        self.routes(app)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{self.port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def inject(self, method: str) -> Optional[str]:
+        """Aplica latencia y decide si esta llamada falla: None, "429" o "error"."""
+        self.calls[method] += 1
+        f = self.faults
+        if f.latency > 0:
+            j = f.latency * f.jitter
+            await asyncio.sleep(max(0.0, f.latency + self._rnd.uniform(-j, j)))
+        r = self._rnd.random()
+        if r < f.rate_429:
+            self.errors[method + ":429"] += 1
+            return "429"
+        if r < f.rate_429 + f.error_rate:
+            self.errors[method + ":error"] += 1
+            return "error"
+        return None
+
+
+class FakeTelegram(FakeService):
+    name = "telegram"
+
+    def __init__(self, faults: Optional[Faults] = None, seed: int = 0, file_size: int = 64 * 1024,
+                 local_dir: Optional[str] = None, server_dir: str = "/var/lib/telegram-bot-api"):
+        super().__init__(faults, seed)
+        self.file_size = file_size
+        # Como telegram-bot-api --local: getFile da una ruta absoluta de *su* disco
+        # (server_dir, que aquí no existe) y el fichero está en local_dir, el mismo
+        # volumen montado en otra ruta (TG_LOCAL_PATH_MAP="server_dir:local_dir")
+        self.local_dir = local_dir
+        self.server_dir = server_dir
+        self.bot_id = 4242
+        self._ids = itertools.count(1_000_000)
+        self.sent: List[Tuple[float, str, Dict[str, Any]]] = []  # (t, método, params)
+
+    def routes(self, app: web.Application):
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.handle_file)
+
+    @staticmethod
+    async def _params(request: web.Request) -> Dict[str, Any]:
+        if request.content_type == "application/json":
+            return await request.json()
+        if request.content_type.startswith("multipart/") or request.content_type.endswith("urlencoded"):
+            form = await request.post()
+            return {k: (v if isinstance(v, str) else "<file>") for k, v in form.items()}
+        return {}
+
+    def _message(self, params: Dict[str, Any], **extra: Any) -> Dict[str, Any]:
+        chat_id = params.get("chat_id", 0)
+        try:
+            chat_id = int(chat_id)
+            chat = {"id": chat_id, "type": "supergroup", "title": "dst"}
+        except (TypeError, ValueError):
+            chat = {"id": -100999, "type": "channel", "username": str(chat_id).lstrip("@")}
+        msg = {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": chat,
+            "from": {"id": self.bot_id, "is_bot": True, "first_name": "bench"},
+        }
+        if params.get("message_thread_id"):
+            msg["message_thread_id"] = int(params["message_thread_id"])
+        msg.update(extra)
+        return msg
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = await self._params(request)
+        fault = await self.inject(method)
+        if fault == "429":
+            f = self.faults
+            return web.json_response(
+                {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {f.retry_after}",
+                 "parameters": {"retry_after": f.retry_after}},
+                status=429,
+            )
+        if fault == "error":
+            return web.json_response({"ok": False, "error_code": 502, "description": "Bad Gateway"}, status=502)
+
+        self.sent.append((time.perf_counter(), method, params))
+        if method == "getMe":
+            result: Any = {"id": self.bot_id, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getFile":
+            fid = str(params.get("file_id", "f"))
+            path = f"voice/{fid}.oga"
+            if self.local_dir:
+                disk = os.path.join(self.local_dir, path)
+                if not os.path.exists(disk):
+                    os.makedirs(os.path.dirname(disk), exist_ok=True)
+                    with open(disk, "wb") as fh:
+                        fh.write(b"\x00" * self.file_size)
+                path = os.path.join(self.server_dir, path)
+            result = {"file_id": fid, "file_unique_id": "u" + fid, "file_size": self.file_size, "file_path": path}
+        elif method == "copyMessage":
+            result = {"message_id": next(self._ids)}
+        elif method == "sendMediaGroup":
+            media = params.get("media") or "[]"
+            n = len(json.loads(media) if isinstance(media, str) else media)
+            result = [self._message(params) for _ in range(max(1, n))]
+        elif method.startswith("send") or method.startswith("edit"):
+            result = self._message(params, text=params.get("text") or "")
+        elif method == "getUpdates":
+            result = []
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        fault = await self.inject("file")
+        if fault:
+            return web.Response(status=502 if fault == "error" else 429)
+        return web.Response(body=b"\x00" * self.file_size, content_type="audio/ogg")
+
+
+class FakeDeepL(FakeService):
+    name = "deepl"
+
+    def __init__(self, faults: Optional[Faults] = None, seed: int = 0):
+        super().__init__(faults, seed)
+        self.texts = 0
+
+    def routes(self, app: web.Application):
+        app.router.add_post("/v2/translate", self.translate)
+        app.router.add_post("/v2/glossaries", self.create_glossary)
+        app.router.add_get("/v2/glossaries", self.list_glossaries)
+
+    def _fail(self, fault: str) -> web.Response:
+        if fault == "429":
+            return web.json_response({"message": "Too many requests"}, status=429)
+        return web.json_response({"message": "Internal error"}, status=500)
+
+    async def translate(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        texts = form.getall("text", [])
+        fault = await self.inject("translate")
+        if fault:
+            return self._fail(fault)
+        self.texts += len(texts)
+        return web.json_response({"translations": [{"detected_source_language": "ES", "text": t} for t in texts]})
+
+    async def create_glossary(self, request: web.Request) -> web.Response:
+        await request.post()
+        fault = await self.inject("glossaries")
+        if fault:
+            return self._fail(fault)
+        return web.json_response({"glossary_id": "bench-glossary", "ready": True})
+
+    async def list_glossaries(self, request: web.Request) -> web.Response:
+        fault = await self.inject("glossaries")
+        if fault:
+            return self._fail(fault)
+        return web.json_response({"glossaries": [{"glossary_id": "bench-glossary", "ready": True}]})
+
+
+class FakeOpenAI(FakeService):
+    name = "openai"
+
+    def __init__(self, faults: Optional[Faults] = None, seed: int = 0, text: str = "hola, esto es una nota de voz de prueba",
+                 transcriber: Optional[Callable[[bytes], str]] = None, sec_per_mb: float = 0.0):
+        super().__init__(faults, seed)
+        self.text = text
+        self.transcriber = transcriber  # cuerpo multipart -> texto (para comprobar el orden de los trozos)
+        self.sec_per_mb = sec_per_mb    # latencia extra proporcional al audio, como Whisper
+        self.bytes_in = 0
+
+    def routes(self, app: web.Application):
+        app.router.add_post("/v1/audio/transcriptions", self.transcribe)
+
+    async def transcribe(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        self.bytes_in += len(body)
+        if self.sec_per_mb > 0:
+            await asyncio.sleep(len(body) / (1024 * 1024) * self.sec_per_mb)
+        fault = await self.inject("transcriptions")
+        if fault == "429":
+            return web.json_response({"error": {"message": "Rate limit reached"}}, status=429)
+        if fault:
+            return web.json_response({"error": {"message": "Server error"}}, status=500)
+        return web.json_response({"text": self.transcriber(body) if self.transcriber else self.text})
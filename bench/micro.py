@@ -0,0 +1,243 @@
+"""
+Microbenchmarks de los caminos de texto que corren en cada mensaje:
+RichText (entities -> HTML / entities), split_html_safe, preprocess_for_translation,
+postprocess_translation, probably_english y cap_with_prefix.
+
+Corpus sintético pero realista (y determinista): señales largas con muchas
+entities, captions llenos de emojis, HTML de ~20k caracteres y textos con
+muchas URLs.
+
+Uso:
+    python bench/micro.py                              # mide e imprime
+    python bench/micro.py --save bench/baseline.json   # guarda baseline JSON
+    python bench/micro.py --compare bench/baseline.json --threshold 0.15
+    python bench/micro.py -k split_html                # solo casos que contengan "split_html"
+
+En modo --compare sale con código 1 si algún caso es más lento que la baseline
+por encima del umbral (se compara el mínimo por operación, lo menos ruidoso).
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main as m  # noqa: E402
+from telegram import MessageEntity  # noqa: E402
+
+WORDS_ES = (
+    "compra venta señal objetivo stop beneficio gestión riesgo mercado tendencia soporte resistencia "
+    "análisis sesión apalancamiento operación cuenta estrategia ruptura volumen precio entrada salida "
+    "hoy mañana semana equipo comunidad paciencia disciplina resultado"
+).split()
+EMOJIS = "🚀📈📉💰🔥✅❌⚠️💎🙏❤️👉📊🕐🎯"
+
+
+def _u16(s: str) -> int:
+    return len(s.encode("utf-16-le")) // 2
+
+
+class Doc:
+    """Acumula texto + entities con offsets UTF-16, como los manda Telegram."""
+
+    def __init__(self):
+        self.parts: List[str] = []
+        self.entities: List[MessageEntity] = []
+        self._pos = 0
+
+    def add(self, s: str, etype: str = "", url: str = ""):
+        if etype:
+            kw = {"url": url} if etype == MessageEntity.TEXT_LINK else {}
+            self.entities.append(MessageEntity(etype, self._pos, _u16(s), **kw))
+        self.parts.append(s)
+        self._pos += _u16(s)
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+
+def _sentence(rnd: random.Random, n: int) -> str:
+    return " ".join(rnd.choice(WORDS_ES) for _ in range(n)).capitalize()
+
+
+def signal_post(rnd: random.Random, paragraphs: int = 12) -> Doc:
+    d = Doc()
+    for p in range(paragraphs):
+        d.add(f"📌 Señal {p + 1}", MessageEntity.BOLD)
+        d.add(": ")
+        d.add(_sentence(rnd, 12), MessageEntity.ITALIC if p % 3 == 0 else "")
+        d.add(". Entrada ")
+        d.add(f"{rnd.randint(60000, 70000)}", MessageEntity.CODE)
+        d.add(", objetivo ")
+        d.add(f"{rnd.randint(60000, 70000)}", MessageEntity.BOLD)
+        d.add(". Más info ")
+        d.add("aquí", MessageEntity.TEXT_LINK, url=f"https://example.com/post/{p}?ref=tg&utm=bench")
+        d.add(" o en ")
+        url = f"https://t.me/c/1946870620/{rnd.randint(1, 99999)}"
+        d.add(url, MessageEntity.URL)
+        d.add(" " + rnd.choice(EMOJIS) + "\n\n")
+    return d
+
+
+def emoji_caption(rnd: random.Random, length: int = 900) -> Doc:
+    d = Doc()
+    while _u16(d.text) < length:
+        w = rnd.choice(WORDS_ES)
+        e = rnd.choice(EMOJIS)
+        # Emojis pegados a palabras, lo que preprocess separa
+        d.add(w + e if rnd.random() < 0.5 else e + w, MessageEntity.BOLD if rnd.random() < 0.1 else "")
+        d.add(" ")
+    return d
+
+
+def url_dense(rnd: random.Random, urls: int = 80) -> str:
+    out = []
+    for i in range(urls):
+        out.append(f"{_sentence(rnd, 4)} https://example.com/a/{i}/{rnd.randint(0, 10**9)}?x={i}")
+    return "\n".join(out)
+
+
+def big_html(rnd: random.Random, target: int = 20_000) -> str:
+    chunks = []
+    total = 0
+    while total < target:
+        d = signal_post(rnd, paragraphs=4)
+        h = m.render_html(d.text, d.entities)
+        chunks.append(h)
+        total += len(h)
+    return "".join(chunks)[:target]
+
+
+def build_cases(seed: int) -> List[Tuple[str, Callable[[], Any]]]:
+    rnd = random.Random(seed)
+    sig = signal_post(rnd)
+    emo = emoji_caption(rnd)
+    urls = url_dense(rnd)
+    html20k = big_html(rnd)
+    sig_rt = m.RichText.from_entities(sig.text, sig.entities)
+    emo_rt = m.RichText.from_entities(emo.text, emo.entities)
+    urls_pre, urls_ph = m.preprocess_for_translation(urls)
+    sig_pre, sig_ph = m.preprocess_for_translation(sig.text)
+    english = "Buy signal for BTC with a tight stop, take profit at the next resistance and manage your account risk."
+    prefix = m.prefix_block("Johaale Trader")
+    emo_html = emo_rt.to_html()
+
+    return [
+        ("rich_text.from_entities/signal_long", lambda: m.RichText.from_entities(sig.text, sig.entities)),
+        ("rich_text.from_entities/emoji_caption", lambda: m.RichText.from_entities(emo.text, emo.entities)),
+        ("rich_text.to_html/signal_long", sig_rt.to_html),
+        ("rich_text.to_html/emoji_caption", emo_rt.to_html),
+        ("rich_text.to_entities/signal_long", sig_rt.to_entities),
+        ("render_html/signal_long", lambda: m.render_html(sig.text, sig.entities)),
+        ("split_html_safe/html_20k@3900", lambda: m.split_html_safe(html20k, 3900)),
+        ("split_html_safe/html_20k@1024", lambda: m.split_html_safe(html20k, 1024)),
+        ("preprocess_for_translation/signal_long", lambda: m.preprocess_for_translation(sig.text)),
+        ("preprocess_for_translation/emoji_caption", lambda: m.preprocess_for_translation(emo.text)),
+        ("preprocess_for_translation/url_dense", lambda: m.preprocess_for_translation(urls)),
+        ("postprocess_translation/signal_long", lambda: m.postprocess_translation(sig_pre, sig_ph)),
+        ("postprocess_translation/url_dense", lambda: m.postprocess_translation(urls_pre, urls_ph)),
+        ("probably_english/signal_long", lambda: m.probably_english(sig.text)),
+        ("probably_english/emoji_caption", lambda: m.probably_english(emo.text)),
+        ("probably_english/english_short", lambda: m.probably_english(english)),
+        ("cap_with_prefix/emoji_caption", lambda: m.cap_with_prefix(prefix, emo_html, max_len=1024)),
+        ("cap_with_prefix/html_20k", lambda: m.cap_with_prefix(prefix, html20k, max_len=1024)),
+    ]
+
+
+def measure(fn: Callable[[], Any], *, repeat: int, min_time: float) -> Dict[str, float]:
+    # Calibrar: bucles suficientes para que cada repetición dure ~min_time
+    loops = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        dt = time.perf_counter() - t0
+        if dt >= min_time or loops >= 1 << 24:
+            break
+        loops *= 2 if dt <= 0 else max(2, min(10, int(min_time / dt) + 1))
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        samples.append((time.perf_counter() - t0) / loops * 1e6)
+    return {
+        "loops": loops,
+        "min_us": round(min(samples), 3),
+        "median_us": round(statistics.median(samples), 3),
+        "stdev_us": round(statistics.pstdev(samples), 3),
+    }
+
+
+def run(args) -> Dict[str, Any]:
+    results: Dict[str, Dict[str, float]] = {}
+    for name, fn in build_cases(args.seed):
+        if args.k and args.k not in name:
+            continue
+        results[name] = measure(fn, repeat=args.repeat, min_time=args.min_time)
+        r = results[name]
+        print(f"{name:<46} {r['min_us']:>12.2f} µs  (mediana {r['median_us']:.2f}, {r['loops']} bucles)")
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "seed": args.seed,
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> int:
+    base = baseline.get("results", {})
+    regressions = 0
+    print(f"\n{'caso':<46} {'base µs':>12} {'ahora µs':>12} {'ratio':>8}")
+    for name, r in current["results"].items():
+        b = base.get(name)
+        if not b:
+            print(f"{name:<46} {'-':>12} {r['min_us']:>12.2f} {'nuevo':>8}")
+            continue
+        ratio = r["min_us"] / b["min_us"] if b["min_us"] else float("inf")
+        flag = ""
+        if ratio > 1.0 + threshold:
+            flag = "  REGRESIÓN"
+            regressions += 1
+        elif ratio < 1.0 - threshold:
+            flag = "  mejora"
+        print(f"{name:<46} {b['min_us']:>12.2f} {r['min_us']:>12.2f} {ratio:>8.2f}{flag}")
+    if baseline.get("meta", {}).get("python") != current["meta"]["python"]:
+        print(f"(aviso: baseline con Python {baseline.get('meta', {}).get('python')}, ahora {current['meta']['python']})")
+    print(f"\n{regressions} regresiones por encima de +{threshold:.0%}")
+    return 1 if regressions else 0
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Microbenchmarks de texto/HTML del replicador")
+    ap.add_argument("--save", help="guardar resultados como baseline JSON")
+    ap.add_argument("--compare", help="comparar contra esta baseline JSON")
+    ap.add_argument("--threshold", type=float, default=0.15, help="regresión tolerada (0.15 = +15%%)")
+    ap.add_argument("--repeat", type=int, default=7)
+    ap.add_argument("--min-time", type=float, default=0.1, help="segundos por repetición")
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("-k", help="solo casos cuyo nombre contenga este texto")
+    args = ap.parse_args()
+
+    current = run(args)
+    if args.save:
+        Path(args.save).write_text(json.dumps(current, indent=2, ensure_ascii=False))
+        print(f"baseline guardada en {args.save}")
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        sys.exit(compare(current, baseline, args.threshold))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Prueba diferencial de las reglas de traducción (DEFAULT_TRANSLATION_RULES)
+contra la implementación anterior, paso a paso con re.sub, copiada abajo tal cual.
+
+Genera textos aleatorios (deterministas con --seed) a base de piezas que tocan
+todas las reglas: invisibles (ZWSP/BOM), emojis pegados a palabras, typos,
+"Importante:", artefactos \\1 \\2, conectores ES->EN, URLs, tabs, espacios y
+saltos de línea repetidos. Compara preprocess_for_translation y
+postprocess_translation (texto y placeholders) con la referencia y sale con
+código 1 si alguna salida difiere.
+
+Diferencias intencionadas, que el generador evita a propósito:
+  - Las URLs se protegen antes que el resto: los typos o emojis dentro de una URL
+    ya no se tocan (el generador siempre pone un espacio o el final tras la URL).
+  - "Importante:" solo se reescribe dentro de su línea; la versión anterior
+    ("^\\s*Importante") se comía los saltos de línea previos. La referencia usa
+    ya la versión por línea.
+
+Uso:
+    python bench/rules.py                        # 20000 textos
+    python bench/rules.py --n 100000 --seed 3 --show 10
+"""
+import argparse
+import random
+import re
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main as m  # noqa: E402
+
+# ---- referencia: pipeline anterior a las reglas configurables ----
+_URL_RE = re.compile(r"https?://\S+")
+_EMOJI_JOIN_RE = re.compile(r"([\wÁÉÍÓÚÑáéíóúñ])([\U0001F300-\U0001FAFF☀-➿])", re.UNICODE)
+_EMOJI_JOIN_RE2 = re.compile(r"([\U0001F300-\U0001FAFF☀-➿])([\wÁÉÍÓÚÑáéíóúñ])", re.UNICODE)
+_TYPO_FIXES = [
+    (re.compile(r"\bGhank\b", re.I), "Thank"),
+    (re.compile(r"\bforsatechnical\b", re.I), "technical"),
+    (re.compile(r"\bforsatechnical\s+analysis\b", re.I), "technical analysis"),
+]
+
+
+def _protect_urls(text: str) -> Tuple[str, Dict[str, str]]:
+    urls = _URL_RE.findall(text or "")
+    placeholders = {}
+    for i, url in enumerate(urls):
+        ph = f"__URL{i}__"
+        text = text.replace(url, ph)
+        placeholders[ph] = url
+    return text, placeholders
+
+
+def _restore_urls(text: str, placeholders: Dict[str, str]) -> str:
+    for ph, url in (placeholders or {}).items():
+        text = text.replace(ph, url)
+    return text
+
+
+def old_preprocess(text: str) -> Tuple[str, Dict[str, str]]:
+    if not text:
+        return text, {}
+    t = text
+    t = re.sub(r"[​-‍﻿]", "", t)
+    t = _EMOJI_JOIN_RE.sub(r"\1 \2", t)
+    t = _EMOJI_JOIN_RE2.sub(r"\1 \2", t)
+    for rx, rep in _TYPO_FIXES:
+        t = rx.sub(rep, t)
+    t, placeholders = _protect_urls(t)
+    t = re.sub(r"[ \t]+", " ", t)
+    t = re.sub(r"\n\s*\n\s*\n+", "\n\n", t).strip()
+    # Antes vivía en deepl_translate, justo después del preproceso (solo TARGET_LANG=EN)
+    if m.TARGET_LANG.upper() == "EN":
+        t = re.sub(r"^[ \t]*Importante[ \t]*:", "Important:", t, flags=re.I | re.M)
+    return t, placeholders
+
+
+def old_postprocess(text: str, placeholders: Dict[str, str]) -> str:
+    if not text:
+        return text
+    t = text
+    t = _restore_urls(t, placeholders)
+    t = t.replace("\\1", "").replace("\\2", "")
+    t = re.sub(r"\bconnect to live\b", "go live", t, flags=re.I)
+    t = re.sub(r"\bcontinue growing together on this path\b", "keep growing together on this journey", t, flags=re.I)
+    t = re.sub(r"\bMattersnte\s*:", "Important:", t, flags=re.I)
+    t = re.sub(r"\bpara\s+that\b", "so that", t, flags=re.I)
+    t = re.sub(r"\bpor\s+(the|your|my|our|this|that|all|a|an)\b", r"for \1", t, flags=re.I)
+    t = re.sub(r"\bpor\s+patience\b", "for your patience", t, flags=re.I)
+    t = re.sub(r"[ \t]+", " ", t).strip()
+    return t
+
+
+# ---- generador ----
+WORDS = (
+    "hola compra señal análisis the your live technical analysis Gracias por para that "
+    "trade setup Ghank GHANK forsatechnical Importante importante Mattersnte connect to "
+    "continue growing together on this path patience a an all"
+).split()
+EMOJIS = ["📈", "❤", "☀", "🚀", "✅"]
+JUNK = ["​", "‌", "‍", "﻿"]
+SPACES = [" ", " ", " ", "  ", "\t", " \t ", "\n", "\n\n", "\n \n\n", "\n\n\n\n"]
+PUNCT = [":", " :", ".", ",", "!", "\\1", "\\2"]
+
+
+def make_text(rnd: random.Random, url_ids: List[int]) -> str:
+    out: List[str] = []
+    for _ in range(rnd.randint(1, 30)):
+        r = rnd.random()
+        if r < 0.40:
+            out.append(rnd.choice(WORDS))
+        elif r < 0.55:
+            out.append(rnd.choice(SPACES))
+        elif r < 0.68:
+            out.append(rnd.choice(EMOJIS))
+        elif r < 0.78:
+            out.append(rnd.choice(JUNK))
+        elif r < 0.92:
+            out.append(rnd.choice(PUNCT))
+        else:
+            # URL única (ancho fijo: ninguna es prefijo de otra) y seguida de espacio
+            url_ids[0] += 1
+            out.append(f"https://ex.com/p{url_ids[0]:06d}?q=1 ")
+    return "".join(out)
+
+
+def make_translated(rnd: random.Random, n_urls: int) -> str:
+    out: List[str] = []
+    for _ in range(rnd.randint(1, 30)):
+        r = rnd.random()
+        if r < 0.50:
+            out.append(rnd.choice(WORDS))
+        elif r < 0.70:
+            out.append(rnd.choice(SPACES))
+        elif r < 0.85:
+            out.append(rnd.choice(PUNCT))
+        elif r < 0.92:
+            out.append(rnd.choice(EMOJIS + JUNK))
+        elif n_urls:
+            out.append(f"__URL{rnd.randrange(n_urls)}__")
+    return "".join(out)
+
+
+def run(n: int, seed: int, show: int) -> int:
+    rnd = random.Random(seed)
+    url_ids = [0]
+    bad: List[Tuple[str, str, object, object]] = []
+    for _ in range(n):
+        text = make_text(rnd, url_ids)
+        exp = old_preprocess(text)
+        got = m.preprocess_for_translation(text)
+        if got != exp:
+            bad.append(("pre", text, exp, got))
+        urls = {f"__URL{i}__": f"https://ex.com/t{i:06d}" for i in range(rnd.randint(0, 3))}
+        out = make_translated(rnd, len(urls))
+        exp_p = old_postprocess(out, urls)
+        got_p = m.postprocess_translation(out, urls)
+        if got_p != exp_p:
+            bad.append(("post", out, exp_p, got_p))
+    print(f"textos: {n} (pre + post)  diferencias: {len(bad)}")
+    for phase, text, exp, got in bad[:show]:
+        print(f"  [{phase}] entrada={text!r}\n         esperado={exp!r}\n         obtenido={got!r}")
+    return 1 if bad else 0
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Diferencial de las reglas de traducción contra la versión anterior")
+    ap.add_argument("--n", type=int, default=20000)
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--show", type=int, default=5, help="cuántas diferencias imprimir")
+    args = ap.parse_args()
+    sys.exit(run(args.n, args.seed, args.show))
+
+
+if __name__ == "__main__":
+    main()
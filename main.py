@@ -2,13 +2,31 @@ import os
 import html
 import logging
 import re
+import signal
 import asyncio
+import bisect
+import contextvars
+import functools
+import hashlib
+import hmac
 import io
+import json
+import queue
 import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict, deque
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Tuple, List, Dict, Any, Callable, Awaitable
+from typing import Optional, Tuple, List, Dict, Any, Callable, Awaitable, Deque, BinaryIO
 
 import aiohttp
+from aiohttp import web
 from telegram import (
     Update,
     InlineKeyboardMarkup,
@@ -26,6 +44,8 @@ from telegram.error import TimedOut, NetworkError, RetryAfter, BadRequest, Forbi
 from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     ContextTypes,
     MessageHandler,
     CommandHandler,
@@ -35,11 +55,23 @@ from telegram.ext import (
 # ================== CONFIG BÁSICA ==================
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 
+# Bot API propio (telegram-bot-api): p.ej. TG_API_BASE_URL=http://bot-api:8081/bot
+# y TG_API_BASE_FILE_URL=http://bot-api:8081/file/bot. Con el servidor en --local,
+# TG_LOCAL_MODE=true: getFile devuelve una ruta de su disco y el audio se lee de ahí
+# (mismo volumen montado; TG_LOCAL_PATH_MAP="/var/lib/telegram-bot-api:/data/tg" si
+# la ruta difiere en este contenedor). Sin límite de 20 MB en descargas.
+TG_API_BASE_URL = os.getenv("TG_API_BASE_URL", "").strip().rstrip("/")
+TG_API_BASE_FILE_URL = os.getenv("TG_API_BASE_FILE_URL", "").strip().rstrip("/")
+TG_LOCAL_MODE = os.getenv("TG_LOCAL_MODE", "false").lower() == "true"
+TG_LOCAL_PATH_MAP = os.getenv("TG_LOCAL_PATH_MAP", "").strip()
+
 # Traducción (global por defecto)
 TRANSLATE = os.getenv("TRANSLATE", "true").lower() == "true"
 TRANSLATOR = "deepl"
 DEEPL_API_KEY = os.getenv("DEEPL_API_KEY", "").strip()
 DEEPL_API_HOST = os.getenv("DEEPL_API_HOST", "api-free.deepl.com").strip()
+# Base completa (esquema incluido); útil para apuntar a un servidor local (bench/)
+DEEPL_API_URL = (os.getenv("DEEPL_API_URL", "").strip() or f"https://{DEEPL_API_HOST}").rstrip("/")
 
 SOURCE_LANG = os.getenv("SOURCE_LANG", "ES").upper()
 TARGET_LANG = os.getenv("TARGET_LANG", "EN").upper()
@@ -69,6 +101,355 @@ ADMIN_ID = int(os.getenv("ADMIN_ID", "5958154558") or "0")
 logging.basicConfig(format="%(asctime)s | %(levelname)s | %(name)s | %(message)s", level=logging.INFO)
 log = logging.getLogger("replicator")
 
+# ================== HTTP: SESIONES COMPARTIDAS (DeepL / OpenAI / ficheros de Telegram) ==================
+# Un ClientSession por proveedor, con keep-alive + caché DNS, creado al arrancar
+# la app y cerrado en el shutdown. Evita un handshake TCP+TLS por cada traducción.
+HTTP_POOL_LIMIT = int(os.getenv("HTTP_POOL_LIMIT", "100") or "100")
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", "10") or "10")
+HTTP_DNS_TTL_SEC = int(os.getenv("HTTP_DNS_TTL_SEC", "300") or "300")
+HTTP_KEEPALIVE_SEC = float(os.getenv("HTTP_KEEPALIVE_SEC", "30") or "30")
+DEEPL_TIMEOUT_SEC = float(os.getenv("DEEPL_TIMEOUT_SEC", "45") or "45")
+DEEPL_POOL_LIMIT = int(os.getenv("DEEPL_POOL_LIMIT", str(HTTP_POOL_LIMIT_PER_HOST)) or "10")
+OPENAI_POOL_LIMIT = int(os.getenv("OPENAI_POOL_LIMIT", str(HTTP_POOL_LIMIT_PER_HOST)) or "10")
+TG_FILE_TIMEOUT_SEC = float(os.getenv("TG_FILE_TIMEOUT_SEC", "120") or "120")
+
+
+class HttpClients:
+    """
+    Registro de sesiones aiohttp por proveedor ("deepl", "openai", "tg_files").
+    Las sesiones se crean perezosamente dentro del event loop y se reutilizan.
+    """
+
+    def __init__(self, providers: Dict[str, Dict[str, float]]):
+        self._providers = providers
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+
+    def session(self, provider: str) -> aiohttp.ClientSession:
+        s = self._sessions.get(provider)
+        if s is not None and not s.closed:
+            return s
+        cfg = self._providers[provider]
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=int(cfg.get("limit_per_host", HTTP_POOL_LIMIT_PER_HOST)),
+            ttl_dns_cache=HTTP_DNS_TTL_SEC,
+            use_dns_cache=True,
+            keepalive_timeout=HTTP_KEEPALIVE_SEC,
+        )
+        s = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=float(cfg.get("timeout", 60))),
+        )
+        self._sessions[provider] = s
+        return s
+
+    async def start(self):
+        for name in self._providers:
+            self.session(name)
+
+    async def close(self):
+        sessions = list(self._sessions.values())
+        self._sessions.clear()
+        for s in sessions:
+            try:
+                await s.close()
+            except Exception as e:
+                log.warning("HTTP session close failed: %s", e)
+
+
+HTTP = HttpClients({
+    "deepl": {"timeout": DEEPL_TIMEOUT_SEC, "limit_per_host": DEEPL_POOL_LIMIT},
+    "openai": {"timeout": OPENAI_TIMEOUT_SEC, "limit_per_host": OPENAI_POOL_LIMIT},
+    "tg_files": {"timeout": TG_FILE_TIMEOUT_SEC, "limit_per_host": HTTP_POOL_LIMIT_PER_HOST},
+})
+
+
+def deepl_session() -> aiohttp.ClientSession:
+    return HTTP.session("deepl")
+
+
+def openai_session() -> aiohttp.ClientSession:
+    return HTTP.session("openai")
+
+
+def tg_files_session() -> aiohttp.ClientSession:
+    return HTTP.session("tg_files")
+
+
+# ================== MÉTRICAS (formato Prometheus, sin dependencias) ==================
+# Histogramas por etapa etiquetados por ruta y tipo de mensaje + contadores de
+# reintentos, RetryAfter y fallos; cachés y colas como gauges (ver register_runtime_metrics).
+# Se sirven en /metrics (METRICS_PORT, y también en el servidor del webhook).
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0") or "0")  # 0 = desactivado
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1").strip()
+_STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_value(v: Any) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple[Any, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_label_value(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Counter:
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...]):
+        self.name, self.help, self.labelnames = name, help_text, labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: Any):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, v in self._values.items():
+            out.append(f"{self.name}{_fmt_labels(self.labelnames, key)} {v:g}")
+        return out
+
+
+class _Histogram:
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...], buckets: Tuple[float, ...]):
+        self.name, self.help, self.labelnames, self.buckets = name, help_text, labelnames, buckets
+        self._values: Dict[Tuple[str, ...], List[float]] = {}  # [bucket counts..., +Inf, sum]
+
+    def observe(self, value: float, **labels: Any):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        row = self._values.get(key)
+        if row is None:
+            row = self._values[key] = [0.0] * (len(self.buckets) + 2)
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                row[i] += 1
+        row[-2] += 1
+        row[-1] += value
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, row in self._values.items():
+            for i, b in enumerate(self.buckets):
+                le = 'le="%g"' % b
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, le)} {row[i]:g}")
+            le_inf = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, le_inf)} {row[-2]:g}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {row[-1]:.6f}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {row[-2]:g}")
+        return out
+
+
+class _GaugeFn:
+    """Gauge calculado al vuelo: fn() -> {(label values...): valor}."""
+
+    mtype = "gauge"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...], fn: Callable[[], Dict[Tuple[Any, ...], float]]):
+        self.name, self.help, self.labelnames, self.fn = name, help_text, labelnames, fn
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.mtype}"]
+        try:
+            for key, v in self.fn().items():
+                out.append(f"{self.name}{_fmt_labels(self.labelnames, tuple(key))} {float(v):g}")
+        except Exception as e:
+            log.warning("metrics gauge %s failed: %s", self.name, e)
+        return out
+
+
+class _CounterFn(_GaugeFn):
+    """Igual que _GaugeFn, para totales acumulados que ya lleva otro objeto."""
+
+    mtype = "counter"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[Any] = []
+
+    def counter(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()) -> _Counter:
+        m = _Counter(name, help_text, labelnames)
+        self._metrics.append(m)
+        return m
+
+    def histogram(self, name: str, help_text: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = _STAGE_BUCKETS) -> _Histogram:
+        m = _Histogram(name, help_text, labelnames, buckets)
+        self._metrics.append(m)
+        return m
+
+    def gauge_fn(self, name: str, help_text: str, labelnames: Tuple[str, ...],
+                 fn: Callable[[], Dict[Tuple[Any, ...], float]]) -> _GaugeFn:
+        m = _GaugeFn(name, help_text, labelnames, fn)
+        self._metrics.append(m)
+        return m
+
+    def counter_fn(self, name: str, help_text: str, labelnames: Tuple[str, ...],
+                   fn: Callable[[], Dict[Tuple[Any, ...], float]]) -> _CounterFn:
+        m = _CounterFn(name, help_text, labelnames, fn)
+        self._metrics.append(m)
+        return m
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in self._metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+STAGE_SECONDS = METRICS.histogram(
+    "replicator_stage_seconds", "Latencia por etapa del pipeline", ("stage", "route", "kind")
+)
+RETRIES = METRICS.counter("replicator_retries_total", "Reintentos de call_with_retry", ("label", "reason"))
+RETRY_AFTER_SECONDS = METRICS.counter(
+    "replicator_retry_after_seconds_total", "Segundos de RetryAfter pedidos por Telegram", ("label",)
+)
+FAILURES = METRICS.counter("replicator_failures_total", "Fallos por etapa", ("stage",))
+
+# (route, kind) del mensaje que se está replicando; lo heredan tareas hijas (álbum, etc.)
+_METRIC_LABELS: "contextvars.ContextVar[Tuple[str, str]]" = contextvars.ContextVar("metric_labels", default=("", ""))
+
+
+def metric_route(src_chat: Any, src_thread: Optional[int], dst_chat: Any, dst_thread: Optional[int]) -> str:
+    st = 1 if src_thread in (None, 0) else src_thread
+    return f"{src_chat}#{st}>{dst_chat}#{dst_thread if dst_thread is not None else 0}"
+
+
+def message_kind(msg: Message) -> str:
+    if getattr(msg, "voice", None) or getattr(msg, "audio", None):
+        return "audio"
+    if getattr(msg, "media_group_id", None):
+        return "album"
+    if msg.text:
+        return "text"
+    return "media"
+
+
+class stage_timer:
+    """`with stage_timer("etapa"):` observa la duración y cuenta fallos."""
+
+    __slots__ = ("stage", "kind", "t0")
+
+    def __init__(self, stage: str, kind: Optional[str] = None):
+        self.stage = stage
+        self.kind = kind
+        self.t0 = 0.0
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        route, kind = _METRIC_LABELS.get()
+        STAGE_SECONDS.observe(time.perf_counter() - self.t0, stage=self.stage, route=route, kind=self.kind or kind)
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            FAILURES.inc(stage=self.stage)
+        return False
+
+
+def timed_stage(stage: str, kind: Optional[str] = None):
+    """Decorador para corrutinas: mide cada llamada como `stage`."""
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            with stage_timer(stage, kind):
+                return await fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+# ================== LAG EXTREMO A EXTREMO (entregado − msg.date) ==================
+# Por ruta (src#tema>dst#tema): ventana deslizante de muestras con p50/p95/p99.
+# Si el percentil del SLO supera LAG_SLO_SEC se avisa con alert_error (con cooldown).
+LAG_WINDOW = int(os.getenv("LAG_WINDOW", "500") or "500")  # muestras por ruta
+LAG_WINDOW_SEC = float(os.getenv("LAG_WINDOW_SEC", "3600") or "3600")
+LAG_SLO_SEC = float(os.getenv("LAG_SLO_SEC", "60") or "0")  # 0 = sin alertas
+LAG_SLO_PERCENTILE = float(os.getenv("LAG_SLO_PERCENTILE", "95") or "95")
+LAG_SLO_MIN_SAMPLES = int(os.getenv("LAG_SLO_MIN_SAMPLES", "20") or "20")
+LAG_ALERT_COOLDOWN_SEC = float(os.getenv("LAG_ALERT_COOLDOWN_SEC", "900") or "900")
+
+
+def _percentile(sorted_vals: List[float], pct: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    i = max(0, min(len(sorted_vals) - 1, int(round(pct / 100.0 * len(sorted_vals) + 0.5)) - 1))
+    return sorted_vals[i]
+
+
+class LagTracker:
+    def __init__(self, window: int, window_sec: float):
+        self.window = max(1, window)
+        self.window_sec = window_sec
+        self._samples: Dict[str, Deque[Tuple[float, float]]] = {}  # ruta -> (t_entrega, lag)
+        self._last_alert: Dict[str, float] = {}
+
+    def record(self, route: str, lag: float, now: Optional[float] = None):
+        now = time.time() if now is None else now
+        dq = self._samples.get(route)
+        if dq is None:
+            dq = self._samples[route] = deque(maxlen=self.window)
+        dq.append((now, max(0.0, lag)))
+
+    def _values(self, route: str, now: float) -> List[float]:
+        dq = self._samples.get(route)
+        if not dq:
+            return []
+        cutoff = now - self.window_sec
+        while dq and dq[0][0] < cutoff:
+            dq.popleft()
+        return sorted(v for _, v in dq)
+
+    def percentiles(self, now: Optional[float] = None) -> Dict[str, Dict[str, float]]:
+        now = time.time() if now is None else now
+        out: Dict[str, Dict[str, float]] = {}
+        for route in list(self._samples):
+            vals = self._values(route, now)
+            if vals:
+                out[route] = {
+                    "n": len(vals),
+                    "p50": _percentile(vals, 50),
+                    "p95": _percentile(vals, 95),
+                    "p99": _percentile(vals, 99),
+                }
+        return out
+
+    def breach(self, route: str, slo_sec: float, pct: float, min_samples: int, cooldown: float,
+               now: Optional[float] = None) -> Optional[float]:
+        """Devuelve el percentil si la ruta incumple el SLO y no se avisó hace poco."""
+        now = time.time() if now is None else now
+        vals = self._values(route, now)
+        if len(vals) < min_samples:
+            return None
+        value = _percentile(vals, pct)
+        if value <= slo_sec or now - self._last_alert.get(route, 0.0) < cooldown:
+            return None
+        self._last_alert[route] = now
+        return value
+
+
+LAG = LagTracker(LAG_WINDOW, LAG_WINDOW_SEC)
+
+
+async def record_lag(context: ContextTypes.DEFAULT_TYPE, src_msg: Message, dst_chat: Any,
+                     dst_thread: Optional[int], *, edit: bool = False):
+    ts = (src_msg.edit_date or src_msg.date) if edit else src_msg.date
+    if ts is None:
+        return
+    now = time.time()
+    lag = now - ts.timestamp()
+    route = metric_route(src_msg.chat.id, src_msg.message_thread_id, dst_chat, dst_thread)
+    LAG.record(route, lag, now)
+    # Solo una muestra por encima del SLO puede empujar el percentil por encima
+    if LAG_SLO_SEC > 0 and lag > LAG_SLO_SEC:
+        value = LAG.breach(route, LAG_SLO_SEC, LAG_SLO_PERCENTILE, LAG_SLO_MIN_SAMPLES, LAG_ALERT_COOLDOWN_SEC, now)
+        if value is not None:
+            log.warning("[lag] %s p%g=%.1fs > SLO %.0fs", route, LAG_SLO_PERCENTILE, value, LAG_SLO_SEC)
+            await alert_error(context, f"Lag SLO: {route} p{LAG_SLO_PERCENTILE:g}={value:.1f}s > {LAG_SLO_SEC:g}s")
+
+
 # ================== CANAL → CANAL ==================
 CHANNEL_MAP: Dict[Any, Any] = {
     "@johaaletrader_es": "@johaaletrader_en",
@@ -161,27 +542,96 @@ def is_destination_topic(chat_id: int, thread_id: Optional[int]) -> bool:
 
 # ================== DEDUP: evita procesar el mismo msg varias veces ==================
 DEDUP_TTL_SECONDS = float(os.getenv("DEDUP_TTL_SECONDS", "120") or "120")
-_seen_msgs: Dict[Tuple[int, int], float] = {}
+DEDUP_MAX_KEYS = int(os.getenv("DEDUP_MAX_KEYS", "50000") or "50000")
+# Opcional: guardar claves recientes en SQLite para no re-replicar tras un reinicio
+DEDUP_PERSIST = os.getenv("DEDUP_PERSIST", "false").lower() == "true"
+
 
-def seen_recent(chat_id: int, message_id: int) -> bool:
-    now = asyncio.get_event_loop().time()
-    key = (int(chat_id), int(message_id))
+class DedupWindow:
+    """
+    Ventana de expiración ordenada: como el TTL es fijo, el orden de inserción es
+    el orden de expiración. Insertar/consultar/expirar es O(1) amortizado (se
+    recorta solo por el frente) y DEDUP_MAX_KEYS pone un techo duro de memoria.
+    """
 
-    # limpieza ocasional
-    if len(_seen_msgs) > 2000:
-        cutoff = now - DEDUP_TTL_SECONDS
-        for k in list(_seen_msgs.keys()):
-            if _seen_msgs.get(k, 0) < cutoff:
-                _seen_msgs.pop(k, None)
+    def __init__(self, ttl_sec: float, max_keys: int):
+        self.ttl_sec = ttl_sec
+        self.max_keys = max(1, max_keys)
+        self._seen: "OrderedDict[Tuple[int, ...], float]" = OrderedDict()
 
-    t = _seen_msgs.get(key)
-    if t and (now - t) < DEDUP_TTL_SECONDS:
-        return True
+    def _expire(self, now: float):
+        cutoff = now - self.ttl_sec
+        while self._seen:
+            _, t = next(iter(self._seen.items()))
+            if t >= cutoff:
+                break
+            self._seen.popitem(last=False)
+
+    def add(self, key: Tuple[int, ...], seen_at: float):
+        self._seen[key] = seen_at
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.max_keys:
+            self._seen.popitem(last=False)
+
+    def check_and_add(self, key: Tuple[int, ...], now: float) -> bool:
+        self._expire(now)
+        if key in self._seen:
+            return True
+        self.add(key, now)
+        return False
+
+    def __len__(self) -> int:
+        return len(self._seen)
 
-    _seen_msgs[key] = now
+
+_seen_msgs = DedupWindow(DEDUP_TTL_SECONDS, DEDUP_MAX_KEYS)
+_dedup_writes = 0
+
+
+def _dedup_key_str(key: Tuple[int, ...]) -> str:
+    return ":".join(str(k) for k in key)
+
+
+def seen_recent(chat_id: int, message_id: int, edit_date: Any = None) -> bool:
+    """
+    Posts: clave (chat, msg). Ediciones: (chat, msg, edit_date), para que una
+    edición no choque con la clave del post original ni con otra edición.
+    """
+    now = time.time()
+    key: Tuple[int, ...] = (int(chat_id), int(message_id))
+    if edit_date is not None:
+        ts = edit_date.timestamp() if hasattr(edit_date, "timestamp") else edit_date
+        key = key + (int(ts),)
+
+    if _seen_msgs.check_and_add(key, now):
+        return True
+    if DEDUP_PERSIST:
+        global _dedup_writes
+        db_execute_later(
+            "INSERT OR REPLACE INTO dedup_seen (key, seen_at) VALUES (?, ?)",
+            (_dedup_key_str(key), now),
+        )
+        _dedup_writes += 1
+        if _dedup_writes % 1000 == 0:
+            db_execute_later("DELETE FROM dedup_seen WHERE seen_at<?", (now - DEDUP_TTL_SECONDS,))
     return False
 
 
+def dedup_load(conn: sqlite3.Connection):
+    """Recarga las claves aún vigentes (tras un reinicio) y limpia las viejas."""
+    cutoff = time.time() - DEDUP_TTL_SECONDS
+    conn.execute("DELETE FROM dedup_seen WHERE seen_at<?", (cutoff,))
+    conn.commit()
+    rows = conn.execute("SELECT key, seen_at FROM dedup_seen ORDER BY seen_at").fetchall()
+    for key_s, seen_at in rows:
+        try:
+            _seen_msgs.add(tuple(int(x) for x in key_s.split(":")), float(seen_at))
+        except ValueError:
+            continue
+    if rows:
+        log.info("Dedup: %s claves recientes recargadas", len(rows))
+
+
 # ================== HEURÍSTICA DE IDIOMA ==================
 _EN_COMMON = re.compile(
     r"\b(the|and|for|with|from|to|of|in|on|is|are|you|we|they|buy|sell|trade|signal|profit|setup|account)\b",
@@ -190,71 +640,276 @@ _EN_COMMON = re.compile(
 # ================== TRANSLATION QUALITY PATCH (SAFE) ==================
 # Solo mejora la calidad del texto enviado a DeepL y el texto traducido.
 # No cambia rutas, fanouts, ni lógica de replicación.
+#
+# Reglas configurables (JSON en TRANSLATION_RULES_FILE; si no, DEFAULT_TRANSLATION_RULES).
+# Cada fase ("pre" = antes de DeepL, "post" = después) compila las reglas seguidas en
+# UNA regex con una alternativa por regla y las aplica en una sola pasada (gana la
+# regla que empiece antes; a igual posición, la primera de la lista). Las reglas con
+# "separate": true (borrados, normalizar espacios: dependen del texto que dejan las
+# vecinas) van en su propia pasada, en el orden de la lista. Tipos de regla:
+#   {"literal": {"buscar": "reemplazo", ...}, "word": true, "ignore_case": true}
+#   {"regex": "...", "replace": "... \\1 ..."}      (grupos numerados, no con nombre)
+#   {"protect": "regex", "placeholder": "URL"}     -> __URL0__, __URL1__, ... (solo "pre")
+#   {"restore": "URL"}                             -> repone los placeholders (solo "post")
+#   {"insert": " ", "after": "[clase]", "before": "[clase]"}  -> inserta entre ambos
+# Las reglas "insert" no consumen texto: van en una segunda pasada propia (sobre el
+# resultado de la primera), porque mezcladas con el resto anulan el prefiltro de re.
+# Opcional en cualquier regla: "target_lang": "EN" (solo se aplica con ese TARGET_LANG).
+# Opcional en "regex"/"protect": "first": "abc", los caracteres por los que puede empezar
+# un match (sin distinguir mayúsculas). Si todas las reglas de una pasada lo tienen (los
+# "literal" y "restore" lo sacan de su propio texto), la pasada solo prueba en esas
+# posiciones: varias alternativas anulan el escaneo rápido de re. Un "first" incompleto
+# hace que la regla no se aplique donde el match empiece por otro carácter.
+# El fichero se relee solo si cambia (mtime), como mucho cada TRANSLATION_RULES_RELOAD_SEC.
+TRANSLATION_RULES_FILE = os.getenv("TRANSLATION_RULES_FILE", "").strip()
+TRANSLATION_RULES_RELOAD_SEC = float(os.getenv("TRANSLATION_RULES_RELOAD_SEC", "5") or "5")
+
+_WORD_CHARS = "\\wÁÉÍÓÚÑáéíóúñ"
+_EMOJI_CHARS = "\\U0001F300-\\U0001FAFF\\u2600-\\u27BF"
+
+DEFAULT_TRANSLATION_RULES: Dict[str, List[Dict[str, Any]]] = {
+    "pre": [
+        # Quitar invisibles típicos (antes que nada: "\u200bImportante:" también es un encabezado)
+        {"regex": "[\\u200B-\\u200D\\uFEFF]+", "replace": "", "separate": True},
+        # Proteger URLs (antes que el resto: lo que hay dentro de una URL no se toca)
+        {"protect": "https?://\\S+", "placeholder": "URL", "first": "h"},
+        # Separar emojis pegados a palabras (evita cosas tipo "Gracias❤️por" o "live📈")
+        {"insert": " ", "after": f"[{_WORD_CHARS}]", "before": f"[{_EMOJI_CHARS}]"},
+        {"insert": " ", "after": f"[{_EMOJI_CHARS}]", "before": f"[{_WORD_CHARS}]"},
+        # Typos comunes vistos en tu contenido
+        {"literal": {"forsatechnical analysis": "technical analysis", "forsatechnical": "technical", "Ghank": "Thank"},
+         "word": True, "ignore_case": True},
+        # Ayuda a DeepL con encabezados típicos para evitar salidas raras
+        {"regex": "(?im:^[ \\t]*Importante[ \\t]*:)", "replace": "Important:", "target_lang": "EN",
+         "first": " \tI"},
+        # Normalizar espacios
+        {"regex": "[ \\t]{2,}|\\t", "replace": " ", "separate": True},
+        {"regex": "\\n\\s*\\n\\s*\\n+", "replace": "\\n\\n", "separate": True},
+    ],
+    "post": [
+        {"restore": "URL"},
+        # Limpiar artefactos tipo \1 \2 si aparecieran por accidente
+        {"literal": {"\\1": "", "\\2": ""}, "separate": True},
+        # Ajustes mínimos para inglés más natural (trading/community)
+        {"literal": {"connect to live": "go live",
+                     "continue growing together on this path": "keep growing together on this journey"},
+         "word": True, "ignore_case": True},
+        # Arreglos anti-mezcla ES->EN (conectores típicos que a veces quedan sin traducir)
+        {"regex": "(?i:\\bMattersnte\\s*:)", "replace": "Important:", "first": "m"},
+        {"regex": "(?i:\\bpara\\s+that\\b)", "replace": "so that", "first": "p"},
+        {"regex": "(?i:\\bpor\\s+patience\\b)", "replace": "for your patience", "first": "p"},
+        {"regex": "(?i:\\bpor\\s+(the|your|my|our|this|that|all|a|an)\\b)", "replace": "for \\1",
+         "first": "p"},
+        # Normalizar espacios
+        {"regex": "[ \\t]{2,}|\\t", "replace": " ", "separate": True},
+    ],
+}
+
+
+class _RulePass:
+    """Una pasada compilada: regex combinada + tabla de despacho por alternativa."""
+
+    __slots__ = ("rx", "handlers", "ins_rx", "ins_text", "ins_table", "template")
+
+    def __init__(self, rules: List[Tuple[int, Dict[str, Any]]]):
+        parts: List[str] = []
+        bodies: List[str] = []
+        firsts: List[str] = []  # primeros caracteres posibles por alternativa ("" = sin acotar)
+        ins_parts: List[str] = []
+        self.handlers: Dict[str, Tuple[str, Any]] = {}
+        self.ins_table: Dict[str, str] = {}
+        self.template: Optional[str] = None
+        for i, rule in rules:
+            name = f"r{i}"
+            if "insert" in rule:
+                body = f"(?<={rule.get('after') or ''})(?={rule.get('before') or ''})"
+                re.compile(body)
+                ins_parts.append(f"(?P<{name}>{body})")
+                self.ins_table[name] = str(rule["insert"])
+                continue
+            if "literal" in rule:
+                table = {str(k): str(v) for k, v in rule["literal"].items() if k}
+                if not table:
+                    continue
+                ic = bool(rule.get("ignore_case"))
+                alts = "|".join(re.escape(k) for k in sorted(table, key=len, reverse=True))
+                body = f"\\b(?:{alts})\\b" if rule.get("word") else f"(?:{alts})"
+                if ic:
+                    body = f"(?i:{body})"
+                    table = {k.lower(): v for k, v in table.items()}
+                self.handlers[name] = ("literal_ci" if ic else "literal", table)
+                first = "".join(k[0] for k in table)
+            elif "protect" in rule:
+                body = rule["protect"]
+                tag = str(rule.get("placeholder") or "PH").upper()
+                self.handlers[name] = ("protect", tag)
+                first = str(rule.get("first") or "")
+            elif "restore" in rule:
+                tag = str(rule["restore"]).upper()
+                body = f"__{re.escape(tag)}\\d+__"
+                self.handlers[name] = ("restore", tag)
+                first = "_"
+            elif "regex" in rule:
+                body = rule["regex"]
+                repl = str(rule.get("replace", ""))
+                # Con referencias a grupos se expande con la regex de la regla en la misma posición
+                own = re.compile(body) if "\\" in repl else None
+                self.handlers[name] = ("regex", (repl, own))
+                first = str(rule.get("first") or "")
+            else:
+                raise ValueError(f"regla sin tipo: {rule}")
+            re.compile(body)  # error claro con la regla culpable
+            parts.append(f"(?P<{name}>{body})")
+            bodies.append(body)
+            firsts.append(first)
+        self.rx = re.compile("|".join(parts)) if parts else None
+        if len(parts) > 1 and all(firsts):
+            chars = "".join(re.escape(c) for c in dict.fromkeys("".join(firsts)))
+            self.rx = re.compile(f"(?=(?i:[{chars}]))(?:{'|'.join(parts)})")
+        if len(parts) == 1 and not ins_parts:
+            kind, arg = next(iter(self.handlers.values()))
+            if kind == "regex":
+                # Regla sola: re.sub directo con su propia regex y plantilla (sin callback)
+                self.rx, self.template = re.compile(bodies[0]), arg[0]
+        self.ins_rx = re.compile("|".join(ins_parts)) if ins_parts else None
+        # Si todas las inserciones son el mismo texto, re.sub con plantilla fija (sin callback)
+        texts = set(self.ins_table.values())
+        only = next(iter(texts)) if len(texts) == 1 else None
+        self.ins_text = only if only is not None and "\\" not in only else None
+
+    def apply(self, text: str, ph: Dict[str, str]) -> str:
+        if self.template is not None:
+            return self.rx.sub(self.template, text)
+        if self.rx is not None:
+            text = self._sub(text, ph)
+        if self.ins_rx is not None:
+            if self.ins_text is not None:
+                text = self.ins_rx.sub(self.ins_text, text)
+            else:
+                table = self.ins_table
+                text = self.ins_rx.sub(lambda m: table[m.lastgroup], text)
+        return text
+
+    def _sub(self, text: str, ph: Dict[str, str]) -> str:
+        handlers = self.handlers
+        counters: Dict[str, int] = {}
+
+        def repl(m: "re.Match[str]") -> str:
+            kind, arg = handlers[m.lastgroup]
+            s = m.group(m.lastgroup)
+            if kind == "literal":
+                return arg.get(s, s)
+            if kind == "literal_ci":
+                return arg.get(s.lower(), s)
+            if kind == "protect":
+                n = counters.get(arg, 0)
+                counters[arg] = n + 1
+                key = f"__{arg}{n}__"
+                ph[key] = s
+                return key
+            if kind == "restore":
+                return ph.get(s, s)
+            template, own = arg
+            if own is None:
+                return template
+            mm = own.match(m.string, m.start())
+            return mm.expand(template) if mm else s
+
+        return self.rx.sub(repl, text)
+
+
+class _RulePhase:
+    """Una fase ("pre"/"post"): pasadas combinadas entre reglas "separate", en orden."""
+
+    __slots__ = ("passes",)
+
+    def __init__(self, rules: List[Dict[str, Any]], target_lang: str):
+        self.passes: List[_RulePass] = []
+        group: List[Tuple[int, Dict[str, Any]]] = []
+        for i, rule in enumerate(rules):
+            tl = rule.get("target_lang")
+            if tl and str(tl).upper() != target_lang:
+                continue
+            if not rule.get("separate"):
+                group.append((i, rule))
+                continue
+            if group:
+                self.passes.append(_RulePass(group))
+                group = []
+            self.passes.append(_RulePass([(i, rule)]))
+        if group:
+            self.passes.append(_RulePass(group))
+
+    def apply(self, text: str, placeholders: Optional[Dict[str, str]] = None) -> Tuple[str, Dict[str, str]]:
+        ph: Dict[str, str] = {} if placeholders is None else placeholders
+        if not text:
+            return text, ph
+        for p in self.passes:
+            text = p.apply(text, ph)
+        return text, ph
+
+
+class TranslationRules:
+    def __init__(self, path: str, reload_sec: float):
+        self.path = Path(path) if path else None
+        self.reload_sec = reload_sec
+        self._mtime: Optional[float] = None
+        self._checked = 0.0
+        self._compile(DEFAULT_TRANSLATION_RULES)
+        self._maybe_reload(force=True)
+
+    def _compile(self, spec: Dict[str, List[Dict[str, Any]]]):
+        target = (TARGET_LANG or "EN").upper()
+        pre = _RulePhase(spec.get("pre", []), target)
+        post = _RulePhase(spec.get("post", []), target)
+        self.pre, self.post = pre, post
+
+    def _maybe_reload(self, force: bool = False):
+        if self.path is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._checked < self.reload_sec:
+            return
+        self._checked = now
+        try:
+            mtime = self.path.stat().st_mtime
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        try:
+            spec = json.loads(self.path.read_text(encoding="utf-8"))
+            merged = dict(DEFAULT_TRANSLATION_RULES)
+            merged.update({k: v for k, v in spec.items() if k in ("pre", "post")})
+            self._compile(merged)
+            log.info("Reglas de traducción cargadas de %s", self.path)
+        except Exception as e:
+            # Una edición a medias no tumba el bot: seguimos con las reglas anteriores
+            log.warning("Reglas de traducción inválidas en %s: %s", self.path, e)
+
+    def preprocess(self, text: str) -> Tuple[str, Dict[str, str]]:
+        self._maybe_reload()
+        return self.pre.apply(text)
+
+    def postprocess(self, text: str, placeholders: Dict[str, str]) -> str:
+        self._maybe_reload()
+        return self.post.apply(text, dict(placeholders or {}))[0]
+
+
+TRANSLATION_RULES = TranslationRules(TRANSLATION_RULES_FILE, TRANSLATION_RULES_RELOAD_SEC)
 
-_URL_RE = re.compile(r"https?://\S+")
-# Separar emojis pegados a palabras (evita cosas tipo "Gracias❤️por" o "live📈")
-_EMOJI_JOIN_RE = re.compile(r"([\wÁÉÍÓÚÑáéíóúñ])([\U0001F300-\U0001FAFF\u2600-\u27BF])", re.UNICODE)
-_EMOJI_JOIN_RE2 = re.compile(r"([\U0001F300-\U0001FAFF\u2600-\u27BF])([\wÁÉÍÓÚÑáéíóúñ])", re.UNICODE)
-
-# Typos comunes vistos en tu contenido (solo para pruebas / limpieza)
-_TYPO_FIXES = [
-    (re.compile(r"\bGhank\b", re.I), "Thank"),
-    (re.compile(r"\bforsatechnical\b", re.I), "technical"),
-    (re.compile(r"\bforsatechnical\s+analysis\b", re.I), "technical analysis"),
-]
-
-def _protect_urls(text: str) -> tuple[str, dict]:
-    urls = _URL_RE.findall(text or "")
-    placeholders = {}
-    for i, url in enumerate(urls):
-        ph = f"__URL{i}__"
-        text = text.replace(url, ph)
-        placeholders[ph] = url
-    return text, placeholders
-
-def _restore_urls(text: str, placeholders: dict) -> str:
-    for ph, url in (placeholders or {}).items():
-        text = text.replace(ph, url)
-    return text
 
 def preprocess_for_translation(text: str) -> tuple[str, dict]:
     if not text:
         return text, {}
-    t = text
-    # Quitar invisibles típicos
-    t = re.sub(r"[\u200B-\u200D\uFEFF]", "", t)
-    # Separar emojis
-    t = _EMOJI_JOIN_RE.sub(r"\1 \2", t)
-    t = _EMOJI_JOIN_RE2.sub(r"\1 \2", t)
-    # Fix typos
-    for rx, rep in _TYPO_FIXES:
-        t = rx.sub(rep, t)
-    # Proteger URLs
-    t, placeholders = _protect_urls(t)
-    # Normalizar espacios
-    t = re.sub(r"[ \t]+", " ", t)
-    t = re.sub(r"\n\s*\n\s*\n+", "\n\n", t).strip()
-    return t, placeholders
+    t, placeholders = TRANSLATION_RULES.preprocess(text)
+    return t.strip(), placeholders
 
 def postprocess_translation(text: str, placeholders: dict) -> str:
     if not text:
         return text
-    t = text
-    # Reponer URLs
-    t = _restore_urls(t, placeholders)
-    # Limpiar artefactos tipo \1 \2 si aparecieran por accidente
-    t = t.replace("\\1", "").replace("\\2", "")
-    # Ajustes mínimos para inglés más natural (trading/community)
-    t = re.sub(r"\bconnect to live\b", "go live", t, flags=re.I)
-    t = re.sub(r"\bcontinue growing together on this path\b", "keep growing together on this journey", t, flags=re.I)
-    # Arreglos anti-mezcla ES->EN (conectores típicos que a veces quedan sin traducir)
-    t = re.sub(r"\bMattersnte\s*:", "Important:", t, flags=re.I)
-    t = re.sub(r"\bpara\s+that\b", "so that", t, flags=re.I)
-    t = re.sub(r"\bpor\s+(the|your|my|our|this|that|all|a|an)\b", r"for \1", t, flags=re.I)
-    t = re.sub(r"\bpor\s+patience\b", "for your patience", t, flags=re.I)
-    # Normalizar espacios
-    t = re.sub(r"[ \t]+", " ", t).strip()
-    return t
+    return TRANSLATION_RULES.postprocess(text, placeholders).strip()
 # ================== END TRANSLATION QUALITY PATCH ==================
 _ES_MARKERS = re.compile(r"[áéíóúñ¿¡]|\b(que|para|porque|hola|gracias|compra|venta|señal|apalancamiento|beneficios)\b", re.I)
 
@@ -272,86 +927,222 @@ def probably_english(text: str) -> bool:
 
 
 # ================== ENTIDADES HTML ==================
-SAFE_TAGS = {"b", "strong", "i", "em", "u", "s", "del", "code", "pre", "a"}
+# Texto enriquecido compacto: los offsets UTF-16 de Telegram se convierten UNA vez
+# a índices de str (solo los caracteres fuera del BMP, p. ej. emojis, desplazan),
+# las entities anidadas se respetan y el HTML sale en una sola pasada. El mismo
+# modelo vuelve a entities (offsets UTF-16) para mandar caption/texto sin parse_mode.
+CUSTOM_EMOJI = os.getenv("CUSTOM_EMOJI", "false").lower() == "true"  # solo bots con username de Fragment
+_ASTRAL_RE = re.compile("[\U00010000-\U0010FFFF]")
 
 
 def escape(t: str) -> str:
     return html.escape(t, quote=False)
 
 
-def entities_to_html(text: str, entities: List[MessageEntity]) -> List[Tuple[str, Dict[str, Any]]]:
-    """
-    Convierte entities de Telegram a fragments + metadata para reconstruir HTML.
-    Soporta PTB donde e.type puede ser string ("bold") o enum (MessageEntityType.BOLD).
-    """
-    if not entities:
-        return [(text, {})]
-
-    def _etype(e: MessageEntity) -> str:
-        t = getattr(e, "type", "")
-        # PTB: enum con .value; otros: string
-        if hasattr(t, "value"):
-            t = t.value
+def _u16len(s: str) -> int:
+    return len(s) if s.isascii() else len(s.encode("utf-16-le")) // 2
+
+
+def _u16_prefix(s: str, units: int) -> str:
+    """Prefijo más largo de s que ocupa <= units unidades UTF-16 (sin partir surrogates)."""
+    if s.isascii() or units <= 0:
+        return s[:max(0, units)]
+    n = 0
+    for i, ch in enumerate(s):
+        n += 2 if ord(ch) > 0xFFFF else 1
+        if n > units:
+            return s[:i]
+    return s
+
+
+_ETYPE_CACHE: Dict[Any, str] = {}
+
+
+def _entity_type(e: MessageEntity) -> str:
+    # PTB: enum con .value; otros: string (o "MessageEntityType.BOLD")
+    raw = getattr(e, "type", "")
+    t = _ETYPE_CACHE.get(raw)
+    if t is None:
+        t = raw.value if hasattr(raw, "value") else raw
         t = str(t).strip()
-        # Por si viene "MessageEntityType.BOLD"
         if t.startswith("MessageEntityType."):
             t = t.split(".", 1)[1]
-        return t.lower()
-
-    entities = sorted(entities, key=lambda e: e.offset)
-    res: List[Tuple[str, Dict[str, Any]]] = []
-    idx = 0
-    for e in entities:
-        if e.offset > idx:
-            res.append((text[idx:e.offset], {}))
-        frag = text[e.offset:e.offset + e.length]
-        meta: Dict[str, Any] = {}
-
-        t = _etype(e)
-        if t == "bold":
-            meta["tag"] = "b"
-        elif t == "italic":
-            meta["tag"] = "i"
-        elif t == "underline":
-            meta["tag"] = "u"
-        elif t == "strikethrough":
-            meta["tag"] = "s"
-        elif t == "code":
-            meta["tag"] = "code"
-        elif t in ("text_link", "textlink") and getattr(e, "url", None):
-            meta["tag"] = "a"
-            meta["href"] = e.url
-        elif t == "url":
-            # URL visible (no "bonito"), lo volvemos link también
-            meta["tag"] = "a"
-            meta["href"] = frag
-        else:
-            meta = {}
+        t = _ETYPE_CACHE[raw] = t.lower()
+    return t
 
-        res.append((frag, meta))
-        idx = e.offset + e.length
 
-    if idx < len(text):
-        res.append((text[idx:], {}))
-    return res
+_SIMPLE_TAGS = {
+    "bold": "b",
+    "italic": "i",
+    "underline": "u",
+    "strikethrough": "s",
+    "spoiler": "tg-spoiler",
+    "code": "code",
+    "blockquote": "blockquote",
+    # "<blockquote expandable>" no es XML válido y DeepL traduce en modo xml:
+    # en HTML sale como cita normal; por entities se conserva expandible.
+    "expandable_blockquote": "blockquote",
+}
 
 
-def build_html(fragments: List[Tuple[str, Dict[str, Any]]]) -> str:
-    out: List[str] = []
-    for frag, meta in fragments:
-        safe = escape(frag)
-        tag = meta.get("tag")
-        if not tag:
-            out.append(safe)
-            continue
-        if tag == "a":
-            href = html.escape(meta.get("href", ""), quote=True)
-            out.append(f'<a href="{href}">{safe}</a>')
-        elif tag in SAFE_TAGS:
-            out.append(f"<{tag}>{safe}</{tag}>")
+class _Span:
+    __slots__ = ("start", "end", "etype", "entity")
+
+    def __init__(self, start: int, end: int, etype: str, entity: MessageEntity):
+        self.start = start
+        self.end = end
+        self.etype = etype
+        self.entity = entity
+
+    def tags(self, text: str) -> Optional[Tuple[str, str]]:
+        t = self.etype
+        tag = _SIMPLE_TAGS.get(t)
+        if tag:
+            return f"<{tag}>", f"</{tag}>"
+        e = self.entity
+        if t in ("text_link", "textlink") and getattr(e, "url", None):
+            return f'<a href="{html.escape(e.url, quote=True)}">', "</a>"
+        if t == "url":
+            # URL visible (no "bonito"), la volvemos link también
+            return f'<a href="{html.escape(text[self.start:self.end], quote=True)}">', "</a>"
+        if t == "text_mention" and getattr(e, "user", None):
+            return f'<a href="tg://user?id={e.user.id}">', "</a>"
+        if t == "pre":
+            lang = getattr(e, "language", None)
+            if lang:
+                return f'<pre><code class="language-{html.escape(lang, quote=True)}">', "</code></pre>"
+            return "<pre>", "</pre>"
+        if t == "custom_emoji" and CUSTOM_EMOJI and getattr(e, "custom_emoji_id", None):
+            return f'<tg-emoji emoji-id="{html.escape(e.custom_emoji_id, quote=True)}">', "</tg-emoji>"
+        return None
+
+
+class RichText:
+    """Texto + spans (índices de str, ordenados por inicio y de fuera hacia dentro)."""
+
+    __slots__ = ("text", "spans")
+
+    def __init__(self, text: str, spans: List[_Span]):
+        self.text = text
+        self.spans = spans
+
+    @classmethod
+    def from_entities(cls, text: str, entities: Optional[List[MessageEntity]]) -> "RichText":
+        text = text or ""
+        if not entities:
+            return cls(text, [])
+        # Unidad UTF-16 -> índice: restar los caracteres astrales que empiezan antes
+        astral_u16 = [m.start() + k for k, m in enumerate(_ASTRAL_RE.finditer(text))]
+
+        def to_idx(u: int) -> int:
+            return u - bisect.bisect_left(astral_u16, u) if astral_u16 else u
+
+        n = len(text)
+        spans = []
+        for e in entities:
+            a = min(n, to_idx(e.offset))
+            b = min(n, to_idx(e.offset + e.length))
+            if b > a:
+                spans.append(_Span(a, b, _entity_type(e), e))
+        spans.sort(key=lambda sp: (sp.start, -sp.end))
+        return cls(text, spans)
+
+    def u16len(self) -> int:
+        return _u16len(self.text)
+
+    def to_html(self) -> str:
+        text = self.text
+        if not self.spans:
+            return escape(text)
+        out: List[str] = []
+        stack: List[Tuple[int, str, _Span]] = []  # (fin, cierre, span)
+        end_at = len(text) + 1  # fin más cercano de lo abierto
+        pos = 0
+        for sp in self.spans:
+            tags = sp.tags(text)
+            if tags is None:
+                continue
+            # Cerrar todo lo que termina antes de que empiece este span
+            while stack and end_at <= sp.start:
+                pos, end_at = self._close_at(out, stack, pos, end_at)
+            if sp.start > pos:
+                out.append(escape(text[pos:sp.start]))
+                pos = sp.start
+            out.append(tags[0])
+            stack.append((sp.end, tags[1], sp))
+            if sp.end < end_at:
+                end_at = sp.end
+        while stack:
+            pos, end_at = self._close_at(out, stack, pos, end_at)
+        if pos < len(text):
+            out.append(escape(text[pos:]))
+        return "".join(out)
+
+    def _close_at(self, out: List[str], stack: List[Tuple[int, str, "_Span"]], pos: int, end: int) -> Tuple[int, int]:
+        # Cierra lo que termina en `end`; si algo solapa sin anidar, se cierra y se reabre
+        if end > pos:
+            out.append(escape(self.text[pos:end]))
+        if stack[-1][0] == end:  # caso normal: anidado bien, cierra el de arriba
+            out.append(stack.pop()[1])
+            if not stack:
+                return end, len(self.text) + 1
+            return end, min(item[0] for item in stack)
+        k = next(j for j, item in enumerate(stack) if item[0] == end)
+        reopen = [item for item in stack[k + 1:] if item[0] > end]
+        for item in reversed(stack[k:]):
+            out.append(item[1])
+        del stack[k:]
+        for item in reopen:
+            out.append(item[2].tags(self.text)[0])
+            stack.append(item)
+        return end, min((item[0] for item in stack), default=len(self.text) + 1)
+
+    def to_entities(self) -> List[MessageEntity]:
+        text = self.text
+        astral = [m.start() for m in _ASTRAL_RE.finditer(text)] if self.spans else []
+
+        def to_u16(i: int) -> int:
+            return i + bisect.bisect_left(astral, i) if astral else i
+
+        out = []
+        for sp in self.spans:
+            if sp.etype == "custom_emoji" and not CUSTOM_EMOJI:
+                continue
+            e = sp.entity
+            a, b = to_u16(sp.start), to_u16(sp.end)
+            out.append(MessageEntity(
+                e.type, a, b - a,
+                url=getattr(e, "url", None),
+                user=getattr(e, "user", None),
+                language=getattr(e, "language", None),
+                custom_emoji_id=getattr(e, "custom_emoji_id", None),
+            ))
+        return out
+
+    def with_prefix(self, prefix: str) -> "RichText":
+        k = len(prefix)
+        return RichText(prefix + self.text, [_Span(sp.start + k, sp.end + k, sp.etype, sp.entity) for sp in self.spans])
+
+    def truncate(self, max_len: int, ellipsis: str = "…") -> "RichText":
+        """Recorta a max_len unidades UTF-16 (como cap_with_prefix, con "…")."""
+        text = self.text.strip()
+        lead = len(self.text) - len(self.text.lstrip())
+        if _u16len(text) > max_len:
+            text = _u16_prefix(text, max_len - _u16len(ellipsis)) + ellipsis
+            limit = len(text) - len(ellipsis)
         else:
-            out.append(safe)
-    return "".join(out)
+            limit = len(text)
+        spans = []
+        for sp in self.spans:
+            a, b = sp.start - lead, min(sp.end - lead, limit)
+            a = max(0, a)
+            if b > a:
+                spans.append(_Span(a, b, sp.etype, sp.entity))
+        return RichText(text, spans)
+
+
+def render_html(text: str, entities: Optional[List[MessageEntity]]) -> str:
+    return RichText.from_entities(text, entities).to_html()
 
 
 # ================== GLOSARIO (DEFAULT) ==================
@@ -393,6 +1184,227 @@ bullish\tbullish
 bearish\tbearish
 """
 
+# ================== CACHÉ DE TRADUCCIÓN (LRU memoria + SQLite) ==================
+# Clave = hash de (texto normalizado, source, target, formality, glossary, tag_handling).
+# Se guarda la salida CRUDA de DeepL (antes de postprocess), así los placeholders de URL
+# se reponen con los de cada mensaje y textos que solo difieren en URLs comparten entrada.
+TRANSLATION_CACHE = os.getenv("TRANSLATION_CACHE", "true").lower() == "true"
+TRANSLATION_CACHE_MEM_MAX = int(os.getenv("TRANSLATION_CACHE_MEM_MAX", "2000") or "2000")
+TRANSLATION_CACHE_DB_MAX = int(os.getenv("TRANSLATION_CACHE_DB_MAX", "50000") or "50000")
+TRANSLATION_CACHE_TTL_SEC = float(os.getenv("TRANSLATION_CACHE_TTL_SEC", str(30 * 86400)) or "2592000")
+TRANSLATION_CACHE_PRUNE_EVERY = 500  # puts entre limpiezas de la tabla
+
+
+def _tcache_key(text: str, *, tag_handling: str, glossary_id: str) -> str:
+    norm = unicodedata.normalize("NFC", text or "")
+    formality = FORMALITY if TARGET_LANG in DEEPL_FORMALITY_LANGS else ""
+    raw = "\x1f".join([norm, SOURCE_LANG, TARGET_LANG, formality, glossary_id or "", tag_handling or ""])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class TranslationCache:
+    def __init__(self, mem_max: int, db_max: int, ttl_sec: float, table: str = "translation_cache"):
+        self.table = table
+        self.mem_max = mem_max
+        self.db_max = db_max
+        self.ttl_sec = ttl_sec
+        self._mem: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._puts = 0
+        self.hits_mem = 0
+        self.hits_db = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        item = self._mem.get(key)
+        if item is not None:
+            value, created = item
+            if (now - created) < self.ttl_sec:
+                self._mem.move_to_end(key)
+                self.hits_mem += 1
+                return value
+            self._mem.pop(key, None)
+
+        value = await self._db_get(key, now)
+        if value is not None:
+            self.hits_db += 1
+            self._mem_put(key, value, now)
+            return value
+        self.misses += 1
+        return None
+
+    def put(self, key: str, value: str):
+        now = time.time()
+        self._mem_put(key, value, now)
+        self._db_put(key, value, now)
+
+    def _mem_put(self, key: str, value: str, created: float):
+        self._mem[key] = (value, created)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.mem_max:
+            self._mem.popitem(last=False)
+
+    async def _db_get(self, key: str, now: float) -> Optional[str]:
+        # Por el hilo lector de msg_map, como las lecturas del mapa: un miss no bloquea el loop
+        if not _DB_CONN or not MSG_MAP:
+            return None
+        try:
+            rows = await MSG_MAP.query(
+                f"SELECT value FROM {self.table} WHERE key=? AND created_at>=?",
+                (key, now - self.ttl_sec),
+            )
+            return rows[0][0] if rows else None
+        except Exception as e:
+            log.warning("%s get failed: %s", self.table, e)
+            return None
+
+    def _db_put(self, key: str, value: str, now: float):
+        # Por el hilo escritor de msg_map (mismo lote/transacción): un miss no bloquea el loop
+        if not _DB_CONN or not MSG_MAP:
+            return
+        try:
+            MSG_MAP.execute_later(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created_at) VALUES (?, ?, ?)",
+                (key, value, now),
+            )
+            self._puts += 1
+            if self._puts % TRANSLATION_CACHE_PRUNE_EVERY == 0:
+                self._db_prune(now)
+        except Exception as e:
+            log.warning("%s put failed: %s", self.table, e)
+
+    def _db_prune(self, now: float):
+        MSG_MAP.execute_later(f"DELETE FROM {self.table} WHERE created_at<?", (now - self.ttl_sec,))
+        MSG_MAP.execute_later(
+            f"""
+            DELETE FROM {self.table} WHERE key IN (
+                SELECT key FROM {self.table} ORDER BY created_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.db_max,),
+        )
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "mem_size": len(self._mem),
+            "hits_mem": self.hits_mem,
+            "hits_db": self.hits_db,
+            "misses": self.misses,
+        }
+
+
+_TCACHE = TranslationCache(TRANSLATION_CACHE_MEM_MAX, TRANSLATION_CACHE_DB_MAX, TRANSLATION_CACHE_TTL_SEC)
+
+
+async def tcache_get(text: str, *, tag_handling: str, glossary_id: str) -> Optional[str]:
+    if not TRANSLATION_CACHE:
+        return None
+    return await _TCACHE.get(_tcache_key(text, tag_handling=tag_handling, glossary_id=glossary_id))
+
+
+def tcache_put(text: str, translated: str, *, tag_handling: str, glossary_id: str):
+    if not TRANSLATION_CACHE:
+        return
+    _TCACHE.put(_tcache_key(text, tag_handling=tag_handling, glossary_id=glossary_id), translated)
+
+
+# ================== BATCHING DE DEEPL (/v2/translate con varios "text") ==================
+# Junta todos los textos con los mismos parámetros (glosario, tag_handling) que llegan
+# dentro de una ventana corta y los manda en UNA petición. Cuerpo + botones de un
+# mensaje (y mensajes concurrentes) comparten round-trip.
+DEEPL_BATCH_WINDOW_MS = float(os.getenv("DEEPL_BATCH_WINDOW_MS", "15") or "15")
+DEEPL_BATCH_MAX_TEXTS = int(os.getenv("DEEPL_BATCH_MAX_TEXTS", "50") or "50")  # límite DeepL: 50
+DEEPL_BATCH_MAX_BYTES = int(os.getenv("DEEPL_BATCH_MAX_BYTES", "100000") or "100000")
+
+
+def _deepl_params(tag_handling: str, glossary_id: str) -> List[Tuple[str, str]]:
+    params = [("source_lang", SOURCE_LANG), ("target_lang", TARGET_LANG)]
+    if tag_handling == "xml":
+        params += [
+            ("tag_handling", "xml"),
+            ("split_sentences", "nonewlines"),
+            ("preserve_formatting", "1"),
+            ("ignore_tags", "code,pre"),
+        ]
+    if TARGET_LANG in DEEPL_FORMALITY_LANGS:
+        params.append(("formality", FORMALITY))
+    if glossary_id:
+        params.append(("glossary_id", glossary_id))
+    return params
+
+
+class DeepLBatcher:
+    def __init__(self, window_sec: float, max_texts: int, max_bytes: int):
+        self.window_sec = window_sec
+        self.max_texts = max(1, max_texts)
+        self.max_bytes = max_bytes
+        self._pending: Dict[Tuple[str, str], List[Tuple[str, "asyncio.Future[Optional[str]]"]]] = {}
+        self._sizes: Dict[Tuple[str, str], int] = {}
+        self._timers: Dict[Tuple[str, str], asyncio.TimerHandle] = {}
+        self.requests = 0
+        self.texts = 0
+
+    async def translate(self, text: str, *, tag_handling: str, glossary_id: str) -> Optional[str]:
+        """
+        Devuelve la salida cruda de DeepL, o None si DeepL respondió != 200.
+        Errores de red se propagan a cada llamador.
+        """
+        key = (tag_handling, glossary_id)
+        fut: "asyncio.Future[Optional[str]]" = asyncio.get_running_loop().create_future()
+        size = len(text.encode("utf-8"))
+        if key in self._pending and self._sizes.get(key, 0) + size > self.max_bytes:
+            self._flush(key)
+        batch = self._pending.setdefault(key, [])
+        batch.append((text, fut))
+        self._sizes[key] = self._sizes.get(key, 0) + size
+        if len(batch) >= self.max_texts:
+            self._flush(key)
+        elif key not in self._timers:
+            if self.window_sec > 0:
+                self._timers[key] = asyncio.get_running_loop().call_later(self.window_sec, self._flush, key)
+            else:
+                self._flush(key)
+        return await fut
+
+    def _flush(self, key: Tuple[str, str]):
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        batch = self._pending.pop(key, [])
+        self._sizes.pop(key, None)
+        if batch:
+            asyncio.ensure_future(self._send(key, batch))
+
+    async def _send(self, key: Tuple[str, str], batch: List[Tuple[str, "asyncio.Future[Optional[str]]"]]):
+        tag_handling, glossary_id = key
+        url = f"{DEEPL_API_URL}/v2/translate"
+        headers = {"Authorization": f"DeepL-Auth-Key {DEEPL_API_KEY}"}
+        data = [("text", t) for t, _ in batch] + _deepl_params(tag_handling, glossary_id)
+        self.requests += 1
+        self.texts += len(batch)
+        try:
+            async with deepl_session().post(url, headers=headers, data=data) as r:
+                b = await r.text()
+                if r.status != 200:
+                    log.warning("DeepL%s HTTP %s: %s", "(markup)" if tag_handling else "", r.status, b)
+                    outs: List[Optional[str]] = [None] * len(batch)
+                else:
+                    js = await r.json()
+                    outs = [tr.get("text") for tr in js.get("translations", [])]
+                    outs += [None] * (len(batch) - len(outs))
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for (_, fut), out in zip(batch, outs):
+            if not fut.done():
+                fut.set_result(out)
+
+
+_DEEPL_BATCHER = DeepLBatcher(DEEPL_BATCH_WINDOW_MS / 1000.0, DEEPL_BATCH_MAX_TEXTS, DEEPL_BATCH_MAX_BYTES)
+
+
 # ================== TRADUCCIÓN (DEEPL + GLOSARIO) ==================
 # ================== TRADUCCIÓN DE MARKUP (HTML/XML) PARA CONSERVAR LINKS BONITOS ==================
 _TAG_RE = re.compile(r"<[^>]+>")
@@ -400,7 +1412,7 @@ _TAG_RE = re.compile(r"<[^>]+>")
 def _strip_tags(s: str) -> str:
     return _TAG_RE.sub("", s or "")
 
-async def deepl_translate_markup(markup_text: str, *, session: aiohttp.ClientSession) -> str:
+async def deepl_translate_markup(markup_text: str) -> str:
     """
     Traduce texto en formato HTML/XML conservando tags (por ejemplo <a href="...">link</a>).
     DeepL conserva href y solo traduce el texto visible, así tus enlaces se mantienen bonitos.
@@ -421,36 +1433,28 @@ async def deepl_translate_markup(markup_text: str, *, session: aiohttp.ClientSes
         except Exception:
             gid = ""
 
-    url = f"https://{DEEPL_API_HOST}/v2/translate"
-    headers = {"Authorization": f"DeepL-Auth-Key {DEEPL_API_KEY}"}
-    data = {
-        "text": markup_text,
-        "source_lang": SOURCE_LANG,
-        "target_lang": TARGET_LANG,
-        "tag_handling": "xml",
-        "split_sentences": "nonewlines",
-        "preserve_formatting": "1",
-        "ignore_tags": "code,pre",
-    }
-    if TARGET_LANG in DEEPL_FORMALITY_LANGS:
-        data["formality"] = FORMALITY
-    if gid:
-        data["glossary_id"] = gid
-
-    async with session.post(url, headers=headers, data=data) as r:
-        b = await r.text()
-        if r.status != 200:
-            log.warning("DeepL(markup) HTTP %s: %s", r.status, b)
-            return markup_text
-        js = await r.json()
-        return js["translations"][0]["text"]
+    cached = await tcache_get(markup_text, tag_handling="xml", glossary_id=gid)
+    if cached is not None:
+        return cached
+
+    out = await _DEEPL_BATCHER.translate(markup_text, tag_handling="xml", glossary_id=gid)
+    if out is None:
+        return markup_text
+    tcache_put(markup_text, out, tag_handling="xml", glossary_id=gid)
+    return out
 # ================== FIN TRADUCCIÓN DE MARKUP ==================
 
 DEEPL_FORMALITY_LANGS = {"DE", "FR", "IT", "ES", "NL", "PL", "PT-PT", "PT-BR", "RU", "JA"}
 _glossary_id_mem: Optional[str] = None  # cache en memoria para esta ejecución
+_GLOSSARY_LOCK = asyncio.Lock()  # traducciones concurrentes no crean N glosarios
 
 
 async def deepl_create_glossary_if_needed() -> Optional[str]:
+    async with _GLOSSARY_LOCK:
+        return await _deepl_create_glossary_locked()
+
+
+async def _deepl_create_glossary_locked() -> Optional[str]:
     global _glossary_id_mem, GLOSSARY_ID
     if not TRANSLATE or not DEEPL_API_KEY:
         return None
@@ -462,7 +1466,7 @@ async def deepl_create_glossary_if_needed() -> Optional[str]:
     if not entries:
         return None
 
-    url = f"https://{DEEPL_API_HOST}/v2/glossaries"
+    url = f"{DEEPL_API_URL}/v2/glossaries"
     form = aiohttp.FormData()
     form.add_field("name", "Trading ES-EN (Auto)")
     form.add_field("source_lang", SOURCE_LANG or "ES")
@@ -472,25 +1476,36 @@ async def deepl_create_glossary_if_needed() -> Optional[str]:
     headers = {"Authorization": f"DeepL-Auth-Key {DEEPL_API_KEY}"}
     timeout = aiohttp.ClientTimeout(total=30)
     try:
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.post(url, headers=headers, data=form) as resp:
-                body = await resp.text()
-                if resp.status != 200:
-                    log.warning("DeepL glossary create HTTP %s: %s", resp.status, body)
-                    return None
-                js = await resp.json()
-                gid = js.get("glossary_id", "")
-                if gid:
-                    _glossary_id_mem = gid
-                    GLOSSARY_ID = gid
-                    log.info("DeepL glossary created: %s", gid)
-                    return gid
+        async with deepl_session().post(url, headers=headers, data=form, timeout=timeout) as resp:
+            body = await resp.text()
+            if resp.status != 200:
+                log.warning("DeepL glossary create HTTP %s: %s", resp.status, body)
+                return None
+            js = await resp.json()
+            gid = js.get("glossary_id", "")
+            if gid:
+                _glossary_id_mem = gid
+                GLOSSARY_ID = gid
+                log.info("DeepL glossary created: %s", gid)
+                return gid
     except Exception as e:
         log.warning("DeepL glossary create failed: %s", e)
     return None
 
 
-async def deepl_translate(text: str, *, session: aiohttp.ClientSession) -> str:
+async def deepl_translate(text: str, *, as_markup: bool = False) -> str:
+    """
+    Traducción de texto plano. Con as_markup=True el texto viaja escapado en el
+    mismo modo xml que el cuerpo HTML, para compartir petición batch con él
+    (lo usan las etiquetas de botones). Si DeepL falla devuelve el original.
+    """
+    out = await deepl_try_translate(text, as_markup=as_markup)
+    return text if out is None else out
+
+
+async def deepl_try_translate(text: str, *, as_markup: bool = False) -> Optional[str]:
+    """Como deepl_translate, pero None si DeepL falla (429/5xx/red): quien cachea
+    el resultado no debe guardar el original como si fuera la traducción."""
     if not text.strip():
         return text
     if not TRANSLATE or not DEEPL_API_KEY:
@@ -507,35 +1522,115 @@ async def deepl_translate(text: str, *, session: aiohttp.ClientSession) -> str:
             gid = ""
 
     text2, _url_ph = preprocess_for_translation(text)
-    # Extra: ayuda a DeepL con encabezados típicos para evitar salidas raras
-    if TARGET_LANG.upper() == 'EN':
-        text2 = re.sub(r'^\s*Importante\s*:', 'Important:', text2, flags=re.I|re.M)
 
-    url = f"https://{DEEPL_API_HOST}/v2/translate"
-    headers = {"Authorization": f"DeepL-Auth-Key {DEEPL_API_KEY}"}
-    data = {
-        "text": text2,
-        "source_lang": SOURCE_LANG,
-        "target_lang": TARGET_LANG,
-    }
-    if TARGET_LANG in DEEPL_FORMALITY_LANGS:
-        data["formality"] = FORMALITY
-    if gid:
-        data["glossary_id"] = gid
-
-    async with session.post(url, headers=headers, data=data) as r:
-        b = await r.text()
-        if r.status != 200:
-            log.warning("DeepL HTTP %s: %s", r.status, b)
-            return text
-        js = await r.json()
-        out = js["translations"][0]["text"]
-        return postprocess_translation(out, _url_ph)
+    tag_handling = "xml" if as_markup else ""
+    payload = escape(text2) if as_markup else text2
+
+    out = await tcache_get(payload, tag_handling=tag_handling, glossary_id=gid)
+    if out is None:
+        out = await _DEEPL_BATCHER.translate(payload, tag_handling=tag_handling, glossary_id=gid)
+        if out is None:
+            return None
+        tcache_put(payload, out, tag_handling=tag_handling, glossary_id=gid)
+    if as_markup:
+        out = html.unescape(out)
+    return postprocess_translation(out, _url_ph)
 
 # ================== OPENAI STT/TTS (AUDIO) ==================
-async def openai_transcribe(audio_bytes: bytes, filename: str, mime: str, *, language_hint: str) -> str:
+# El audio se descarga en streaming a un buffer que pasa a fichero temporal al
+# superar AUDIO_SPOOL_MEM_BYTES, y se sube a Whisper desde ese mismo fichero: nunca
+# hay una copia entera del audio en RAM. Los límites se comprueban antes de bajar
+# nada (file_size del mensaje / getFile) y, por si no vienen, también al vuelo.
+OPENAI_STT_MAX_BYTES = int(os.getenv("OPENAI_STT_MAX_BYTES", str(25 * 1024 * 1024)) or "26214400")
+# getFile del Bot API público no sirve más de 20 MB; el servidor local en --local, hasta 2000 MB
+TG_DOWNLOAD_MAX_BYTES = int(
+    os.getenv("TG_DOWNLOAD_MAX_BYTES", str((2000 if TG_LOCAL_MODE else 20) * 1024 * 1024)) or "20971520"
+)
+AUDIO_SPOOL_MEM_BYTES = int(os.getenv("AUDIO_SPOOL_MEM_BYTES", str(1024 * 1024)) or "1048576")
+_DOWNLOAD_CHUNK = 64 * 1024
+
+
+def audio_size_limit() -> int:
+    # Troceando, el límite de Whisper aplica a cada trozo, no al fichero
+    return TG_DOWNLOAD_MAX_BYTES if STT_CHUNK_SEC > 0 else min(OPENAI_STT_MAX_BYTES, TG_DOWNLOAD_MAX_BYTES)
+
+
+def local_file_path(path: str) -> Path:
+    """Ruta del servidor Bot API → ruta en este contenedor (TG_LOCAL_PATH_MAP="origen:destino")."""
+    if TG_LOCAL_PATH_MAP and ":" in TG_LOCAL_PATH_MAP:
+        src, dst = TG_LOCAL_PATH_MAP.split(":", 1)
+        src = src.rstrip("/")
+        if path == src or path.startswith(src + "/"):
+            return Path(dst.rstrip("/") + path[len(src):])
+    return Path(path)
+
+
+def bot_api_file_path(bot: Any, file_path: str) -> str:
+    """
+    Ruta tal cual la dio getFile. PTB antepone base_file_url a toda ruta que no
+    exista en este disco (ruta del servidor con otro montaje → "…/file/bot<token>//var/lib/…").
+    """
+    prefix = (getattr(bot, "base_file_url", "") or "") + "/"
+    if prefix != "/" and file_path.startswith(prefix):
+        return file_path[len(prefix):]
+    return file_path
+
+
+def open_local_file(path: str, *, max_bytes: int) -> BinaryIO:
+    """
+    Modo --local: el fichero ya está en disco. Se abre tal cual (sin copiar): aiohttp
+    sube desde el descriptor con Content-Length y el troceador hace seek sobre él.
+    """
+    p = local_file_path(path)
+    size = p.stat().st_size
+    if size > max_bytes:
+        raise RuntimeError(f"audio demasiado grande: {size} > {max_bytes} bytes")
+    return p.open("rb")
+
+
+@timed_stage("download_audio")
+async def download_telegram_file(context: ContextTypes.DEFAULT_TYPE, file_id: str, *, max_bytes: int) -> BinaryIO:
+    """
+    getFile + descarga en streaming. Devuelve un fichero binario posicionado al
+    inicio (BytesIO si es pequeño, fichero temporal anónimo si no; con TG_LOCAL_MODE,
+    el propio fichero del servidor Bot API). Lo cierra quien llama.
+    """
+    tg_file = await context.bot.get_file(file_id)
+    if tg_file.file_size and tg_file.file_size > max_bytes:
+        raise RuntimeError(f"audio demasiado grande: {tg_file.file_size} > {max_bytes} bytes")
+    if TG_LOCAL_MODE and tg_file.file_path:
+        path = bot_api_file_path(context.bot, tg_file.file_path)
+        if os.path.isabs(path):
+            return open_local_file(path, max_bytes=max_bytes)
+
+    buf: BinaryIO = io.BytesIO()
+    size = 0
+    try:
+        async with tg_files_session().get(tg_file.file_path) as resp:
+            if resp.status != 200:
+                raise RuntimeError(f"Telegram file HTTP {resp.status}")
+            async for chunk in resp.content.iter_chunked(_DOWNLOAD_CHUNK):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise RuntimeError(f"audio demasiado grande: > {max_bytes} bytes")
+                if isinstance(buf, io.BytesIO) and size > AUDIO_SPOOL_MEM_BYTES:
+                    spool = tempfile.TemporaryFile()
+                    spool.write(buf.getbuffer())
+                    buf.close()
+                    buf = spool
+                buf.write(chunk)
+    except BaseException:
+        buf.close()
+        raise
+    buf.seek(0)
+    return buf
+
+
+@timed_stage("openai_transcribe")
+async def openai_transcribe(audio: bytes | BinaryIO, filename: str, mime: str, *, language_hint: str) -> str:
     """
     Speech-to-text con OpenAI (Whisper). Devuelve texto en el idioma original.
+    `audio` puede ser bytes o un fichero binario (se sube en streaming desde él).
     """
     if not OPENAI_API_KEY:
         raise RuntimeError("Falta OPENAI_API_KEY para transcribir audio.")
@@ -547,16 +1642,14 @@ async def openai_transcribe(audio_bytes: bytes, filename: str, mime: str, *, lan
     # Whisper usa language como 'es', 'en', etc. (mejor esfuerzo)
     if language_hint:
         form.add_field("language", language_hint.lower())
-    form.add_field("file", audio_bytes, filename=filename, content_type=mime or "application/octet-stream")
+    form.add_field("file", audio, filename=filename, content_type=mime or "application/octet-stream")
 
-    timeout = aiohttp.ClientTimeout(total=OPENAI_TIMEOUT_SEC)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.post(url, headers=headers, data=form) as resp:
-            body = await resp.text()
-            if resp.status != 200:
-                raise RuntimeError(f"OpenAI STT HTTP {resp.status}: {body[:400]}")
-            js = await resp.json()
-            return (js.get("text") or "").strip()
+    async with openai_session().post(url, headers=headers, data=form) as resp:
+        body = await resp.text()
+        if resp.status != 200:
+            raise RuntimeError(f"OpenAI STT HTTP {resp.status}: {body[:400]}")
+        js = await resp.json()
+        return (js.get("text") or "").strip()
 
 async def openai_tts(text_en: str) -> bytes:
     """
@@ -575,13 +1668,263 @@ async def openai_tts(text_en: str) -> bytes:
         "format": OPENAI_TTS_FORMAT,
     }
 
-    timeout = aiohttp.ClientTimeout(total=OPENAI_TIMEOUT_SEC)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.post(url, headers=headers, json=payload) as resp:
-            if resp.status != 200:
-                body = await resp.text()
-                raise RuntimeError(f"OpenAI TTS HTTP {resp.status}: {body[:400]}")
-            return await resp.read()
+    async with openai_session().post(url, headers=headers, json=payload) as resp:
+        if resp.status != 200:
+            body = await resp.text()
+            raise RuntimeError(f"OpenAI TTS HTTP {resp.status}: {body[:400]}")
+        return await resp.read()
+
+
+# ================== TRANSCRIPCIÓN POR TROZOS (audio largo) ==================
+# Ogg/Opus (notas de voz) y MP3 se cortan en límites de página/frame, sin decodificar,
+# en trozos de ~STT_CHUNK_SEC que se transcriben en paralelo (máx. STT_CHUNK_CONCURRENCY
+# llamadas a la vez en todo el proceso) y se unen en orden. El tiempo de pared pasa a
+# depender del largo del trozo, no del audio. Cada trozo Ogg lleva las páginas de
+# cabecera (OpusHead/OpusTags) y sus páginas renumeradas con CRC nuevo; los MP3 son
+# autosincronizantes y basta con cortar entre frames (tras basura se resincroniza; si
+# los frames no llegan hasta el final, no se trocea). Otros formatos: una sola llamada.
+STT_CHUNK_SEC = float(os.getenv("STT_CHUNK_SEC", "120") or "0")  # 0 = no trocear
+STT_CHUNK_CONCURRENCY = int(os.getenv("STT_CHUNK_CONCURRENCY", "4") or "4")
+
+_STT_SEM = asyncio.Semaphore(max(1, STT_CHUNK_CONCURRENCY))
+
+_OGG_HDR = struct.Struct("<4sBBqIIIB")  # captura, versión, flags, granule, serie, secuencia, crc, nsegs
+_OGG_CONTINUED, _OGG_EOS = 0x01, 0x04
+_BITREV8 = bytes(int(f"{i:08b}"[::-1], 2) for i in range(256))
+
+_MP3_BITRATES = {  # kbps por (MPEG1?, capa)
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+
+def _ogg_crc(page: bytes) -> int:
+    """CRC de Ogg (poly 0x04C11DB7, sin reflejar, init 0) vía zlib con bits invertidos."""
+    r = zlib.crc32(page.translate(_BITREV8), 0xFFFFFFFF) ^ 0xFFFFFFFF
+    return int(f"{r:032b}"[::-1], 2)
+
+
+def _new_spool(size: int) -> BinaryIO:
+    return io.BytesIO() if size <= AUDIO_SPOOL_MEM_BYTES else tempfile.TemporaryFile()
+
+
+def _copy_range(src: BinaryIO, dst: BinaryIO, offset: int, length: int):
+    src.seek(offset)
+    while length > 0:
+        block = src.read(min(length, 1024 * 1024))
+        if not block:
+            break
+        dst.write(block)
+        length -= len(block)
+
+
+def _plan_cuts(units: List[Tuple[int, int, float, bool]], chunk_sec: float, max_bytes: int) -> List[Tuple[int, int]]:
+    """
+    units = (offset, tamaño, segundos, se_puede_cortar_antes). Devuelve rangos [i, j)
+    de unidades con duración ~igual (total / n) y sin pasar de max_bytes.
+    """
+    total = sum(u[2] for u in units)
+    n = max(1, int(-(-total // chunk_sec)))
+    target = total / n
+    cuts: List[Tuple[int, int]] = []
+    start, dur, size = 0, 0.0, 0
+    for i, (_, length, sec, cuttable) in enumerate(units):
+        if i > start and cuttable and (dur >= target or size + length > max_bytes):
+            cuts.append((start, i))
+            start, dur, size = i, 0.0, 0
+        dur += sec
+        size += length
+    cuts.append((start, len(units)))
+    return cuts
+
+
+def _split_ogg_opus(f: BinaryIO, chunk_sec: float, max_bytes: int) -> Optional[List[BinaryIO]]:
+    pages: List[Tuple[int, int, int, int]] = []  # (offset, tamaño, flags, granule)
+    serial = None
+    pre_skip = 0
+    f.seek(0)
+    while True:
+        off = f.tell()
+        raw = f.read(_OGG_HDR.size)
+        if len(raw) < _OGG_HDR.size:
+            break
+        capture, _ver, flags, granule, ser, _seq, _crc, nsegs = _OGG_HDR.unpack(raw)
+        if capture != b"OggS" or (serial is not None and ser != serial):
+            return None  # no es Ogg, o es multiplexado/encadenado: sin trocear
+        serial = ser
+        body = sum(f.read(nsegs))
+        if not pages:
+            head = f.read(12)
+            if head[:8] != b"OpusHead" or len(head) < 12:
+                return None
+            pre_skip = struct.unpack_from("<H", head, 10)[0]
+            f.seek(-12, 1)
+        f.seek(body, 1)
+        pages.append((off, _OGG_HDR.size + nsegs + body, flags, granule))
+
+    # Cabecera = página OpusHead + páginas de OpusTags (granule 0)
+    n_head = 1
+    while n_head < len(pages) and pages[n_head][3] == 0:
+        n_head += 1
+    audio = pages[n_head:]
+    if not audio:
+        return None
+    units: List[Tuple[int, int, float, bool]] = []
+    last_gp = pre_skip
+    for off, size, flags, granule in audio:
+        sec = 0.0
+        if granule >= 0:
+            sec = max(0, granule - last_gp) / 48000.0
+            last_gp = granule
+        units.append((off, size, sec, not (flags & _OGG_CONTINUED)))
+    head_bytes = sum(p[1] for p in pages[:n_head])
+    cuts = _plan_cuts(units, chunk_sec, max_bytes - head_bytes)
+    if len(cuts) < 2:
+        return None
+
+    chunks: List[BinaryIO] = []
+    for i, j in cuts:
+        out = _new_spool(head_bytes + sum(u[1] for u in units[i:j]))
+        _copy_range(f, out, 0, head_bytes)
+        for k in range(i, j):
+            off, size, _sec, _ok = units[k]
+            f.seek(off)
+            page = bytearray(f.read(size))
+            page[5] = (page[5] & ~_OGG_EOS) | (_OGG_EOS if k == j - 1 else 0)
+            struct.pack_into("<II", page, 18, n_head + k - i, 0)
+            struct.pack_into("<I", page, 22, _ogg_crc(bytes(page)))
+            out.write(page)
+        out.seek(0)
+        chunks.append(out)
+    return chunks
+
+
+_MP3_RESYNC_MAX = 64 * 1024  # basura tolerada entre dos frames
+
+
+def _mp3_frame(h: bytes) -> Optional[Tuple[int, float]]:
+    """(bytes, segundos) del frame cuya cabecera son estos 4 bytes, o None si no lo es."""
+    if len(h) < 4 or h[0] != 0xFF or (h[1] & 0xE0) != 0xE0:
+        return None
+    version, layer = (h[1] >> 3) & 3, 4 - ((h[1] >> 1) & 3)
+    br_idx, sr_idx, pad = h[2] >> 4, (h[2] >> 2) & 3, (h[2] >> 1) & 1
+    if version == 1 or layer == 4 or br_idx in (0, 15) or sr_idx == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = _MP3_BITRATES[(mpeg1, layer)][br_idx] * 1000
+    rate = _MP3_RATES[version][sr_idx]
+    if layer == 1:
+        samples, length = 384, (12 * bitrate // rate + pad) * 4
+    else:
+        samples = 1152 if (layer == 2 or mpeg1) else 576
+        length = samples // 8 * bitrate // rate + pad
+    return length, samples / rate
+
+
+def _mp3_resync(f: BinaryIO, pos: int, end: int) -> Optional[int]:
+    """Siguiente offset > pos con un frame válido seguido de otro (o del final)."""
+    f.seek(pos + 1)
+    buf = f.read(min(_MP3_RESYNC_MAX, end - pos - 1) + 4)
+    i = buf.find(b"\xff")
+    while 0 <= i < len(buf) - 3:
+        fr = _mp3_frame(buf[i:i + 4])
+        if fr is not None:
+            nxt = pos + 1 + i + fr[0]
+            f.seek(nxt)
+            if nxt >= end or _mp3_frame(f.read(4)) is not None:
+                return pos + 1 + i
+        i = buf.find(b"\xff", i + 1)
+    return None
+
+
+def _split_mp3(f: BinaryIO, chunk_sec: float, max_bytes: int) -> Optional[List[BinaryIO]]:
+    size = f.seek(0, io.SEEK_END)
+    f.seek(max(0, size - 128))
+    end = size - 128 if size >= 128 and f.read(3) == b"TAG" else size  # ID3v1 al final
+    f.seek(0)
+    head = f.read(10)
+    pos = 0
+    if head[:3] == b"ID3" and len(head) == 10:  # ID3v2: tamaño synchsafe (+ pie opcional)
+        pos = 10 + ((head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]) + (10 if head[5] & 0x10 else 0)
+    units: List[Tuple[int, int, float, bool]] = []
+    while pos < end:
+        f.seek(pos)
+        fr = _mp3_frame(f.read(4))
+        if fr is None:
+            # Basura entre frames: se busca la siguiente cabecera creíble. Si no hay,
+            # no se trocea (una sola llamada a Whisper) en vez de perder el resto.
+            nxt = _mp3_resync(f, pos, end)
+            if nxt is None:
+                return None
+            pos = nxt
+            continue
+        units.append((pos, fr[0], fr[1], True))
+        pos += fr[0]
+    if not units:
+        return None
+    cuts = _plan_cuts(units, chunk_sec, max_bytes)
+    if len(cuts) < 2:
+        return None
+    chunks: List[BinaryIO] = []
+    for i, j in cuts:
+        start = units[i][0]
+        end = units[j - 1][0] + units[j - 1][1]
+        out = _new_spool(end - start)
+        _copy_range(f, out, start, end - start)
+        out.seek(0)
+        chunks.append(out)
+    return chunks
+
+
+def split_audio(f: BinaryIO, *, chunk_sec: float, max_bytes: int) -> Optional[List[BinaryIO]]:
+    """Trozos listos para subir, o None si no hace falta / no se sabe trocear."""
+    f.seek(0)
+    magic = f.read(4)
+    try:
+        if magic == b"OggS":
+            return _split_ogg_opus(f, chunk_sec, max_bytes)
+        if magic[:3] == b"ID3" or (len(magic) >= 2 and magic[0] == 0xFF and (magic[1] & 0xE0) == 0xE0):
+            return _split_mp3(f, chunk_sec, max_bytes)
+        return None
+    finally:
+        f.seek(0)
+
+
+async def transcribe_audio(audio: BinaryIO, filename: str, mime: str, *, language_hint: str) -> str:
+    """openai_transcribe con troceo en paralelo para audio largo (ver STT_CHUNK_SEC)."""
+    chunks = None
+    if STT_CHUNK_SEC > 0:
+        chunks = await asyncio.get_running_loop().run_in_executor(
+            None, functools.partial(split_audio, audio, chunk_sec=STT_CHUNK_SEC, max_bytes=OPENAI_STT_MAX_BYTES)
+        )
+    if not chunks:
+        size = audio.seek(0, io.SEEK_END)
+        audio.seek(0)
+        if size > OPENAI_STT_MAX_BYTES:
+            raise RuntimeError(f"audio demasiado grande para Whisper y no troceable: {size} bytes")
+        async with _STT_SEM:
+            return await openai_transcribe(audio, filename, mime, language_hint=language_hint)
+
+    async def _one(chunk: BinaryIO) -> str:
+        async with _STT_SEM:
+            return await openai_transcribe(chunk, filename, mime, language_hint=language_hint)
+
+    tasks = [asyncio.ensure_future(_one(c)) for c in chunks]
+    try:
+        texts = await asyncio.gather(*tasks)
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for c in chunks:
+            c.close()
+    return " ".join(t for t in texts if t)
+
 
 async def replicate_audio_with_translation(
     context: ContextTypes.DEFAULT_TYPE,
@@ -590,17 +1933,18 @@ async def replicate_audio_with_translation(
     dest_thread_id: Optional[int],
     *,
     do_translate: bool,
-):
+    plan: Optional["RenderPlan"] = None,
+) -> bool:
     """
     Ajuste: NO traducimos la voz (no TTS).
     - Enviamos el audio/nota de voz ORIGINAL al destino.
     - Pegado al audio (caption) enviamos el TEXTO traducido a inglés (STT + DeepL).
     Si falla STT o no hay OPENAI_API_KEY, se replica el audio original sin caption.
+    Devuelve True si se envió algo al destino.
     """
     # Si está apagado el audio-translate o no corresponde traducir, solo copiamos el audio original.
     if not AUDIO_TRANSLATE or not do_translate:
-        await copy_with_caption(context, dest_chat_id, dest_thread_id, src_msg, do_translate=False)
-        return
+        return await copy_with_caption(context, dest_chat_id, dest_thread_id, src_msg, do_translate=False, plan=plan) is not None
 
     file_id = None
     is_voice = False
@@ -612,122 +1956,324 @@ async def replicate_audio_with_translation(
         is_voice = False
 
     if not file_id:
-        await copy_with_caption(context, dest_chat_id, dest_thread_id, src_msg, do_translate=do_translate)
-        return
-
-    transcript = ""
-    if OPENAI_API_KEY:
-        try:
-            tg_file = await context.bot.get_file(file_id)
-            audio_bytes = bytes(await tg_file.download_as_bytearray())
-
-            filename = "audio.ogg"
-            mime = "audio/ogg"
-            language_hint = SOURCE_LANG or None
-            try:
-                if src_msg.voice:
-                    filename = "voice.ogg"
-                    mime = "audio/ogg"
-                elif src_msg.audio:
-                    filename = (src_msg.audio.file_name or "audio")
-                    mime = (src_msg.audio.mime_type or "audio/mpeg")
-                elif src_msg.document:
-                    filename = (getattr(src_msg.document, "file_name", None) or "audio")
-                    mime = (getattr(src_msg.document, "mime_type", None) or "application/octet-stream")
-            except Exception:
-                pass
-
-            transcript = await openai_transcribe(audio_bytes, filename, mime, language_hint=language_hint)
-        except Exception as e:
-            log.warning("Audio STT failed (msg %s): %s", src_msg.message_id, e)
-            transcript = ""
-
-    caption_text = ""
-    if transcript.strip():
-        try:
-            timeout = aiohttp.ClientTimeout(total=45)
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                caption_text = await deepl_translate(transcript.strip(), session=session)
-        except Exception as e:
-            log.warning("Audio translate text failed (msg %s): %s", src_msg.message_id, e)
-            caption_text = ""
-
+        return await copy_with_caption(context, dest_chat_id, dest_thread_id, src_msg, do_translate=do_translate, plan=plan) is not None
+
+    plan = plan or RenderPlan(src_msg)
+    if AUDIO_ASYNC:
+        # Audio original ya (una llamada a Telegram); el caption llega después por edición
+        kb = await plan.keyboard(do_translate)
+        sent = await _send_audio_file(context, src_msg, dest_chat_id, dest_thread_id, file_id, is_voice,
+                                      caption=None, reply_markup=kb, plan=plan)
+        if sent is not None and OPENAI_API_KEY:
+            AUDIO_POOL.submit(lambda: attach_audio_caption(context, plan, src_msg, dest_chat_id, dest_thread_id,
+                                                          sent.message_id, kb))
+        return sent is not None
+
+    caption_text = await plan.audio_caption(context)
+    kb = await plan.keyboard(do_translate)
+    sent = await _send_audio_file(context, src_msg, dest_chat_id, dest_thread_id, file_id, is_voice,
+                                  caption=(caption_text[:1024] if caption_text else None), reply_markup=kb, plan=plan)
+    return sent is not None
+
+
+async def _send_audio_file(
+    context: ContextTypes.DEFAULT_TYPE,
+    src_msg: Message,
+    dest_chat_id: int | str,
+    dest_thread_id: Optional[int],
+    file_id: str,
+    is_voice: bool,
+    *,
+    caption: Optional[str],
+    reply_markup: Optional[InlineKeyboardMarkup],
+    plan: "RenderPlan",
+) -> Optional[Message]:
     try:
-        kb = await translate_buttons(src_msg.reply_markup, do_translate=TRANSLATE_BUTTONS and do_translate)
         if is_voice:
-            await context.bot.send_voice(
+            sent = await context.bot.send_voice(
                 chat_id=dest_chat_id,
                 message_thread_id=dest_thread_id,
                 voice=file_id,
-                caption=(caption_text[:1024] if caption_text else None),
-                reply_markup=kb,
+                caption=caption,
+                reply_markup=reply_markup,
             )
         else:
-            await context.bot.send_audio(
+            sent = await context.bot.send_audio(
                 chat_id=dest_chat_id,
                 message_thread_id=dest_thread_id,
                 audio=file_id,
-                caption=(caption_text[:1024] if caption_text else None),
-                reply_markup=kb,
+                caption=caption,
+                reply_markup=reply_markup,
             )
     except Exception as e:
         log.warning("Audio send with caption failed (msg %s): %s. Falling back to copy_message.", src_msg.message_id, e)
-        await copy_with_caption(context, dest_chat_id, dest_thread_id, src_msg, do_translate=False)
-    return
+        sent = await copy_with_caption(context, dest_chat_id, dest_thread_id, src_msg, do_translate=False, plan=plan)
+    # El mapeo permite editar/responder al audio replicado (y lo usa el caption diferido)
+    if sent:
+        db_save_map(src_msg.chat.id, src_msg.message_id, dest_chat_id, sent.message_id)
+    return sent
+
+
+# ================== CACHÉ DE TRANSCRIPCIONES (file_unique_id) ==================
+# Clave = hash de (file_unique_id, modelo STT, pista de idioma, idioma destino): el mismo
+# audio reenviado, repetido o reintentado no vuelve a descargarse ni pasar por Whisper.
+# Se guarda {"transcript", "caption"} en la tabla audio_cache (misma LRU + SQLite que
+# la caché de traducción). Peticiones simultáneas del mismo audio comparten un único job.
+AUDIO_CACHE = os.getenv("AUDIO_CACHE", "true").lower() == "true"
+AUDIO_CACHE_MEM_MAX = int(os.getenv("AUDIO_CACHE_MEM_MAX", "500") or "500")
+AUDIO_CACHE_DB_MAX = int(os.getenv("AUDIO_CACHE_DB_MAX", "20000") or "20000")
+AUDIO_CACHE_TTL_SEC = float(os.getenv("AUDIO_CACHE_TTL_SEC", str(TRANSLATION_CACHE_TTL_SEC)) or "2592000")
+
+_ACACHE = TranslationCache(AUDIO_CACHE_MEM_MAX, AUDIO_CACHE_DB_MAX, AUDIO_CACHE_TTL_SEC, table="audio_cache")
+_AUDIO_INFLIGHT: Dict[str, "asyncio.Future[Dict[str, str]]"] = {}
+_AUDIO_COALESCED = [0]  # esperas que se engancharon a un job ya en vuelo
+
+
+def _acache_key(file_unique_id: str, language_hint: str) -> str:
+    raw = "\x1f".join([file_unique_id, OPENAI_STT_MODEL, (language_hint or "").lower(), TARGET_LANG])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _audio_source(src_msg: Message) -> Tuple[Any, str, str]:
+    """(objeto voice/audio, filename, mime) para mandar a Whisper."""
+    if getattr(src_msg, "voice", None):
+        return src_msg.voice, "voice.ogg", "audio/ogg"
+    if getattr(src_msg, "audio", None):
+        return src_msg.audio, (src_msg.audio.file_name or "audio"), (src_msg.audio.mime_type or "audio/mpeg")
+    return None, "", ""
+
+
+async def _transcribe_and_translate(
+    context: ContextTypes.DEFAULT_TYPE, media: Any, filename: str, mime: str, language_hint: str, key: str
+) -> Dict[str, str]:
+    with await download_telegram_file(context, media.file_id, max_bytes=audio_size_limit()) as audio:
+        transcript = await transcribe_audio(audio, filename, mime, language_hint=language_hint)
+    translated = await deepl_try_translate(transcript) if transcript else ""
+    result = {"transcript": transcript, "caption": transcript if translated is None else translated}
+    # Con DeepL caído el caption es el texto original: sirve esta vez, pero no se cachea
+    if AUDIO_CACHE and translated is not None:
+        _ACACHE.put(key, json.dumps(result, ensure_ascii=False))
+    return result
+
+
+async def transcribe_and_translate_audio(context: ContextTypes.DEFAULT_TYPE, src_msg: Message) -> str:
+    """
+    STT (Whisper) + DeepL del audio/nota de voz. Devuelve el caption traducido o "" si falla.
+    Cacheado por file_unique_id; los errores no se cachean (el siguiente intento reintenta).
+    """
+    media, filename, mime = _audio_source(src_msg)
+    if media is None or not OPENAI_API_KEY:
+        return ""
+    limit = audio_size_limit()
+    if media.file_size and media.file_size > limit:
+        log.info("Audio msg %s: %s bytes > límite %s, sin transcripción", src_msg.message_id, media.file_size, limit)
+        return ""
+
+    language_hint = SOURCE_LANG or ""
+    key = _acache_key(media.file_unique_id, language_hint)
+    if AUDIO_CACHE:
+        cached = await _ACACHE.get(key)
+        if cached is not None:
+            return json.loads(cached).get("caption", "")
+
+    fut = _AUDIO_INFLIGHT.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(_transcribe_and_translate(context, media, filename, mime, language_hint, key))
+        _AUDIO_INFLIGHT[key] = fut
+        fut.add_done_callback(lambda f: _AUDIO_INFLIGHT.pop(key, None) if _AUDIO_INFLIGHT.get(key) is f else None)
+    else:
+        _AUDIO_COALESCED[0] += 1
+    try:
+        return (await asyncio.shield(fut))["caption"]
+    except Exception as e:
+        log.warning("Audio STT/translate failed (msg %s): %s", src_msg.message_id, e)
+        return ""
+# ================== AUDIO ASÍNCRONO (caption diferido) ==================
+# AUDIO_ASYNC=true: el audio original sale al momento por file_id y el STT + DeepL
+# corre en un pool acotado (AUDIO_WORKERS). Al terminar, edit_message_caption sobre
+# el mensaje del destino (entrada de msg_map). La entrega del audio ya no espera a
+# OpenAI. Si la cola (AUDIO_QUEUE_MAX) está llena, el audio queda sin caption.
+# Al apagar (post_stop, con el bot aún operativo) se espera hasta AUDIO_DRAIN_SEC a
+# que terminen los captions pendientes; lo que quede se cancela y esos audios se
+# quedan sin caption (la cola vive en memoria, no en el outbox).
+AUDIO_ASYNC = os.getenv("AUDIO_ASYNC", "false").lower() == "true"
+AUDIO_WORKERS = int(os.getenv("AUDIO_WORKERS", "2") or "2")
+AUDIO_QUEUE_MAX = int(os.getenv("AUDIO_QUEUE_MAX", "200") or "200")
+AUDIO_DRAIN_SEC = float(os.getenv("AUDIO_DRAIN_SEC", "30") or "0")
+
+
+class AudioCaptionPool:
+    def __init__(self, workers: int, queue_max: int):
+        self.workers = max(1, workers)
+        self.queue_max = max(1, queue_max)
+        self._q: Optional["asyncio.Queue[Callable[[], Awaitable[Any]]]"] = None
+        self._tasks: List["asyncio.Task[Any]"] = []
+        self._running = 0
+        self.done = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def _ensure_started(self):
+        if self._q is None:
+            self._q = asyncio.Queue(self.queue_max)
+        self._tasks = [t for t in self._tasks if not t.done()]
+        while len(self._tasks) < self.workers:
+            # Contexto vacío: si no, el worker heredaría el del primer submit
+            # (_METRIC_LABELS, _OUTBOX_JOB de ese mensaje) para siempre
+            self._tasks.append(contextvars.Context().run(asyncio.create_task, self._worker()))
+
+    def submit(self, factory: Callable[[], Awaitable[Any]]) -> bool:
+        self._ensure_started()
+        try:
+            self._q.put_nowait(factory)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            log.warning("[audio] cola de captions llena (%s): audio sin caption", self.queue_max)
+            return False
+
+    async def _worker(self):
+        while True:
+            factory = await self._q.get()
+            self._running += 1
+            try:
+                # Cada job en su propio contexto: lo que fije (etiquetas de métricas) no pasa al siguiente
+                await contextvars.Context().run(asyncio.ensure_future, factory())
+                self.done += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                log.warning("[audio] caption diferido falló: %s", e)
+            finally:
+                self._running -= 1
+                self._q.task_done()
+
+    def pending(self) -> int:
+        return (self._q.qsize() if self._q is not None else 0) + self._running
+
+    async def join(self):
+        if self._q is not None:
+            await self._q.join()
+
+    async def drain(self, timeout: float) -> bool:
+        """Espera como mucho timeout s a que terminen los captions en cola y en curso."""
+        if self._q is None or not self.pending():
+            return True
+        log.info("[audio] esperando %s captions pendientes (máx %gs)", self.pending(), timeout)
+        try:
+            await asyncio.wait_for(self._q.join(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            log.warning("[audio] %s captions sin terminar tras %gs: se cancelan al cerrar", self.pending(), timeout)
+            return False
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        for t in self._tasks:
+            try:
+                await t
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._tasks = []
+        self._q = None
+
+
+AUDIO_POOL = AudioCaptionPool(AUDIO_WORKERS, AUDIO_QUEUE_MAX)
+
+
+@timed_stage("attach_audio_caption", kind="audio")
+async def attach_audio_caption(
+    context: ContextTypes.DEFAULT_TYPE,
+    plan: "RenderPlan",
+    src_msg: Message,
+    dest_chat_id: int | str,
+    dest_thread_id: Optional[int],
+    sent_msg_id: int,
+    kb: Optional[InlineKeyboardMarkup],
+):
+    _METRIC_LABELS.set((metric_route(src_msg.chat.id, src_msg.message_thread_id, dest_chat_id, dest_thread_id), "audio"))
+    caption_text = await plan.audio_caption(context)
+    if not caption_text:
+        return
+    dst_msg_id = sent_msg_id
+    if isinstance(dest_chat_id, int):
+        dst_msg_id = await db_get_dst_msg(src_msg.chat.id, src_msg.message_id, dest_chat_id) or sent_msg_id
+    await call_with_retry(
+        "edit_message_caption_audio",
+        lambda: context.bot.edit_message_caption(
+            chat_id=dest_chat_id,
+            message_id=dst_msg_id,
+            caption=caption_text[:1024],
+            reply_markup=kb,  # sin esto la edición quitaría el teclado
+        ),
+    )
+
+
 # ================== TRADUCCIÓN VISIBLE ==================
+@timed_stage("translate_visible_html")
 async def translate_visible_html(text: str, entities: List[MessageEntity]) -> Tuple[str, List[MessageEntity]]:
     """
     Traduce preservando formato y links bonitos:
     - Entities -> HTML (<a href="...">texto</a>, <b>, etc.)
     - DeepL traduce el HTML completo (tag_handling=xml) preservando href.
     """
-    html_in = build_html(entities_to_html(text or "", entities or []))
-    timeout = aiohttp.ClientTimeout(total=45)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        html_out = await deepl_translate_markup(html_in, session=session)
+    html_in = render_html(text, entities)
+    html_out = await deepl_translate_markup(html_in)
     return html_out, []
 def build_html_no_translate(text: str, entities: List[MessageEntity]) -> str:
-    return build_html(entities_to_html(text, entities or []))
+    return render_html(text, entities)
 
 
+@timed_stage("translate_buttons")
 async def translate_buttons(markup: Optional[InlineKeyboardMarkup], *, do_translate: bool) -> Optional[InlineKeyboardMarkup]:
     if not markup or not TRANSLATE_BUTTONS or not getattr(markup, "inline_keyboard", None):
         return markup
     if not do_translate:
         return markup
-    timeout = aiohttp.ClientTimeout(total=30)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        rows: List[List[InlineKeyboardButton]] = []
-        for row in markup.inline_keyboard:
-            new_row: List[InlineKeyboardButton] = []
-            for b in row:
-                label = await deepl_translate(b.text or "", session=session)
-                new_row.append(
-                    InlineKeyboardButton(
-                        text=(label or "")[:64],
-                        url=b.url,
-                        callback_data=b.callback_data,
-                        switch_inline_query=b.switch_inline_query,
-                        switch_inline_query_current_chat=b.switch_inline_query_current_chat,
-                        web_app=getattr(b, "web_app", None),
-                        login_url=getattr(b, "login_url", None),
-                    )
+    # Todas las etiquetas a la vez: el batcher las junta en una sola petición DeepL
+    labels = await asyncio.gather(*[
+        deepl_translate(b.text or "", as_markup=True) for row in markup.inline_keyboard for b in row
+    ])
+    it = iter(labels)
+    rows: List[List[InlineKeyboardButton]] = []
+    for row in markup.inline_keyboard:
+        new_row: List[InlineKeyboardButton] = []
+        for b in row:
+            label = next(it)
+            new_row.append(
+                InlineKeyboardButton(
+                    text=(label or "")[:64],
+                    url=b.url,
+                    callback_data=b.callback_data,
+                    switch_inline_query=b.switch_inline_query,
+                    switch_inline_query_current_chat=b.switch_inline_query_current_chat,
+                    web_app=getattr(b, "web_app", None),
+                    login_url=getattr(b, "login_url", None),
                 )
-            rows.append(new_row)
-        return InlineKeyboardMarkup(rows)
+            )
+        rows.append(new_row)
+    return InlineKeyboardMarkup(rows)
 
 
 # ================== MAPEO DE REPLY/EDITS (SQLite persistente) ==================
 DATA_DIR = Path(os.getenv("DATA_DIR", "/app/data"))
 DB_PATH = Path(os.getenv("REPL_DB_PATH", str(DATA_DIR / "replicator_map.db")))
 
+DB_FLUSH_INTERVAL_MS = float(os.getenv("DB_FLUSH_INTERVAL_MS", "50") or "50")
+DB_FLUSH_BATCH_MAX = int(os.getenv("DB_FLUSH_BATCH_MAX", "500") or "500")
+MSG_MAP_CACHE_MAX = int(os.getenv("MSG_MAP_CACHE_MAX", "5000") or "5000")
+
 _DB_CONN: Optional[sqlite3.Connection] = None
 
 
 def db_init():
-    global _DB_CONN
+    global _DB_CONN, MSG_MAP
     DATA_DIR.mkdir(parents=True, exist_ok=True)
     _DB_CONN = sqlite3.connect(str(DB_PATH), check_same_thread=False)
+    _DB_CONN.execute("PRAGMA journal_mode=WAL")
+    _DB_CONN.execute("PRAGMA synchronous=NORMAL")
     _DB_CONN.execute("""
         CREATE TABLE IF NOT EXISTS msg_map (
             src_chat INTEGER NOT NULL,
@@ -738,36 +2284,328 @@ def db_init():
         )
     """)
     _DB_CONN.execute("CREATE INDEX IF NOT EXISTS idx_src ON msg_map (src_chat, src_msg)")
+    _DB_CONN.execute("""
+        CREATE TABLE IF NOT EXISTS translation_cache (
+            key        TEXT PRIMARY KEY,
+            value      TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+    _DB_CONN.execute("CREATE INDEX IF NOT EXISTS idx_tcache_created ON translation_cache (created_at)")
+    _DB_CONN.execute("""
+        CREATE TABLE IF NOT EXISTS audio_cache (
+            key        TEXT PRIMARY KEY,
+            value      TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+    _DB_CONN.execute("CREATE INDEX IF NOT EXISTS idx_acache_created ON audio_cache (created_at)")
+    _DB_CONN.execute("""
+        CREATE TABLE IF NOT EXISTS dedup_seen (
+            key     TEXT PRIMARY KEY,
+            seen_at REAL NOT NULL
+        )
+    """)
+    for table, extra in (("outbox", ""), ("outbox_dead", ", dead_at REAL NOT NULL")):
+        _DB_CONN.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                idem_key     TEXT PRIMARY KEY,
+                kind         TEXT NOT NULL,
+                src_chat     INTEGER NOT NULL,
+                src_msg      INTEGER NOT NULL,
+                dst_chat     TEXT NOT NULL,
+                dst_thread   INTEGER,
+                do_translate INTEGER NOT NULL,
+                payload      TEXT NOT NULL,
+                attempts     INTEGER NOT NULL DEFAULT 0,
+                next_at      REAL NOT NULL,
+                dst_msg      INTEGER,
+                last_error   TEXT,
+                created_at   REAL NOT NULL{extra}
+            )
+        """)
+    _DB_CONN.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_at)")
     _DB_CONN.commit()
+    if DEDUP_PERSIST:
+        dedup_load(_DB_CONN)
+
+    if MSG_MAP is None:
+        MSG_MAP = MsgMapStore(DB_PATH, DB_FLUSH_INTERVAL_MS / 1000.0, DB_FLUSH_BATCH_MAX, MSG_MAP_CACHE_MAX)
+        MSG_MAP.start()
+
+
+def db_close():
+    global MSG_MAP
+    if MSG_MAP is not None:
+        MSG_MAP.close()
+        MSG_MAP = None
+
+
+class MsgMapStore:
+    """
+    msg_map detrás de un store asíncrono:
+      - escrituras: cola en memoria → hilo escritor que agrupa filas y hace UNA
+        transacción por lote (WAL + synchronous=NORMAL, sin fsync por fila)
+      - lecturas: hilo lector con su propia conexión, sin bloquear el event loop
+      - overlay `_pending`: lo encolado y aún no commiteado se lee desde memoria
+      - close(): vacía la cola antes de salir (flush garantizado en shutdown)
+      - LRU por (src_chat, src_msg) con TODOS sus destinos: replies/edits recientes
+        se resuelven como lookup en dict; se llena al escribir y en cada miss
+    """
+
+    _STOP = object()
+    _BARRIER = "__barrier__"
+    _MAP_SQL = "INSERT OR REPLACE INTO msg_map (src_chat, src_msg, dst_chat, dst_msg) VALUES (?, ?, ?, ?)"
+
+    def __init__(self, path: Path, flush_interval_sec: float, batch_max: int, cache_max: int = 5000):
+        self.path = path
+        self.flush_interval_sec = flush_interval_sec
+        self.batch_max = max(1, batch_max)
+        self._q: "queue.Queue[Any]" = queue.Queue()
+        self._pending: Dict[Tuple[int, int, int], int] = {}
+        self._pending_lock = threading.Lock()
+        self._writer = threading.Thread(target=self._writer_loop, name="msgmap-writer", daemon=True)
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="msgmap-reader")
+        self._reader_conn: Optional[sqlite3.Connection] = None
+        # (src_chat, src_msg) -> (completo, {dst_chat: dst_msg}); "completo" = ya se cargó de SQLite
+        self._lru: "OrderedDict[Tuple[int, int], Tuple[bool, Dict[int, int]]]" = OrderedDict()
+        self.cache_max = max(1, cache_max)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.flushed_rows = 0
+        self.flushes = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def start(self):
+        if not self._writer.is_alive():
+            self._writer.start()
+
+    def save(self, src_chat: int, src_msg: int, dst_chat: int, dst_msg: int):
+        row = (int(src_chat), int(src_msg), int(dst_chat), int(dst_msg))
+        with self._pending_lock:
+            self._pending[row[:3]] = row[3]
+        complete, dsts = self._lru.get(row[:2], (False, {}))
+        dsts[row[2]] = row[3]
+        self._lru_put(row[:2], complete, dsts)
+        self._q.put((self._MAP_SQL, row))
+
+    def execute_later(self, sql: str, params: Tuple[Any, ...]):
+        """Escritura genérica por el mismo hilo/lote (p. ej. dedup_seen)."""
+        self._q.put((sql, params))
+
+    async def flush(self):
+        """Espera a que todo lo encolado hasta ahora esté commiteado."""
+        if not self._writer.is_alive():
+            return
+        fut: "concurrent.futures.Future[None]" = concurrent.futures.Future()
+        self._q.put((self._BARRIER, fut))
+        await asyncio.wrap_future(fut)
+
+    def after_commit(self, callback: Callable[[], Any]):
+        """Llama a callback (en el event loop) cuando lo encolado hasta ahora esté commiteado."""
+        if not self._writer.is_alive():
+            callback()
+            return
+        loop = asyncio.get_running_loop()
+        fut: "concurrent.futures.Future[None]" = concurrent.futures.Future()
 
+        def _done(_f: "concurrent.futures.Future[None]"):
+            try:
+                loop.call_soon_threadsafe(callback)
+            except RuntimeError:  # loop ya cerrado (apagado)
+                pass
+
+        fut.add_done_callback(_done)
+        self._q.put((self._BARRIER, fut))
+
+    async def query(self, sql: str, params: Tuple[Any, ...] = ()) -> List[Tuple[Any, ...]]:
+        """Lectura genérica en el hilo lector (no bloquea el event loop)."""
+        return await asyncio.get_running_loop().run_in_executor(self._reader, self._query, sql, params)
+
+    def _query(self, sql: str, params: Tuple[Any, ...]) -> List[Tuple[Any, ...]]:
+        if self._reader_conn is None:
+            self._reader_conn = self._connect()
+        return self._reader_conn.execute(sql, params).fetchall()
+
+    def _lru_put(self, key: Tuple[int, int], complete: bool, dsts: Dict[int, int]):
+        self._lru[key] = (complete, dsts)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.cache_max:
+            self._lru.popitem(last=False)
+
+    async def get_all(self, src_chat: int, src_msg: int) -> Dict[int, int]:
+        """Todos los destinos {dst_chat: dst_msg} de un mensaje origen."""
+        key = (int(src_chat), int(src_msg))
+        entry = self._lru.get(key)
+        if entry is not None and entry[0]:
+            self._lru.move_to_end(key)
+            self.cache_hits += 1
+            return dict(entry[1])
+        self.cache_misses += 1
+        rows = await asyncio.get_running_loop().run_in_executor(self._reader, self._read_all, key)
+        # Lo escrito mientras leíamos (cache/overlay) gana sobre SQLite
+        dsts = dict(rows)
+        entry = self._lru.get(key)
+        if entry is not None:
+            dsts.update(entry[1])
+        with self._pending_lock:
+            for (sc, sm, dc), dm in self._pending.items():
+                if (sc, sm) == key:
+                    dsts[dc] = dm
+        self._lru_put(key, True, dsts)
+        return dict(dsts)
+
+    async def get(self, src_chat: int, src_msg: int, dst_chat: int) -> Optional[int]:
+        entry = self._lru.get((int(src_chat), int(src_msg)))
+        if entry is not None and int(dst_chat) in entry[1]:
+            self._lru.move_to_end((int(src_chat), int(src_msg)))
+            self.cache_hits += 1
+            return entry[1][int(dst_chat)]
+        return (await self.get_all(src_chat, src_msg)).get(int(dst_chat))
+
+    def _read_all(self, key: Tuple[int, int]) -> List[Tuple[int, int]]:
+        if self._reader_conn is None:
+            self._reader_conn = self._connect()
+        rows = self._reader_conn.execute(
+            "SELECT dst_chat, dst_msg FROM msg_map WHERE src_chat=? AND src_msg=?", key
+        ).fetchall()
+        return [(int(dc), int(dm)) for dc, dm in rows]
+
+    def writer_alive(self) -> bool:
+        return self._writer.is_alive()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.cache_hits + self.cache_misses
+        return {
+            "cache_size": len(self._lru),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+            "hit_rate": round(self.cache_hits / total, 3) if total else 0.0,
+            "pending": self._q.qsize(),
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+        }
+
+    def _writer_loop(self):
+        conn = self._connect()
+        stop = False
+        while not stop:
+            item = self._q.get()
+            batch: List[Tuple[str, Tuple[Any, ...]]] = []
+            if item is self._STOP:
+                stop = True
+            else:
+                batch.append(item)
+            deadline = time.monotonic() + self.flush_interval_sec
+            while not stop and len(batch) < self.batch_max:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stop = True
+                else:
+                    batch.append(item)
+            if batch:
+                barriers = [p for sql, p in batch if sql == self._BARRIER]
+                rows = [it for it in batch if it[0] != self._BARRIER]
+                if rows:
+                    self._write_batch(conn, rows)
+                for fut in barriers:
+                    fut.set_result(None)
+        conn.close()
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: List[Tuple[str, Tuple[Any, ...]]]):
+        # Una transacción por lote; un executemany por cada tramo consecutivo de la
+        # misma sentencia (se respeta el orden: INSERT → UPDATE → DELETE de un job)
+        runs: List[Tuple[str, List[Tuple[Any, ...]]]] = []
+        for sql, params in batch:
+            if runs and runs[-1][0] == sql:
+                runs[-1][1].append(params)
+            else:
+                runs.append((sql, [params]))
+        try:
+            with conn:
+                for sql, rows in runs:
+                    conn.executemany(sql, rows)
+            self.flushes += 1
+            self.flushed_rows += len(batch)
+        except Exception as e:
+            log.warning("db write batch (%s filas) failed: %s", len(batch), e)
+        with self._pending_lock:
+            for sql, rows in runs:
+                if sql != self._MAP_SQL:
+                    continue
+                for row in rows:
+                    if self._pending.get(row[:3]) == row[3]:
+                        self._pending.pop(row[:3], None)
+
+    def close(self, timeout: float = 10.0):
+        if self._writer.is_alive():
+            self._q.put(self._STOP)
+            self._writer.join(timeout)
+        self._reader.shutdown(wait=True)
+        if self._reader_conn is not None:
+            self._reader_conn.close()
+            self._reader_conn = None
+
+
+MSG_MAP: Optional[MsgMapStore] = None
+
+
+def db_save_map(src_chat: int, src_msg: int, dst_chat: Any, dst_msg: int):
+    """No bloquea: encola la fila; el hilo escritor la persiste en lote.
 
-def db_save_map(src_chat: int, src_msg: int, dst_chat: int, dst_msg: int):
-    if not _DB_CONN:
+    Los destinos @username no tienen fila en msg_map (sin id numérico), pero
+    igual marcan el job del outbox como entregado.
+    """
+    if not MSG_MAP:
         db_init()
     try:
-        _DB_CONN.execute(
-            "INSERT OR REPLACE INTO msg_map (src_chat, src_msg, dst_chat, dst_msg) VALUES (?, ?, ?, ?)",
-            (int(src_chat), int(src_msg), int(dst_chat), int(dst_msg))
-        )
-        _DB_CONN.commit()
+        with stage_timer("db_save_map"):
+            if isinstance(dst_chat, int):
+                MSG_MAP.save(src_chat, src_msg, dst_chat, dst_msg)
+            outbox_note_delivered(src_chat, src_msg, dst_chat, dst_msg)
     except Exception as e:
         log.warning("db_save_map failed: %s", e)
 
 
-def db_get_dst_msg(src_chat: int, src_msg: int, dst_chat: int) -> Optional[int]:
-    if not _DB_CONN:
+def db_execute_later(sql: str, params: Tuple[Any, ...]):
+    if not MSG_MAP:
         db_init()
     try:
-        cur = _DB_CONN.execute(
-            "SELECT dst_msg FROM msg_map WHERE src_chat=? AND src_msg=? AND dst_chat=? LIMIT 1",
-            (int(src_chat), int(src_msg), int(dst_chat))
-        )
-        row = cur.fetchone()
-        return int(row[0]) if row else None
+        MSG_MAP.execute_later(sql, params)
+    except Exception as e:
+        log.warning("db_execute_later failed: %s", e)
+
+
+@timed_stage("db_get_dst_msg")
+async def db_get_dst_msg(src_chat: int, src_msg: int, dst_chat: int) -> Optional[int]:
+    if not MSG_MAP:
+        db_init()
+    try:
+        return await MSG_MAP.get(src_chat, src_msg, dst_chat)
     except Exception:
         return None
 
 
+async def db_get_dst_msgs(src_chat: int, src_msg: int) -> Dict[int, int]:
+    if not MSG_MAP:
+        db_init()
+    try:
+        return await MSG_MAP.get_all(src_chat, src_msg)
+    except Exception:
+        return {}
+
+
 # ================== PREFIJO "👤 Nombre:" ==================
 def sender_display_name(msg: Message) -> str:
     # Anonymous admin / sender_chat
@@ -869,15 +2707,19 @@ async def call_with_retry(
     last_exc: Exception | None = None
     for i in range(1, tries + 1):
         try:
-            return await fn()
+            with stage_timer(f"call_with_retry:{label}"):
+                return await fn()
         except RetryAfter as e:
             last_exc = e
             wait_s = float(getattr(e, "retry_after", 1.0))
+            RETRIES.inc(label=label, reason="retry_after")
+            RETRY_AFTER_SECONDS.inc(wait_s, label=label)
             log.warning("[%s] RetryAfter %ss (intento %s/%s)", label, wait_s, i, tries)
             await asyncio.sleep(wait_s + 0.2)
         except (TimedOut, NetworkError) as e:
             last_exc = e
             wait = base_delay * (2 ** (i - 1))
+            RETRIES.inc(label=label, reason="network")
             log.warning("[%s] Timeout/NetworkError (intento %s/%s). Esperando %.1fs. Err=%s", label, i, tries, wait, e)
             await asyncio.sleep(wait)
         except BadRequest as e:
@@ -889,6 +2731,7 @@ async def call_with_retry(
         except Exception as e:
             last_exc = e
             wait = base_delay * (2 ** (i - 1))
+            RETRIES.inc(label=label, reason="error")
             log.warning("[%s] Error inesperado (intento %s/%s). Esperando %.1fs. Err=%s", label, i, tries, wait, e)
             await asyncio.sleep(wait)
 
@@ -896,6 +2739,123 @@ async def call_with_retry(
         raise last_exc
 
 
+# ================== RATE LIMIT PROACTIVO (token buckets) ==================
+# Modela los límites de Telegram antes de que nos frenen: ~30 msg/s global y
+# ~20 msg/min por grupo/canal (1 msg/s en privados). Los envíos esperan en cola
+# FIFO por su bucket en vez de chocar con RetryAfter y dormir dentro de call_with_retry.
+TG_RATE_LIMIT = os.getenv("TG_RATE_LIMIT", "true").lower() == "true"
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30") or "30")  # msg/s
+TG_GROUP_RATE_PER_MIN = float(os.getenv("TG_GROUP_RATE_PER_MIN", "20") or "20")
+TG_GROUP_BURST = float(os.getenv("TG_GROUP_BURST", "20") or "20")
+TG_PRIVATE_RATE = float(os.getenv("TG_PRIVATE_RATE", "1") or "1")  # msg/s
+TG_RL_MAX_RETRIES = int(os.getenv("TG_RL_MAX_RETRIES", "2") or "2")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = max(rate, 1e-6)
+        self.capacity = max(capacity, 1.0)
+        self.tokens = self.capacity
+        self.paused_until = 0.0
+        self._ts = time.monotonic()
+        self._lock = asyncio.Lock()  # FIFO: los que esperan salen en orden
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._ts) * self.rate)
+        self._ts = now
+
+    def level(self) -> float:
+        self._refill(time.monotonic())
+        return self.tokens
+
+    def idle(self) -> bool:
+        return not self._lock.locked() and self.level() >= self.capacity
+
+    async def acquire(self, cost: float = 1.0):
+        cost = min(cost, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                await asyncio.sleep((cost - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Telegram nos frenó igual: vaciamos el bucket y lo congelamos `seconds`."""
+        self._refill(time.monotonic())
+        self.tokens = 0.0
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class BucketRateLimiter(BaseRateLimiter):
+    def __init__(self):
+        self._global = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self._chats: Dict[Any, TokenBucket] = {}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def _chat_bucket(self, chat_id: Any) -> TokenBucket:
+        b = self._chats.get(chat_id)
+        if b is not None:
+            return b
+        if len(self._chats) > 512:
+            for k, v in list(self._chats.items()):
+                if v.idle():
+                    self._chats.pop(k, None)
+        if (isinstance(chat_id, int) and chat_id < 0) or isinstance(chat_id, str):
+            b = TokenBucket(TG_GROUP_RATE_PER_MIN / 60.0, TG_GROUP_BURST)
+        else:
+            b = TokenBucket(TG_PRIVATE_RATE, 1.0)
+        self._chats[chat_id] = b
+        return b
+
+    def levels(self) -> Dict[str, Any]:
+        return {
+            "global": round(self._global.level(), 2),
+            "chats": {k: round(v.level(), 2) for k, v in self._chats.items()},
+        }
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        if chat_id is None:
+            return await callback(*args, **kwargs)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+
+        # Un álbum cuenta como un mensaje por ítem
+        cost = float(len(data.get("media") or [])) if endpoint == "sendMediaGroup" else 1.0
+        cost = max(cost, 1.0)
+        bucket = self._chat_bucket(chat_id)
+        retries = rate_limit_args if isinstance(rate_limit_args, int) else TG_RL_MAX_RETRIES
+        for i in range(retries + 1):
+            await bucket.acquire(cost)
+            await self._global.acquire(1.0)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                wait_s = float(getattr(e, "retry_after", 1.0))
+                RETRIES.inc(label=f"ratelimit:{endpoint}", reason="retry_after")
+                RETRY_AFTER_SECONDS.inc(wait_s, label=f"ratelimit:{endpoint}")
+                log.warning("[ratelimit] RetryAfter %ss en chat %s (%s)", wait_s, chat_id, endpoint)
+                bucket.pause(wait_s + 0.2)
+                if i == retries:
+                    raise
+
+
+RATE_LIMITER: Optional[BucketRateLimiter] = BucketRateLimiter() if TG_RATE_LIMIT else None
+
+
 # ================== HELPERS REPLY/LOOP ==================
 def is_from_bot(msg: Message, context: ContextTypes.DEFAULT_TYPE) -> bool:
     try:
@@ -906,64 +2866,160 @@ def is_from_bot(msg: Message, context: ContextTypes.DEFAULT_TYPE) -> bool:
     return False
 
 
-def resolve_reply_to_id(src_msg: Message, dst_chat: int) -> Optional[int]:
+async def resolve_reply_to_id(src_msg: Message, dst_chat: int) -> Optional[int]:
     try:
         r = getattr(src_msg, "reply_to_message", None)
         if not r:
             return None
-        return db_get_dst_msg(src_msg.chat.id, r.message_id, dst_chat)
+        return await db_get_dst_msg(src_msg.chat.id, r.message_id, dst_chat)
     except Exception:
         return None
 
 
 
 # ================== SPLIT SEGURO PARA MENSAJES HTML (evita romper <a href=...>) ==================
+# Una pasada por tokens (tag / entidad / tramo de texto). Se cuenta el texto VISIBLE
+# en unidades UTF-16 (lo que Telegram limita tras parsear el HTML), no el HTML crudo.
+_SPLIT_TOKEN_RE = re.compile(r"</?([A-Za-z][\w-]*)[^>]*>|&(?:#\d+|#[xX][0-9A-Fa-f]+|[A-Za-z]+);|[^<&]+|[<&]")
+# Preferencia de corte: párrafo > línea > frase > palabra (el match es el separador que se descarta)
+_SPLIT_BREAKS = (
+    re.compile(r"\n[ \t]*\n\s*"),
+    re.compile(r"\n\s*"),
+    re.compile(r"(?<=[.!?…])[\"')\]»]*\s+"),
+    re.compile(r"\s+"),
+)
+_EMPTY_TAG_RE = re.compile(r"<([A-Za-z][\w-]*)(?:\s[^>]*)?></\1>")
+_TEXT, _ATOM, _TAG = 0, 1, 2
+
+
 def split_html_safe(html_text: str, max_len: int) -> List[str]:
     """
-    Divide HTML en partes <= max_len sin partir dentro de tags.
-    Cortamos preferiblemente en saltos de línea fuera de etiquetas.
+    Divide HTML de Telegram en partes de como mucho max_len unidades UTF-16 de texto
+    visible. Nunca corta dentro de un tag o entidad; los tags abiertos se cierran al
+    final de cada parte y se reabren al principio de la siguiente.
     """
     s = html_text or ""
-    if len(s) <= max_len:
+    if _u16len(s) <= max_len:  # el texto visible nunca es más largo que el HTML
         return [s]
 
-    parts: List[str] = []
-    buf: List[str] = []
-    inside_tag = False
-    last_safe_break = -1
-    current_len = 0
-
-    for ch in s:
-        buf.append(ch)
-        current_len += 1
-
-        if ch == "<":
-            inside_tag = True
-        elif ch == ">" and inside_tag:
-            inside_tag = False
-
-        if (ch == "\n") and (not inside_tag):
-            last_safe_break = len(buf)
-
-        if current_len >= max_len:
-            if last_safe_break > 0:
-                part = "".join(buf[:last_safe_break]).rstrip()
-                parts.append(part)
-                buf = buf[last_safe_break:]
-                current_len = len(buf)
-                last_safe_break = -1
+    parts: List[str] = []
+    # item = (tipo, token, nombre_tag, es_cierre); pieza = (item, vis_inicio, pila_vigente)
+    chunk: List[Tuple[Tuple[int, str, str, bool], int, tuple]] = []
+    opened: tuple = ()  # tags abiertos al empezar la parte actual
+    stack: List[Tuple[str, str]] = []
+    stack_t: tuple = ()
+    vis = 0
+    min_fill = max_len // 2
+    queue: List[Tuple[int, str, str, bool]] = []  # items a re-procesar tras un corte (LIFO)
+    tokens = _SPLIT_TOKEN_RE.finditer(s)
+
+    def last_break(pieces, rx, floor: int) -> Optional[Tuple[int, int, int, int]]:
+        for j in range(len(pieces) - 1, -1, -1):
+            (kind, tok, _, _), v0, _ = pieces[j]
+            if kind != _TEXT:
+                continue
+            if v0 + _u16len(tok) < floor:
+                return None
+            last = None
+            for mt in rx.finditer(tok):
+                last = mt
+            if last is not None:
+                pos = v0 + _u16len(tok[:last.start()])
+                if pos > 0 and pos >= floor:
+                    return (j, last.start(), last.end(), pos)
+        return None
+
+    def find_cut(pieces) -> Optional[Tuple[int, int, int, int]]:
+        # Mejor nivel que deje la parte al menos medio llena; si no, la última palabra
+        for rx in _SPLIT_BREAKS:
+            found = last_break(pieces, rx, min_fill)
+            if found:
+                return found
+        return last_break(pieces, _SPLIT_BREAKS[-1], 1)
+
+    def emit(body: str, close: tuple):
+        out = "".join(t for _, t in opened) + body + "".join(f"</{n}>" for n, _ in reversed(close))
+        prev = None
+        while prev != out:
+            prev, out = out, _EMPTY_TAG_RE.sub("", out)
+        if _strip_tags(out).strip():
+            parts.append(out)
+
+    while True:
+        if queue:
+            item = queue.pop()
+        else:
+            mt = next(tokens, None)
+            if mt is None:
+                break
+            tok = mt.group(0)
+            c = tok[0]
+            if c != "<" and c != "&":
+                item = (_TEXT, tok, "", False)
+            elif len(tok) > 1 and c == "<":
+                item = (_TAG, tok, mt.group(1).lower(), tok[1] == "/")
+            else:
+                item = (_ATOM, tok, "", False)
+
+        kind, tok, name, closing = item
+        if kind == _TAG:
+            if closing:
+                if stack and stack[-1][0] == name:
+                    stack.pop()
+                else:
+                    names = [n for n, _ in stack]
+                    if name in names:
+                        del stack[len(names) - 1 - names[::-1].index(name):]
+                stack_t = tuple(stack)
+            else:
+                stack.append((name, tok))
+                stack_t = tuple(stack)
+            chunk.append((item, vis, stack_t))
+            continue
+
+        if kind == _TEXT:
+            v = len(tok) if tok.isascii() else len(tok.encode("utf-16-le")) // 2
+        else:
+            v = _u16len(html.unescape(tok))
+        if vis + v <= max_len:
+            chunk.append((item, vis, stack_t))
+            vis += v
+            continue
+
+        # No cabe: el tramo entrante participa como pieza virtual (solo lo que cabe)
+        pieces = chunk
+        head = ""
+        if kind == _TEXT:
+            head = _u16_prefix(tok, max_len - vis) or (tok[:1] if not chunk else "")
+            if head:
+                pieces = chunk + [((_TEXT, head, "", False), vis, stack_t)]
+        found = find_cut(pieces)
+        if found is None and head:
+            found = (len(pieces) - 1, len(head), len(head), max_len)  # corte duro
+        if found is None and not chunk:
+            chunk.append((item, vis, stack_t))  # no cabe ni sola: se deja pasar
+            vis += v
+            continue
+        if found is None:
+            emit("".join(p[0][1] for p in chunk), stack_t)
+            rest = [item]
+            close = stack_t
+        else:
+            j, a, b, _ = found
+            (_, ptok, _, _), _, close = pieces[j]
+            emit("".join(p[0][1] for p in pieces[:j]) + ptok[:a], close)
+            if head and j == len(pieces) - 1:
+                rest = [(_TEXT, tok[b:], "", False)]
             else:
-                part = "".join(buf).rstrip()
-                parts.append(part[:max_len])
-                rest = part[max_len:]
-                buf = [rest] if rest else []
-                current_len = len(rest)
-                last_safe_break = -1
-
-    tail = "".join(buf).strip()
-    if tail:
-        parts.append(tail)
-    return [p for p in parts if p]
+                rest = [(_TEXT, ptok[b:], "", False)] + [p[0] for p in chunk[j + 1:]] + [item]
+            rest = [r for r in rest if r[1]]
+        opened, stack, stack_t = close, list(close), close
+        chunk, vis = [], 0
+        queue.extend(reversed(rest))
+
+    if chunk:
+        emit("".join(p[0][1] for p in chunk), stack_t)
+    return parts
 
 async def send_html_message_in_chunks(
     context: ContextTypes.DEFAULT_TYPE,
@@ -1003,6 +3059,76 @@ async def send_html_message_in_chunks(
     return first_msg  # type: ignore
 # ================== FIN SPLIT SEGURO ==================
 
+# ================== PLAN DE RENDER (traducir 1 vez por mensaje) ==================
+class RenderPlan:
+    """
+    Variantes de render de un mensaje origen, calculadas como mucho una vez y
+    compartidas entre la ruta principal y todos los destinos fanout:
+      - HTML de texto/caption traducido y sin traducir
+      - teclado inline traducido
+      - caption de audio (STT + DeepL)
+    Si un cálculo falla, no se cachea el error: el siguiente destino reintenta.
+    """
+
+    def __init__(self, msg: Message):
+        self.msg = msg
+        self._jobs: Dict[Any, "asyncio.Future[Any]"] = {}
+        self._rich: Dict[str, RichText] = {}
+
+    async def _once(self, key: Any, factory: Callable[[], Awaitable[Any]]) -> Any:
+        fut = self._jobs.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(factory())
+            self._jobs[key] = fut
+        try:
+            return await asyncio.shield(fut)
+        except Exception:
+            if self._jobs.get(key) is fut:
+                self._jobs.pop(key, None)
+            raise
+
+    async def _render(self, text: str, entities: List[MessageEntity], translate: bool) -> str:
+        if translate:
+            html_out, _ = await translate_visible_html(text, entities)
+            return html_out
+        return build_html_no_translate(text, entities)
+
+    async def text_html(self, translate: bool) -> str:
+        translate = bool(translate and TRANSLATE)
+        return await self._once(
+            ("text", translate),
+            lambda: self._render(self.msg.text or "", self.msg.entities or [], translate),
+        )
+
+    async def caption_html(self, translate: bool) -> str:
+        translate = bool(translate and TRANSLATE)
+        return await self._once(
+            ("caption", translate),
+            lambda: self._render(self.msg.caption or "", self.msg.caption_entities or [], translate),
+        )
+
+    def rich(self, field: str) -> RichText:
+        """Texto o caption original como RichText (para mandarlo con entities, sin HTML)."""
+        rt = self._rich.get(field)
+        if rt is None:
+            if field == "text":
+                rt = RichText.from_entities(self.msg.text or "", self.msg.entities)
+            else:
+                rt = RichText.from_entities(self.msg.caption or "", self.msg.caption_entities)
+            self._rich[field] = rt
+        return rt
+
+    async def keyboard(self, translate: bool) -> Optional[InlineKeyboardMarkup]:
+        translate = bool(translate and TRANSLATE)
+        return await self._once(
+            ("keyboard", translate),
+            lambda: translate_buttons(self.msg.reply_markup, do_translate=translate),
+        )
+
+    async def audio_caption(self, context: ContextTypes.DEFAULT_TYPE) -> str:
+        return await self._once(("audio",), lambda: transcribe_and_translate_audio(context, self.msg))
+
+
 # ================== REPLICACIÓN ==================
 async def send_text(
     context: ContextTypes.DEFAULT_TYPE,
@@ -1012,17 +3138,32 @@ async def send_text(
     *,
     do_translate: bool,
     reply_to_message_id: Optional[int] = None,
+    plan: Optional[RenderPlan] = None,
 ) -> Optional[Message]:
+    plan = plan or RenderPlan(msg)
     name = sender_display_name(msg)
     pref = prefix_block(name)
 
-    if do_translate and TRANSLATE:
-        html_text, _ = await translate_visible_html(msg.text or "", msg.entities or [])
-    else:
-        html_text = build_html_no_translate(msg.text or "", msg.entities or [])
+    if not (do_translate and TRANSLATE):
+        # Sin traducir y en un solo mensaje: texto + entities, Telegram no parsea HTML
+        rt = plan.rich("text").with_prefix(pref)
+        if rt.u16len() <= 3900:
+            kb = await plan.keyboard(False)
+            return await call_with_retry(
+                "send_message_entities",
+                lambda: context.bot.send_message(
+                    chat_id=chat_id,
+                    message_thread_id=thread_id,
+                    text=rt.text,
+                    entities=rt.to_entities(),
+                    disable_web_page_preview=True,
+                    reply_markup=kb,
+                    reply_to_message_id=reply_to_message_id,
+                ),
+            )
 
-    html_text = pref + html_text
-    kb = await translate_buttons(msg.reply_markup, do_translate=do_translate and TRANSLATE)
+    body, kb = await asyncio.gather(plan.text_html(do_translate), plan.keyboard(do_translate))
+    html_text = pref + body
 
     # Telegram texto ~4096. Usamos 3900 por seguridad y para no romper links/HTML.
     sent = await send_html_message_in_chunks(
@@ -1045,21 +3186,34 @@ async def copy_with_caption(
     *,
     do_translate: bool,
     reply_to_message_id: Optional[int] = None,
+    plan: Optional[RenderPlan] = None,
 ) -> Optional[Message]:
+    plan = plan or RenderPlan(msg)
     name = sender_display_name(msg)
     pref = prefix_block(name)
 
     cap_text = msg.caption or ""
-    cap_entities = msg.caption_entities or []
 
-    if cap_text.strip():
-        if do_translate and TRANSLATE:
-            cap_html, _ = await translate_visible_html(cap_text, cap_entities)
-        else:
-            cap_html = build_html_no_translate(cap_text, cap_entities)
+    if cap_text.strip() and not (do_translate and TRANSLATE):
+        rt = plan.rich("caption").with_prefix(pref).truncate(1024)
+        kb = await plan.keyboard(False)
+        return await call_with_retry(
+            "copy_message_caption",
+            lambda: context.bot.copy_message(
+                chat_id=chat_id,
+                message_thread_id=thread_id,
+                from_chat_id=msg.chat.id,
+                message_id=msg.message_id,
+                caption=rt.text,
+                caption_entities=rt.to_entities(),
+                reply_markup=kb,
+                reply_to_message_id=reply_to_message_id,
+            ),
+        )
 
-        cap_html = cap_with_prefix(pref, cap_html, max_len=1024)
-        kb = await translate_buttons(msg.reply_markup, do_translate=do_translate and TRANSLATE)
+    if cap_text.strip():
+        cap_body, kb = await asyncio.gather(plan.caption_html(do_translate), plan.keyboard(do_translate))
+        cap_html = cap_with_prefix(pref, cap_body, max_len=1024)
 
         sent = await call_with_retry(
             "copy_message_caption",
@@ -1090,7 +3244,9 @@ async def copy_with_caption(
 
 
 # --------- SOPORTE DE ÁLBUM (media_group) ---------
-MEDIA_GROUP_BUFFER: Dict[Tuple[int, str, Any, Optional[int], bool], List[Message]] = {}
+# Cada item lleva el job del outbox que lo encoló: el flush lo cierra o lo reprograma
+MEDIA_GROUP_BUFFER: Dict[Tuple[int, str, Any, Optional[int], bool],
+                         List[Tuple[Message, RenderPlan, Optional["OutboxJob"]]]] = {}
 MEDIA_GROUP_TASKS: Dict[Tuple[int, str, Any, Optional[int], bool], Any] = {}
 MEDIA_GROUP_DELAY = 0.6  # segundos
 
@@ -1128,67 +3284,73 @@ def _msg_build_input_media(
     return None
 
 
+@timed_stage("_flush_media_group", kind="album")
 async def _flush_media_group(context: ContextTypes.DEFAULT_TYPE, key: Tuple[int, str, Any, Optional[int], bool]):
+    items = MEDIA_GROUP_BUFFER.pop(key, [])
+    MEDIA_GROUP_TASKS.pop(key, None)
+    jobs = [job for _, _, job in items if job is not None]
     try:
-        msgs = MEDIA_GROUP_BUFFER.pop(key, [])
-        MEDIA_GROUP_TASKS.pop(key, None)
-        if not msgs:
-            return
-
-        msgs.sort(key=lambda m: m.message_id)
-
-        _, _, dst_chat, dst_thread, do_translate = key
+        await _send_media_group(context, key, items)
+    except Exception as e:
+        log.exception("Error enviando media group %s: %s", key, e)
+        if not jobs:
+            await alert_error(context, f"media_group error: {e}")
+        # Cada miembro vuelve al outbox (reintento o dead-letter); se reagrupan al reenviarse
+        for job in jobs:
+            await OUTBOX_RUNNER.fail_deferred(job, e, context)
+        return
+    for job in jobs:
+        OUTBOX_RUNNER.finish_deferred(job)
 
-        cap_text = ""
-        cap_entities: List[MessageEntity] = []
-        first_src_msg: Optional[Message] = None
-        for m in msgs:
-            if (m.caption or "").strip():
-                cap_text = m.caption or ""
-                cap_entities = m.caption_entities or []
-                first_src_msg = m
-                break
 
-        first_caption_html: Optional[str] = None
-        if cap_text:
-            name = sender_display_name(first_src_msg or msgs[0])
-            pref = prefix_block(name)
-            if do_translate and TRANSLATE:
-                first_caption_html, _ = await translate_visible_html(cap_text, cap_entities)
-            else:
-                first_caption_html = build_html_no_translate(cap_text, cap_entities)
-            first_caption_html = cap_with_prefix(pref, first_caption_html, max_len=1024)
-
-        media_list: List[InputMediaPhoto | InputMediaVideo | InputMediaDocument | InputMediaAudio] = []
-        first_used = False
-        for m in msgs:
-            cap = first_caption_html if not first_used else None
-            im = _msg_build_input_media(m, caption_html=cap)
-            if im:
-                media_list.append(im)
-                if cap is not None:
-                    first_used = True
-
-        if not media_list:
-            return
+async def _send_media_group(
+    context: ContextTypes.DEFAULT_TYPE,
+    key: Tuple[int, str, Any, Optional[int], bool],
+    items: List[Tuple[Message, RenderPlan, Optional["OutboxJob"]]],
+):
+    if not items:
+        return
 
-        sent_msgs = await call_with_retry(
-            "send_media_group",
-            lambda: context.bot.send_media_group(
-                chat_id=dst_chat,
-                message_thread_id=dst_thread,
-                media=media_list,
-            ),
-        )
+    items.sort(key=lambda it: it[0].message_id)
+    msgs = [m for m, _, _ in items]
+
+    _, _, dst_chat, dst_thread, do_translate = key
+
+    first_caption_html: Optional[str] = None
+    for m, m_plan, _ in items:
+        if (m.caption or "").strip():
+            pref = prefix_block(sender_display_name(m))
+            first_caption_html = cap_with_prefix(pref, await m_plan.caption_html(do_translate), max_len=1024)
+            break
+
+    media_list: List[InputMediaPhoto | InputMediaVideo | InputMediaDocument | InputMediaAudio] = []
+    first_used = False
+    for m in msgs:
+        cap = first_caption_html if not first_used else None
+        im = _msg_build_input_media(m, caption_html=cap)
+        if im:
+            media_list.append(im)
+            if cap is not None:
+                first_used = True
+
+    if not media_list:
+        return
 
-        if sent_msgs and isinstance(sent_msgs, list) and isinstance(dst_chat, int):
-            for i, sm in enumerate(msgs):
-                if i < len(sent_msgs):
-                    db_save_map(sm.chat.id, sm.message_id, int(dst_chat), sent_msgs[i].message_id)
+    sent_msgs = await call_with_retry(
+        "send_media_group",
+        lambda: context.bot.send_media_group(
+            chat_id=dst_chat,
+            message_thread_id=dst_thread,
+            media=media_list,
+        ),
+    )
 
-    except Exception as e:
-        log.exception("Error enviando media group %s: %s", key, e)
-        await alert_error(context, f"media_group error: {e}")
+    if sent_msgs and isinstance(sent_msgs, list):
+        for i, sm in enumerate(msgs):
+            if i < len(sent_msgs):
+                db_save_map(sm.chat.id, sm.message_id, dst_chat, sent_msgs[i].message_id)
+    if sent_msgs:
+        await record_lag(context, msgs[0], dst_chat, dst_thread)
 
 
 async def replicate_media_with_album_support(
@@ -1198,32 +3360,39 @@ async def replicate_media_with_album_support(
     dest_thread_id: Optional[int],
     *,
     do_translate: bool,
-):
+    plan: Optional[RenderPlan] = None,
+) -> bool:
+    """True si se envió ya; los álbumes solo se encolan (los entrega _flush_media_group)."""
+    plan = plan or RenderPlan(src_msg)
     mgid = getattr(src_msg, "media_group_id", None)
     if not mgid:
-        reply_to_id = resolve_reply_to_id(src_msg, int(dest_chat_id)) if isinstance(dest_chat_id, int) else None
+        reply_to_id = await resolve_reply_to_id(src_msg, int(dest_chat_id)) if isinstance(dest_chat_id, int) else None
         sent = await copy_with_caption(
             context, dest_chat_id, dest_thread_id, src_msg,
-            do_translate=do_translate, reply_to_message_id=reply_to_id
+            do_translate=do_translate, reply_to_message_id=reply_to_id, plan=plan
         )
-        if sent and isinstance(dest_chat_id, int):
-            db_save_map(src_msg.chat.id, src_msg.message_id, int(dest_chat_id), sent.message_id)
-        return
+        if sent:
+            db_save_map(src_msg.chat.id, src_msg.message_id, dest_chat_id, sent.message_id)
+        return sent is not None
 
     key = (src_msg.chat.id, str(mgid), dest_chat_id, dest_thread_id, bool(do_translate))
     bucket = MEDIA_GROUP_BUFFER.setdefault(key, [])
-    bucket.append(src_msg)
+    job = _OUTBOX_JOB.get()
+    if job is not None:
+        job.deferred = True  # el envío real (y su resultado) ocurre en _flush_media_group
+    bucket.append((src_msg, plan, job))
 
     async def _delayed_flush():
         await asyncio.sleep(MEDIA_GROUP_DELAY)
-        await _flush_media_group(context, key)
+        await DELIVERY.submit((dest_chat_id, dest_thread_id), lambda: _flush_media_group(context, key))
 
     task = MEDIA_GROUP_TASKS.get(key)
-    if task and not task.done():
-        return
-    MEDIA_GROUP_TASKS[key] = asyncio.create_task(_delayed_flush())
+    if task is None or task.done():
+        MEDIA_GROUP_TASKS[key] = asyncio.create_task(_delayed_flush())
+    return False
 
 
+@timed_stage("replicate_message")
 async def replicate_message(
     context: ContextTypes.DEFAULT_TYPE,
     src_msg: Message,
@@ -1231,48 +3400,50 @@ async def replicate_message(
     dest_thread_id: Optional[int],
     *,
     do_translate: bool,
-):
+    plan: Optional[RenderPlan] = None,
+) -> bool:
+    """Devuelve True si el mensaje quedó publicado en el destino (para medir el lag)."""
     # Anti-loop interno: si ya es del bot, no repliques
     if is_from_bot(src_msg, context):
-        return
+        return False
+    plan = plan or RenderPlan(src_msg)
+    _METRIC_LABELS.set((
+        metric_route(src_msg.chat.id, src_msg.message_thread_id, dest_chat_id, dest_thread_id),
+        message_kind(src_msg),
+    ))
 
     reply_to_id = None
     if isinstance(dest_chat_id, int):
-        reply_to_id = resolve_reply_to_id(src_msg, dest_chat_id)
+        reply_to_id = await resolve_reply_to_id(src_msg, dest_chat_id)
 
     
     # --- AUDIO: transcribir + traducir + reenviar como audio EN + texto EN ---
     if (getattr(src_msg, "voice", None) or getattr(src_msg, "audio", None)):
         try:
-            await replicate_audio_with_translation(context, src_msg, dest_chat_id, dest_thread_id, do_translate=do_translate)
-            return
+            return await replicate_audio_with_translation(
+                context, src_msg, dest_chat_id, dest_thread_id, do_translate=do_translate, plan=plan
+            )
         except Exception as e:
             # Si falla STT/TTS, hacemos fallback al comportamiento original (copiar audio)
             log.warning("Audio translate fallback (msg %s): %s", src_msg.message_id, e)
     if src_msg.text:
         sent = await send_text(
             context, dest_chat_id, dest_thread_id, src_msg,
-            do_translate=do_translate, reply_to_message_id=reply_to_id
+            do_translate=do_translate, reply_to_message_id=reply_to_id, plan=plan
         )
-        if sent and isinstance(dest_chat_id, int):
+        if sent:
             db_save_map(src_msg.chat.id, src_msg.message_id, dest_chat_id, sent.message_id)
-        return
+        return sent is not None
 
-    await replicate_media_with_album_support(
-        context, src_msg, dest_chat_id, dest_thread_id, do_translate=do_translate
+    delivered = await replicate_media_with_album_support(
+        context, src_msg, dest_chat_id, dest_thread_id, do_translate=do_translate, plan=plan
     )
 
     mgid = getattr(src_msg, "media_group_id", None)
     if mgid and reply_to_id and (src_msg.caption or "").strip() and isinstance(dest_chat_id, int):
         name = sender_display_name(src_msg)
         pref = prefix_block(name)
-        cap_text = src_msg.caption or ""
-        cap_entities = src_msg.caption_entities or []
-        if do_translate and TRANSLATE:
-            cap_html, _ = await translate_visible_html(cap_text, cap_entities)
-        else:
-            cap_html = build_html_no_translate(cap_text, cap_entities)
-        cap_html = cap_with_prefix(pref, cap_html, max_len=3500)
+        cap_html = cap_with_prefix(pref, await plan.caption_html(do_translate), max_len=3500)
         await call_with_retry(
             "reply_album_caption",
             lambda: context.bot.send_message(
@@ -1284,9 +3455,11 @@ async def replicate_message(
                 reply_to_message_id=reply_to_id,
             )
         )
+    return delivered
 
 
 # ================== EDICIONES (AUTO SYNC) ==================
+@timed_stage("replicate_edit", kind="edit")
 async def replicate_edit(
     context: ContextTypes.DEFAULT_TYPE,
     src_msg: Message,
@@ -1294,19 +3467,20 @@ async def replicate_edit(
     dest_thread_id: Optional[int],
     *,
     do_translate: bool,
-):
-    dst_msg_id = db_get_dst_msg(src_msg.chat.id, src_msg.message_id, dest_chat_id)
+    plan: Optional[RenderPlan] = None,
+) -> bool:
+    """Devuelve True si se editó algo en el destino."""
+    _METRIC_LABELS.set((metric_route(src_msg.chat.id, src_msg.message_thread_id, dest_chat_id, dest_thread_id), "edit"))
+    dst_msg_id = await db_get_dst_msg(src_msg.chat.id, src_msg.message_id, dest_chat_id)
     if not dst_msg_id:
-        return
+        return False
+    plan = plan or RenderPlan(src_msg)
+    edited = False
 
     if src_msg.text:
         name = sender_display_name(src_msg)
         pref = prefix_block(name)
-        if do_translate and TRANSLATE:
-            html_text, _ = await translate_visible_html(src_msg.text or "", src_msg.entities or [])
-        else:
-            html_text = build_html_no_translate(src_msg.text or "", src_msg.entities or [])
-        html_text = pref + html_text
+        html_text = pref + await plan.text_html(do_translate)
 
         try:
             await call_with_retry(
@@ -1319,6 +3493,7 @@ async def replicate_edit(
                     disable_web_page_preview=True,
                 ),
             )
+            edited = True
         except BadRequest as e:
             log.warning("edit_message_text failed -> try caption: %s", e)
 
@@ -1326,11 +3501,7 @@ async def replicate_edit(
     if cap:
         name = sender_display_name(src_msg)
         pref = prefix_block(name)
-        if do_translate and TRANSLATE:
-            cap_html, _ = await translate_visible_html(src_msg.caption or "", src_msg.caption_entities or [])
-        else:
-            cap_html = build_html_no_translate(src_msg.caption or "", src_msg.caption_entities or [])
-        cap_html = cap_with_prefix(pref, cap_html, max_len=1024)
+        cap_html = cap_with_prefix(pref, await plan.caption_html(do_translate), max_len=1024)
 
         await call_with_retry(
             "edit_message_caption",
@@ -1341,6 +3512,8 @@ async def replicate_edit(
                 parse_mode=ParseMode.HTML,
             ),
         )
+        edited = True
+    return edited
 
 
 # ================== COMANDOS DE EDICIÓN (opcionales) ==================
@@ -1416,6 +3589,406 @@ async def cmd_editmedia(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.effective_message.reply_text("Ok. Envía ahora el nuevo medio (foto/video/documento/audio).")
 
 
+async def cmd_limits(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not _is_admin(getattr(user, "id", None)):
+        return
+    if not RATE_LIMITER:
+        await update.effective_message.reply_text("Rate limit proactivo desactivado (TG_RATE_LIMIT=false).")
+        return
+    lv = RATE_LIMITER.levels()
+    lines = [f"Global: {lv['global']}/{TG_GLOBAL_RATE:g}"]
+    for chat_id, tokens in sorted(lv["chats"].items(), key=lambda kv: kv[1]):
+        lines.append(f"{chat_id}: {tokens}")
+    await update.effective_message.reply_text("\n".join(lines))
+
+
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not _is_admin(getattr(user, "id", None)):
+        return
+    lines = [f"TCache: {_TCACHE.stats()}", f"ACache: {_ACACHE.stats()}"]
+    if MSG_MAP:
+        lines.append(f"MsgMap: {MSG_MAP.stats()}")
+    await update.effective_message.reply_text("\n".join(lines))
+
+
+async def cmd_lag(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not _is_admin(getattr(user, "id", None)):
+        return
+    pcts = LAG.percentiles()
+    if not pcts:
+        await update.effective_message.reply_text("Sin muestras de lag todavía.")
+        return
+    lines = [f"Lag por ruta (últimos {LAG_WINDOW_SEC:g}s, SLO p{LAG_SLO_PERCENTILE:g} ≤ {LAG_SLO_SEC:g}s):"]
+    for route, p in sorted(pcts.items(), key=lambda kv: -kv[1]["p95"]):
+        lines.append(f"{route}: p50={p['p50']:.1f}s p95={p['p95']:.1f}s p99={p['p99']:.1f}s (n={p['n']:g})")
+    await update.effective_message.reply_text("\n".join(lines)[:4000])
+
+
+async def cmd_dead(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not _is_admin(getattr(user, "id", None)):
+        return
+    rows = await OUTBOX_RUNNER.dead_letters()
+    pending = await OUTBOX_RUNNER.pending()
+    if not rows:
+        await update.effective_message.reply_text(f"Dead-letter vacío. Outbox pendiente: {pending}")
+        return
+    lines = [f"Outbox pendiente: {pending}. Dead-letter (últimos {len(rows)}):"]
+    for key, attempts, err, _dead_at in rows:
+        lines.append(f"• {key} ({attempts} intentos): {(err or '')[:160]}")
+    lines.append("Reencolar: /replay <idem_key> o /replay all")
+    await update.effective_message.reply_text("\n".join(lines)[:4000])
+
+
+async def cmd_replay(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    if not _is_admin(getattr(user, "id", None)):
+        return
+    if not context.args:
+        await update.effective_message.reply_text("Uso: /replay <idem_key|all>")
+        return
+    n = await OUTBOX_RUNNER.replay(context.args[0].strip())
+    await update.effective_message.reply_text(f"✅ {n} job(s) reencolados.")
+
+
+# ================== ENTREGA CONCURRENTE (orden por destino) ==================
+# Los destinos de un mismo mensaje se envían en paralelo; dentro de cada
+# (dst_chat, dst_thread) los envíos salen estrictamente en orden de llegada,
+# así replies y álbumes siguen resolviendo contra el mensaje anterior.
+DELIVERY_CONCURRENCY = int(os.getenv("DELIVERY_CONCURRENCY", "8") or "8")
+
+
+class DeliveryScheduler:
+    def __init__(self, max_concurrency: int):
+        self._sem = asyncio.Semaphore(max(1, max_concurrency))
+        self._tails: Dict[Tuple[Any, Optional[int]], "asyncio.Task[Any]"] = {}
+
+    def submit(self, key: Tuple[Any, Optional[int]], factory: Callable[[], Awaitable[Any]]) -> "asyncio.Task[Any]":
+        """
+        Encola un envío para el destino `key`. Corre cuando terminó el anterior del
+        mismo destino (con o sin error) y hay hueco en el cupo global.
+        """
+        prev = self._tails.get(key)
+
+        async def _run():
+            if prev is not None and not prev.done():
+                await asyncio.wait([prev])
+            async with self._sem:
+                return await factory()
+
+        task = asyncio.ensure_future(_run())
+        self._tails[key] = task
+
+        def _done(t: "asyncio.Task[Any]", k=key):
+            if self._tails.get(k) is t:
+                self._tails.pop(k, None)
+
+        task.add_done_callback(_done)
+        return task
+
+    def pending(self) -> int:
+        return len(self._tails)
+
+
+DELIVERY = DeliveryScheduler(DELIVERY_CONCURRENCY)
+
+
+# ================== OUTBOX (entrega al menos una vez) ==================
+# Cada (mensaje origen, destino, variante) se guarda en la tabla outbox antes de
+# enviarse y se borra al confirmarse. Si el envío falla se reintenta con backoff;
+# tras OUTBOX_MAX_ATTEMPTS (o un error permanente) pasa a outbox_dead, que los
+# admins ven con /dead y reencolan con /replay. Al arrancar se recupera lo que
+# quedó a medias. Idempotencia: db_save_map anota dst_msg en la fila del job
+# (mismo lote que msg_map), así un job ya entregado no se vuelve a publicar.
+# Los miembros de un álbum quedan en vuelo hasta que _flush_media_group envía el
+# grupo: el resultado del envío cierra, reprograma o manda a dead-letter cada uno.
+OUTBOX = os.getenv("OUTBOX", "true").lower() == "true"
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6") or "6")
+OUTBOX_BACKOFF_BASE_SEC = float(os.getenv("OUTBOX_BACKOFF_BASE_SEC", "5") or "5")
+OUTBOX_BACKOFF_MAX_SEC = float(os.getenv("OUTBOX_BACKOFF_MAX_SEC", "600") or "600")
+OUTBOX_POLL_SEC = float(os.getenv("OUTBOX_POLL_SEC", "5") or "5")
+
+_OUTBOX_COLS = (
+    "idem_key, kind, src_chat, src_msg, dst_chat, dst_thread, do_translate, "
+    "payload, attempts, next_at, dst_msg, last_error, created_at"
+)
+
+
+class OutboxJob:
+    __slots__ = ("key", "kind", "src_chat", "src_msg", "dst_chat", "dst_thread", "do_translate", "attempts",
+                 "deferred")
+
+    def __init__(self, kind: str, src_chat: int, src_msg: int, dst_chat: Any, dst_thread: Optional[int],
+                 do_translate: bool, attempts: int = 0, key: str = ""):
+        self.kind = kind
+        self.src_chat = int(src_chat)
+        self.src_msg = int(src_msg)
+        self.dst_chat = dst_chat
+        self.dst_thread = dst_thread
+        self.do_translate = bool(do_translate)
+        self.attempts = attempts
+        self.deferred = False
+        self.key = key or f"{kind}:{src_chat}:{src_msg}:{dst_chat}:{dst_thread if dst_thread is not None else 0}"
+
+
+def _dst_from_db(v: Any) -> Any:
+    s = str(v)
+    return int(s) if s.lstrip("-").isdigit() else s
+
+
+_OUTBOX_JOB: "contextvars.ContextVar[Optional[OutboxJob]]" = contextvars.ContextVar("outbox_job", default=None)
+
+
+def outbox_note_delivered(src_chat: int, src_msg: int, dst_chat: Any, dst_msg: int):
+    """Llamado desde db_save_map: marca el job en curso como ya entregado."""
+    job = _OUTBOX_JOB.get()
+    if job is None or job.kind != "post":
+        return
+    if (job.src_chat, job.src_msg) == (int(src_chat), int(src_msg)) and str(job.dst_chat) == str(dst_chat):
+        db_execute_later("UPDATE outbox SET dst_msg=? WHERE idem_key=?", (int(dst_msg), job.key))
+
+
+def _is_permanent_error(e: Exception) -> bool:
+    return isinstance(e, (BadRequest, Forbidden))
+
+
+class Outbox:
+    def __init__(self):
+        self._inflight: set[str] = set()
+        self._task: Optional["asyncio.Task[Any]"] = None
+        self._app: Optional[Application] = None
+
+    # ---- encolar + primer intento (camino rápido, sin leer SQLite) ----
+    def submit(
+        self,
+        context: ContextTypes.DEFAULT_TYPE,
+        msg: Message,
+        dst_chat: Any,
+        dst_thread: Optional[int],
+        *,
+        do_translate: bool,
+        plan: Optional[RenderPlan] = None,
+        kind: str = "post",
+    ) -> "asyncio.Task[Any]":
+        job = OutboxJob(kind, msg.chat.id, msg.message_id, dst_chat, dst_thread, do_translate)
+        if kind == "edit":
+            ts = msg.edit_date or msg.date
+            job.key += f":{int(ts.timestamp()) if ts else 0}"
+        now = time.time()
+        db_execute_later(
+            f"INSERT OR IGNORE INTO outbox ({_OUTBOX_COLS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?, NULL, NULL, ?)",
+            (job.key, kind, job.src_chat, job.src_msg, str(dst_chat), dst_thread, int(job.do_translate),
+             msg.to_json(), now, now),
+        )
+        self._inflight.add(job.key)
+        return DELIVERY.submit((dst_chat, dst_thread), lambda: self._attempt(job, context, msg, plan))
+
+    async def _attempt(self, job: OutboxJob, context: ContextTypes.DEFAULT_TYPE, msg: Message,
+                       plan: Optional[RenderPlan]):
+        self._inflight.add(job.key)
+        token = _OUTBOX_JOB.set(job)
+        try:
+            if job.kind == "edit":
+                delivered = await replicate_edit(context, msg, job.dst_chat, job.dst_thread,
+                                                 do_translate=job.do_translate, plan=plan)
+            else:
+                delivered = await replicate_message(context, msg, job.dst_chat, job.dst_thread,
+                                                    do_translate=job.do_translate, plan=plan)
+        except Exception as e:
+            if job.deferred:
+                raise  # el álbum ya quedó en el buffer: su flush cierra el job
+            if job.kind == "edit" and isinstance(e, BadRequest) and "not modified" in str(e).lower():
+                self._done(job)
+                return
+            await self._failed(job, e, context)
+            raise
+        else:
+            if job.deferred:
+                return
+            self._done(job)
+            if delivered:
+                await note_delivered(context, msg, job.dst_chat, job.dst_thread, kind=job.kind)
+        finally:
+            _OUTBOX_JOB.reset(token)
+            if not job.deferred:
+                self._release(job.key)
+
+    def _release(self, key: str):
+        # La clave sigue "en vuelo" hasta que el escritor commitee su DELETE/UPDATE;
+        # si no, drain_once podría leer la fila aún pendiente y publicarla otra vez.
+        if MSG_MAP:
+            MSG_MAP.after_commit(lambda: self._inflight.discard(key))
+        else:
+            self._inflight.discard(key)
+
+    def _done(self, job: OutboxJob):
+        db_execute_later("DELETE FROM outbox WHERE idem_key=?", (job.key,))
+
+    # ---- jobs diferidos: miembros de álbum que resuelve _flush_media_group ----
+    def finish_deferred(self, job: OutboxJob):
+        job.deferred = False
+        self._done(job)
+        self._release(job.key)
+
+    async def fail_deferred(self, job: OutboxJob, e: Exception, context: ContextTypes.DEFAULT_TYPE):
+        job.deferred = False
+        try:
+            await self._failed(job, e, context)
+        finally:
+            self._release(job.key)
+
+    async def _failed(self, job: OutboxJob, e: Exception, context: ContextTypes.DEFAULT_TYPE):
+        job.attempts += 1
+        err = f"{type(e).__name__}: {e}"[:500]
+        if _is_permanent_error(e) or job.attempts >= OUTBOX_MAX_ATTEMPTS:
+            now = time.time()
+            db_execute_later("UPDATE outbox SET attempts=?, last_error=? WHERE idem_key=?", (job.attempts, err, job.key))
+            db_execute_later(
+                f"INSERT OR REPLACE INTO outbox_dead ({_OUTBOX_COLS}, dead_at) "
+                f"SELECT {_OUTBOX_COLS}, ? FROM outbox WHERE idem_key=?",
+                (now, job.key),
+            )
+            db_execute_later("DELETE FROM outbox WHERE idem_key=?", (job.key,))
+            log.error("[outbox] %s → dead-letter tras %s intentos: %s", job.key, job.attempts, err)
+            await alert_error(context, f"Outbox dead-letter: {job.key}\n{err}\n/replay {job.key}")
+            return
+        delay = min(OUTBOX_BACKOFF_MAX_SEC, OUTBOX_BACKOFF_BASE_SEC * (2 ** (job.attempts - 1)))
+        db_execute_later(
+            "UPDATE outbox SET attempts=?, next_at=?, last_error=? WHERE idem_key=?",
+            (job.attempts, time.time() + delay, err, job.key),
+        )
+        log.warning("[outbox] %s falló (intento %s/%s), reintento en %.0fs: %s",
+                    job.key, job.attempts, OUTBOX_MAX_ATTEMPTS, delay, err)
+
+    # ---- drenado en segundo plano: reintentos y recuperación tras caída ----
+    def start(self, app: Application):
+        self._app = app
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._drain_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+    async def _drain_loop(self):
+        while True:
+            try:
+                await self.drain_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning("[outbox] drain failed: %s", e)
+            await asyncio.sleep(OUTBOX_POLL_SEC)
+
+    async def drain_once(self) -> int:
+        if not MSG_MAP or self._app is None:
+            return 0
+        await MSG_MAP.flush()  # la tabla refleja todo lo decidido en memoria
+        # Lo que estaba en vuelo al empezar la lectura puede terminar durante ella
+        busy = set(self._inflight)
+        rows = await MSG_MAP.query(
+            f"SELECT {_OUTBOX_COLS} FROM outbox WHERE next_at<=? ORDER BY created_at LIMIT 200",
+            (time.time(),),
+        )
+        context = ContextTypes.DEFAULT_TYPE(self._app)
+        started = 0
+        for (key, kind, src_chat, src_msg, dst_chat, dst_thread, do_tr, payload,
+             attempts, _next_at, dst_msg, _err, _created) in rows:
+            if key in busy or key in self._inflight:
+                continue
+            if dst_msg is not None:
+                # Ya se publicó antes de caer: no duplicar
+                db_execute_later("DELETE FROM outbox WHERE idem_key=?", (key,))
+                continue
+            try:
+                msg = Message.de_json(json.loads(payload), self._app.bot)
+            except Exception as e:
+                log.warning("[outbox] payload inválido %s: %s", key, e)
+                continue
+            job = OutboxJob(kind, src_chat, src_msg, _dst_from_db(dst_chat), dst_thread, bool(do_tr), attempts, key)
+            self._inflight.add(key)
+            task = DELIVERY.submit((job.dst_chat, job.dst_thread), lambda j=job, m=msg: self._attempt(j, context, m, None))
+            task.add_done_callback(lambda t: t.exception() if not t.cancelled() else None)
+            started += 1
+        if started:
+            log.info("[outbox] %s jobs reencolados", started)
+        return started
+
+    async def dead_letters(self, limit: int = 20) -> List[Tuple[Any, ...]]:
+        if not MSG_MAP:
+            return []
+        await MSG_MAP.flush()
+        return await MSG_MAP.query(
+            "SELECT idem_key, attempts, last_error, dead_at FROM outbox_dead ORDER BY dead_at DESC LIMIT ?",
+            (limit,),
+        )
+
+    async def replay(self, key: str) -> int:
+        """Devuelve jobs de outbox_dead a outbox ('all' = todos). Retorna cuántos."""
+        if not MSG_MAP:
+            return 0
+        await MSG_MAP.flush()
+        where, params = ("", ()) if key == "all" else (" WHERE idem_key=?", (key,))
+        n = (await MSG_MAP.query(f"SELECT COUNT(*) FROM outbox_dead{where}", params))[0][0]
+        db_execute_later(
+            f"INSERT OR REPLACE INTO outbox ({_OUTBOX_COLS}) "
+            f"SELECT idem_key, kind, src_chat, src_msg, dst_chat, dst_thread, do_translate, payload, "
+            f"0, ?, NULL, last_error, created_at FROM outbox_dead{where}",
+            (time.time(),) + params,
+        )
+        db_execute_later(f"DELETE FROM outbox_dead{where}", params)
+        await MSG_MAP.flush()
+        return int(n)
+
+    async def pending(self) -> int:
+        if not MSG_MAP:
+            return 0
+        return int((await MSG_MAP.query("SELECT COUNT(*) FROM outbox"))[0][0])
+
+
+OUTBOX_RUNNER = Outbox()
+
+
+def deliver(
+    context: ContextTypes.DEFAULT_TYPE,
+    msg: Message,
+    dst_chat: Any,
+    dst_thread: Optional[int],
+    *,
+    do_translate: bool,
+    plan: Optional[RenderPlan] = None,
+    kind: str = "post",
+) -> "asyncio.Task[Any]":
+    """Entrega a un destino: por el outbox si está activo, si no directo al scheduler."""
+    if OUTBOX:
+        return OUTBOX_RUNNER.submit(context, msg, dst_chat, dst_thread, do_translate=do_translate, plan=plan, kind=kind)
+
+    async def _run():
+        if kind == "edit":
+            delivered = await replicate_edit(context, msg, dst_chat, dst_thread, do_translate=do_translate, plan=plan)
+        else:
+            delivered = await replicate_message(context, msg, dst_chat, dst_thread, do_translate=do_translate, plan=plan)
+        if delivered:
+            await note_delivered(context, msg, dst_chat, dst_thread, kind=kind)
+
+    return DELIVERY.submit((dst_chat, dst_thread), _run)
+
+
+async def note_delivered(context: ContextTypes.DEFAULT_TYPE, msg: Message, dst_chat: Any,
+                         dst_thread: Optional[int], *, kind: str = "post"):
+    # Solo tras un envío/edición real: replicate_* devuelven False si no publicaron nada
+    # (anti-loop, edición sin mapeo, álbum aún en buffer: ese lo mide _flush_media_group)
+    await record_lag(context, msg, dst_chat, dst_thread, edit=(kind == "edit"))
+
+
 # ================== HANDLERS ==================
 async def on_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -1426,7 +3999,7 @@ async def on_channel_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not dst:
             return
         log.info("Channel %s (id=%s) → %s | msg %s", msg.chat.username, msg.chat.id, dst, msg.message_id)
-        await replicate_message(context, msg, dst, None, do_translate=True)
+        await deliver(context, msg, dst, None, do_translate=True)
     except Exception as e:
         log.exception("Error on_channel_post")
         await alert_error(context, f"on_channel_post: {e}")
@@ -1469,14 +4042,14 @@ async def on_group_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
             msg.message_id,
         )
 
-        try:
-            await replicate_message(context, msg, dst_chat, dst_thread, do_translate=do_translate_main)
-        except Exception as e:
-            log.warning("Fallo ruta principal %s#%s -> %s#%s: %s", chat.id, thread_id, dst_chat, dst_thread, e)
-            await alert_error(context, f"Ruta principal fallo: {chat.id}#{thread_id} -> {dst_chat}#{dst_thread}\n{e}")
+        # Un solo plan de render por update: la traducción se comparte con los fanouts.
+        plan = RenderPlan(msg)
+
+        main_task = deliver(context, msg, dst_chat, dst_thread, do_translate=do_translate_main, plan=plan)
 
         tid_norm = thread_id if thread_id is not None else 1
         extras = FANOUT_ROUTES.get((chat.id, tid_norm), [])
+        fanout_tasks = []
         for extra_chat, extra_thread in extras:
             do_translate_extra = not route_no_translate(chat.id, thread_id, extra_chat, extra_thread)
             log.info(
@@ -1488,11 +4061,21 @@ async def on_group_post(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 do_translate_extra,
                 msg.message_id,
             )
-            try:
-                await replicate_message(context, msg, extra_chat, extra_thread, do_translate=do_translate_extra)
-            except Exception as e:
-                log.warning("Fallo fanout %s#%s -> %s#%s: %s", chat.id, tid_norm, extra_chat, extra_thread, e)
-                await alert_error(context, f"Fanout fallo: {chat.id}#{tid_norm} -> {extra_chat}#{extra_thread}\n{e}")
+            fanout_tasks.append(
+                deliver(context, msg, extra_chat, extra_thread, do_translate=do_translate_extra, plan=plan)
+            )
+
+        # La latencia total queda acotada por el destino más lento, no por la suma.
+        results = await asyncio.gather(main_task, *fanout_tasks, return_exceptions=True)
+
+        if isinstance(results[0], Exception):
+            e = results[0]
+            log.warning("Fallo ruta principal %s#%s -> %s#%s: %s", chat.id, thread_id, dst_chat, dst_thread, e)
+            await alert_error(context, f"Ruta principal fallo: {chat.id}#{thread_id} -> {dst_chat}#{dst_thread}\n{e}")
+        for (extra_chat, extra_thread), res in zip(extras, results[1:]):
+            if isinstance(res, Exception):
+                log.warning("Fallo fanout %s#%s -> %s#%s: %s", chat.id, tid_norm, extra_chat, extra_thread, res)
+                await alert_error(context, f"Fanout fallo: {chat.id}#{tid_norm} -> {extra_chat}#{extra_thread}\n{res}")
 
     except Exception as e:
         log.exception("Error on_group_post")
@@ -1508,8 +4091,8 @@ async def on_group_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if chat.type not in (ChatType.SUPERGROUP, ChatType.GROUP):
             return
 
-        # ✅ Dedup edits
-        if seen_recent(chat.id, msg.message_id):
+        # ✅ Dedup edits (por edit_date: no choca con el post original)
+        if seen_recent(chat.id, msg.message_id, msg.edit_date or msg.date):
             return
 
         # ✅ Anti-loop edits
@@ -1538,55 +4121,500 @@ async def on_group_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
             msg.message_id,
         )
 
-        await replicate_edit(context, msg, dst_chat, dst_thread, do_translate=do_translate_main)
+        await deliver(context, msg, dst_chat, dst_thread, do_translate=do_translate_main, kind="edit")
 
     except Exception as e:
         log.exception("Error on_group_edit")
         await alert_error(context, f"on_group_edit: {e}")
 
 
+# ================== UPDATES CONCURRENTES (orden por chat/tema) ==================
+# Updates de distintos (chat, thread) se procesan en paralelo; los del mismo
+# (chat, thread) siguen en orden. Un audio esperando a Whisper ya no frena al resto.
+CONCURRENT_UPDATES = os.getenv("CONCURRENT_UPDATES", "true").lower() == "true"
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8") or "8")
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "256") or "256")
+TG_POOL_SIZE = int(os.getenv("TG_POOL_SIZE", "0") or "0")  # 0 = auto (workers + entregas)
+# Semáforo base de PTB sin límite efectivo: el tope lo lleva KeyedUpdateProcessor
+_UPDATE_PASSTHROUGH = 1 << 30
+
+
+def update_order_key(update: object) -> Tuple[Any, Optional[int]]:
+    if not isinstance(update, Update):
+        return (None, None)
+    chat = update.effective_chat
+    msg = update.effective_message
+    chat_id = chat.id if chat else None
+    tid = getattr(msg, "message_thread_id", None) if msg else None
+    return (chat_id, 1 if tid in (None, 0) else tid)
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Encadena por (chat, thread) y limita a `workers` updates ejecutándose. Ningún
+    cupo se toma mientras un update espera al anterior de su tema: el semáforo base
+    de PTB queda como paso libre y el cupo de workers se toma DESPUÉS de esa espera,
+    así un tema saturado no frena a los demás. UPDATE_QUEUE_MAX limita los updates
+    pendientes (en espera + ejecutándose) con un contador propio: el webhook responde
+    503 al llegar a él y el catch-up espera hueco antes de leer más.
+    """
+
+    def __init__(self, workers: int, queue_max: int):
+        super().__init__(max_concurrent_updates=_UPDATE_PASSTHROUGH)
+        self._workers = asyncio.Semaphore(max(1, workers))
+        self._queue_max = max(1, queue_max)
+        self._tails: Dict[Tuple[Any, Optional[int]], "asyncio.Future[Any]"] = {}
+        self._pending = 0
+        self._room = asyncio.Event()
+        self._room.set()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = update_order_key(update)
+        prev = self._tails.get(key)
+        done: "asyncio.Future[Any]" = asyncio.get_running_loop().create_future()
+        self._tails[key] = done
+        self._pending += 1
+        if self._pending >= self._queue_max:
+            self._room.clear()
+        try:
+            if prev is not None and not prev.done():
+                await asyncio.wait([prev])
+            async with self._workers:
+                await coroutine
+        finally:
+            done.set_result(None)
+            if self._tails.get(key) is done:
+                self._tails.pop(key, None)
+            self._pending -= 1
+            if self._pending < self._queue_max:
+                self._room.set()
+
+    def queued(self) -> int:
+        """Updates en espera de su tema o de un worker, más los que se están ejecutando."""
+        return self._pending
+
+    def full(self) -> bool:
+        return self._pending >= self._queue_max
+
+    async def wait_room(self) -> None:
+        # Deja arrancar las tareas recién creadas para que cuenten antes de mirar
+        await asyncio.sleep(0)
+        while self.full():
+            await self._room.wait()
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
 # ================== MAIN ==================
 def ensure_env():
     if not BOT_TOKEN:
         raise RuntimeError("Falta BOT_TOKEN")
 
 
-def main():
-    ensure_env()
-    db_init()
+async def _post_init(app: Application):
+    await HTTP.start()
+    register_runtime_metrics(app)
+    if METRICS_PORT > 0:
+        await start_metrics_server(app)
+    if CATCHUP and INGEST_MODE != "webhook":
+        await catch_up_backlog(app)
+    if OUTBOX:
+        OUTBOX_RUNNER.start(app)
+
+
+async def _post_stop(app: Application):
+    # Aún con el bot operativo (post_shutdown llega con él ya cerrado)
+    if AUDIO_DRAIN_SEC > 0:
+        await AUDIO_POOL.drain(AUDIO_DRAIN_SEC)
+
+
+async def _post_shutdown(app: Application):
+    await OUTBOX_RUNNER.stop()
+    await AUDIO_POOL.stop()
+    await stop_metrics_server()
+    await HTTP.close()
+    # Flush final de msg_map (bloquea hasta vaciar la cola del hilo escritor)
+    await asyncio.get_running_loop().run_in_executor(None, db_close)
+
+
+# ================== INGESTA: POLLING o WEBHOOK ==================
+# INGEST_MODE=polling (por defecto) o webhook. En webhook levantamos un servidor
+# aiohttp dentro del proceso: sin poll_interval ocioso y Telegram reintenta lo
+# que no aceptamos (503 cuando la cola de handlers está llena).
+INGEST_MODE = os.getenv("INGEST_MODE", "polling").strip().lower()
+ALLOWED_UPDATES = ["channel_post", "message", "edited_message"]
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES", "true").lower() == "true"
+POLL_INTERVAL_SEC = float(os.getenv("POLL_INTERVAL_SEC", "1.2") or "1.2")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")  # URL pública (https://...)
+WEBHOOK_PATH = "/" + (os.getenv("WEBHOOK_PATH", "telegram").strip().strip("/") or "telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0").strip()
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", os.getenv("PORT", "8080")) or "8080")
+# Si no se define, derivamos uno estable del token (Telegram: 1-256 chars [A-Za-z0-9_-])
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip() or (
+    hashlib.sha256(("webhook:" + BOT_TOKEN).encode()).hexdigest()[:48] if BOT_TOKEN else ""
+)
+WEBHOOK_QUEUE_MAX = int(os.getenv("WEBHOOK_QUEUE_MAX", str(UPDATE_QUEUE_MAX)) or "256")
+# /metrics expone chats y rutas: en el puerto público del webhook solo si se pide
+# (por defecto va en el servidor de métricas, METRICS_PORT en 127.0.0.1)
+WEBHOOK_METRICS = os.getenv("WEBHOOK_METRICS", "false").lower() == "true"
+
+
+# ================== CATCH-UP AL ARRANCAR ==================
+# En vez de tirar lo pendiente (drop_pending_updates), lo leemos con getUpdates y
+# lo pasamos por los handlers normales. Solo la LECTURA bloquea el arranque (dos
+# getUpdates a la vez chocan con el polling), y cada lote espera a que haya menos de
+# UPDATE_QUEUE_MAX pendientes; el procesado sigue en segundo plano y los updates en
+# vivo entran detrás, en orden dentro de cada tema (update_processor).
+# Solo en polling: con webhook Telegram ya entrega lo pendiente por el propio webhook
+# (set_webhook no lo tira si CATCHUP), y borrarlo dejaría sin updates un webhook
+# configurado fuera (WEBHOOK_URL vacío).
+CATCHUP = os.getenv("CATCHUP", "true").lower() == "true"
+CATCHUP_MAX_AGE_SEC = float(os.getenv("CATCHUP_MAX_AGE_SEC", "3600") or "3600")
+CATCHUP_MAX_UPDATES = int(os.getenv("CATCHUP_MAX_UPDATES", "5000") or "5000")
+
+
+async def catch_up_backlog(app: Application) -> Dict[str, int]:
+    stats = {"fetched": 0, "queued": 0, "done": 0, "too_old": 0}
+    try:
+        # getUpdates no funciona con webhook activo; lo quitamos SIN tirar pendientes
+        await app.bot.delete_webhook(drop_pending_updates=False)
+    except Exception as e:
+        log.warning("Catch-up: delete_webhook failed: %s", e)
+        return stats
 
+    now = time.time()
+    offset: Optional[int] = None
+    tasks: List["asyncio.Task[Any]"] = []
+
+    async def _run(u: Update):
+        try:
+            await app.update_processor.process_update(u, app.process_update(u))
+        finally:
+            stats["done"] += 1
+
+    proc = app.update_processor
+    while stats["fetched"] < CATCHUP_MAX_UPDATES:
+        if isinstance(proc, KeyedUpdateProcessor):
+            # No leer otro lote mientras haya UPDATE_QUEUE_MAX pendientes
+            await proc.wait_room()
+        try:
+            updates = await app.bot.get_updates(
+                offset=offset, limit=100, timeout=0, allowed_updates=ALLOWED_UPDATES
+            )
+        except Exception as e:
+            log.warning("Catch-up: get_updates failed: %s", e)
+            break
+        if not updates:
+            break
+        offset = updates[-1].update_id + 1
+        stats["fetched"] += len(updates)
+        for u in updates:
+            msg = u.effective_message
+            ts = (msg.edit_date or msg.date) if msg else None
+            if ts is not None and (now - ts.timestamp()) > CATCHUP_MAX_AGE_SEC:
+                stats["too_old"] += 1
+                continue
+            tasks.append(asyncio.create_task(_run(u)))
+            stats["queued"] += 1
+        log.info(
+            "Catch-up: %s leídos | %s encolados | %s procesados | %s descartados por antigüedad",
+            stats["fetched"], stats["queued"], stats["done"], stats["too_old"],
+        )
+
+    if offset is not None:
+        # Confirmamos el offset para que polling/webhook no los vuelva a entregar
+        try:
+            await app.bot.get_updates(offset=offset, limit=1, timeout=0, allowed_updates=ALLOWED_UPDATES)
+        except Exception as e:
+            log.warning("Catch-up: confirm offset failed: %s", e)
+
+    global _CATCHUP_TASK
+    if tasks:
+        _CATCHUP_TASK = asyncio.create_task(_catch_up_wait(tasks, stats))
+    elif stats["fetched"]:
+        log.info("Catch-up terminado: %s", stats)
+    return stats
+
+
+_CATCHUP_TASK: Optional["asyncio.Task[Any]"] = None
+
+
+async def _catch_up_wait(tasks: List["asyncio.Task[Any]"], stats: Dict[str, int]):
+    while tasks:
+        done, pending = await asyncio.wait(tasks, timeout=5)
+        tasks = list(pending)
+        if tasks:
+            log.info("Catch-up: %s/%s procesados", stats["done"], stats["queued"])
+    log.info("Catch-up terminado: %s", stats)
+
+
+def ingest_backlog(app: Application) -> int:
+    """Updates aceptados y aún sin terminar (cola de PTB + pendientes en el update_processor)."""
+    depth = app.update_queue.qsize()
+    proc = app.update_processor
+    if isinstance(proc, KeyedUpdateProcessor):
+        depth += proc.queued()
+    return depth
+
+
+# ================== MÉTRICAS: GAUGES Y SERVIDOR ==================
+_RUNTIME_METRICS_APP: Optional[Application] = None
+_METRICS_RUNNER: Optional[web.AppRunner] = None
+
+
+def register_runtime_metrics(app: Application):
+    """Gauges leídos al vuelo de los stats que ya llevan cachés, colas y limitadores."""
+    global _RUNTIME_METRICS_APP
+    if _RUNTIME_METRICS_APP is not None:
+        _RUNTIME_METRICS_APP = app
+        return
+    _RUNTIME_METRICS_APP = app
+
+    def _cache_events() -> Dict[Tuple[Any, ...], float]:
+        out: Dict[Tuple[Any, ...], float] = {}
+        t = _TCACHE.stats()
+        out[("translation", "hit_mem")] = t["hits_mem"]
+        out[("translation", "hit_db")] = t["hits_db"]
+        out[("translation", "miss")] = t["misses"]
+        a = _ACACHE.stats()
+        out[("audio", "hit_mem")] = a["hits_mem"]
+        out[("audio", "hit_db")] = a["hits_db"]
+        out[("audio", "miss")] = a["misses"]
+        out[("audio", "coalesced")] = _AUDIO_COALESCED[0]
+        if MSG_MAP:
+            m = MSG_MAP.stats()
+            out[("msg_map", "hit")] = m["cache_hits"]
+            out[("msg_map", "miss")] = m["cache_misses"]
+        return out
+
+    def _queues() -> Dict[Tuple[Any, ...], float]:
+        out: Dict[Tuple[Any, ...], float] = {("delivery",): DELIVERY.pending(), ("audio_captions",): AUDIO_POOL.pending()}
+        if _RUNTIME_METRICS_APP is not None:
+            out[("updates",)] = ingest_backlog(_RUNTIME_METRICS_APP)
+        if MSG_MAP:
+            out[("msg_map_writer",)] = MSG_MAP.stats()["pending"]
+        return out
+
+    def _buckets() -> Dict[Tuple[Any, ...], float]:
+        if not RATE_LIMITER:
+            return {}
+        lv = RATE_LIMITER.levels()
+        out: Dict[Tuple[Any, ...], float] = {("global",): lv["global"]}
+        for chat, v in lv["chats"].items():
+            out[(chat,)] = v
+        return out
+
+    METRICS.counter_fn("replicator_cache_events_total", "Aciertos/fallos acumulados por caché", ("cache", "result"),
+                       _cache_events)
+    METRICS.gauge_fn("replicator_queue_depth", "Trabajo pendiente por cola", ("queue",), _queues)
+    METRICS.gauge_fn("replicator_rate_bucket_tokens", "Tokens disponibles por bucket", ("bucket",), _buckets)
+    METRICS.gauge_fn(
+        "replicator_lag_seconds", "Lag entregado − msg.date por ruta (ventana deslizante)", ("route", "quantile"),
+        lambda: {(r, q): p["p" + q[2:]] for r, p in LAG.percentiles().items() for q in ("0.50", "0.95", "0.99")},
+    )
+    METRICS.counter_fn(
+        "replicator_deepl_batches_total", "Peticiones y textos enviados por el batcher de DeepL", ("what",),
+        lambda: {("requests",): _DEEPL_BATCHER.requests, ("texts",): _DEEPL_BATCHER.texts},
+    )
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(text=METRICS.render(), content_type="text/plain", charset="utf-8")
+
+
+async def handle_healthz(request: web.Request) -> web.Response:
+    # Vivo = el hilo escritor de msg_map sigue en pie (si muere, perdemos mapeos)
+    if MSG_MAP and not MSG_MAP.writer_alive():
+        return web.Response(status=503, text="msg_map writer down")
+    return web.Response(text="ok")
+
+
+def create_metrics_app() -> web.Application:
+    mapp = web.Application()
+    mapp.router.add_get("/metrics", handle_metrics)
+    mapp.router.add_get("/healthz", handle_healthz)
+    return mapp
+
+
+async def start_metrics_server(app: Application):
+    global _METRICS_RUNNER
+    if _METRICS_RUNNER is not None:
+        return
+    runner = web.AppRunner(create_metrics_app(), access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        log.warning("Métricas: no se pudo escuchar en %s:%s: %s", METRICS_HOST, METRICS_PORT, e)
+        await runner.cleanup()
+        return
+    _METRICS_RUNNER = runner
+    log.info("Métricas en http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+
+async def stop_metrics_server():
+    global _METRICS_RUNNER
+    if _METRICS_RUNNER is not None:
+        await _METRICS_RUNNER.cleanup()
+        _METRICS_RUNNER = None
+
+
+def create_webhook_app(app: Application, *, secret: str = "", path: str = "") -> web.Application:
+    secret = secret or WEBHOOK_SECRET
+    path = path or WEBHOOK_PATH
+
+    async def handle_update(request: web.Request) -> web.Response:
+        got = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if secret and not hmac.compare_digest(got, secret):
+            return web.Response(status=403, text="forbidden")
+        if ingest_backlog(app) >= WEBHOOK_QUEUE_MAX:
+            # Telegram reintenta la entrega más tarde
+            return web.Response(status=503, text="busy", headers={"Retry-After": "1"})
+        try:
+            data = await request.json()
+            update = Update.de_json(data, app.bot)
+        except Exception as e:
+            log.warning("Webhook: body inválido: %s", e)
+            return web.Response(status=400, text="bad request")
+        if update is None:
+            return web.Response(status=400, text="bad request")
+        await app.update_queue.put(update)
+        return web.Response(text="ok")
+
+    wapp = web.Application(client_max_size=4 * 1024 * 1024)
+    wapp.router.add_post(path, handle_update)
+    wapp.router.add_get("/healthz", handle_healthz)
+    if WEBHOOK_METRICS:
+        wapp.router.add_get("/metrics", handle_metrics)
+    return wapp
+
+
+async def run_webhook(app: Application):
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    await app.initialize()
+    await _post_init(app)  # run_polling lo llama solo; aquí gestionamos el ciclo a mano
+    await app.start()
+    runner = web.AppRunner(create_webhook_app(app), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+    log.info("Webhook escuchando en %s:%s%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+    try:
+        if WEBHOOK_URL:
+            await app.bot.set_webhook(
+                url=WEBHOOK_URL + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=ALLOWED_UPDATES,
+                drop_pending_updates=DROP_PENDING_UPDATES and not CATCHUP,
+                max_connections=max(1, min(100, UPDATE_WORKERS * 2)),
+            )
+        else:
+            log.warning("WEBHOOK_URL vacío: no se registra el webhook en Telegram (se asume ya configurado).")
+        await stop.wait()
+    finally:
+        await runner.cleanup()
+        if app.running:
+            await app.stop()
+            await _post_stop(app)
+        await app.shutdown()
+        await _post_shutdown(app)
+
+
+def build_application(
+    *,
+    base_url: Optional[str] = None,
+    base_file_url: Optional[str] = None,
+    local_mode: Optional[bool] = None,
+) -> Application:
+    base_url = base_url or TG_API_BASE_URL
+    base_file_url = base_file_url or TG_API_BASE_FILE_URL
+    local_mode = TG_LOCAL_MODE if local_mode is None else local_mode
+    pool_size = TG_POOL_SIZE or max(8, (UPDATE_WORKERS if CONCURRENT_UPDATES else 1) + DELIVERY_CONCURRENCY)
     request = HTTPXRequest(
+        connection_pool_size=pool_size,
         connect_timeout=20.0,
         read_timeout=60.0,
         write_timeout=60.0,
         pool_timeout=20.0,
     )
 
-    app = Application.builder().token(BOT_TOKEN).request(request).build()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(request)
+        .post_init(_post_init)
+        .post_stop(_post_stop)
+        .post_shutdown(_post_shutdown)
+    )
+    if base_url:
+        builder = builder.base_url(base_url)
+    if base_file_url:
+        builder = builder.base_file_url(base_file_url)
+    if local_mode:
+        builder = builder.local_mode(True)
+    if CONCURRENT_UPDATES:
+        builder = builder.concurrent_updates(KeyedUpdateProcessor(UPDATE_WORKERS, UPDATE_QUEUE_MAX))
+    if RATE_LIMITER:
+        builder = builder.rate_limiter(RATE_LIMITER)
+    app = builder.build()
     app.add_handler(MessageHandler(filters.ChatType.CHANNEL, on_channel_post))
-    app.add_handler(MessageHandler(filters.ChatType.GROUPS, on_group_post))
+    # Solo mensajes nuevos: las ediciones van a on_group_edit (si no, el primer handler se las come)
+    app.add_handler(MessageHandler(filters.ChatType.GROUPS & filters.UpdateType.MESSAGE, on_group_post))
     app.add_handler(MessageHandler(filters.ChatType.GROUPS & filters.UpdateType.EDITED_MESSAGE, on_group_edit))
 
     # Opcional
     app.add_handler(CommandHandler("edit", cmd_edit))
     app.add_handler(CommandHandler("editmedia", cmd_editmedia))
+    app.add_handler(CommandHandler("limits", cmd_limits))
+    app.add_handler(CommandHandler("stats", cmd_stats))
+    app.add_handler(CommandHandler("lag", cmd_lag))
+    app.add_handler(CommandHandler("dead", cmd_dead))
+    app.add_handler(CommandHandler("replay", cmd_replay))
+    return app
+
+
+def main():
+    ensure_env()
+    db_init()
+    app = build_application()
 
     log.info(
-        "Replicator iniciado. Translate=%s, Buttons=%s | ENV_SRC=%s ENV_DST=%s | DB=%s | DedupTTL=%ss",
+        "Replicator iniciado. Translate=%s, Buttons=%s | ENV_SRC=%s ENV_DST=%s | DB=%s | DedupTTL=%ss | HTTP pool/host=%s | TCache=%s | Workers=%s | Ingest=%s | CatchUp=%s | BotAPI=%s%s",
         TRANSLATE,
         TRANSLATE_BUTTONS,
         ENV_SRC,
         ENV_DST,
         str(DB_PATH),
         str(DEDUP_TTL_SECONDS),
+        HTTP_POOL_LIMIT_PER_HOST,
+        TRANSLATION_CACHE,
+        UPDATE_WORKERS if CONCURRENT_UPDATES else 1,
+        INGEST_MODE,
+        CATCHUP,
+        TG_API_BASE_URL or "api.telegram.org",
+        " (local)" if TG_LOCAL_MODE else "",
     )
 
+    if INGEST_MODE == "webhook":
+        asyncio.run(run_webhook(app))
+        return
+
     app.run_polling(
-        allowed_updates=["channel_post", "message", "edited_message"],
-        poll_interval=1.2,
+        allowed_updates=ALLOWED_UPDATES,
+        poll_interval=POLL_INTERVAL_SEC,
         stop_signals=None,
-        drop_pending_updates=True
-
+        # Con catch-up el backlog ya se procesó en post_init; lo llegado entretanto no se tira
+        drop_pending_updates=DROP_PENDING_UPDATES and not CATCHUP,
     )
 
 